@@ -0,0 +1,26 @@
+from .captcha import CaptchaBenchConfig, run_captcha_bench
+from .harness import BenchConfig, compare_reports, report_meta, run_benchmarks, write_report
+from .loadtest import LoadTestConfig, run_loadtest
+from .pending import PendingBenchConfig, run_pending_bench
+from .proxy import NetworkProfile
+from .replay import ReplayBenchConfig, run_replay_bench
+from .storage import StorageBenchConfig, run_storage_bench
+
+__all__ = [
+    "BenchConfig",
+    "CaptchaBenchConfig",
+    "LoadTestConfig",
+    "NetworkProfile",
+    "PendingBenchConfig",
+    "ReplayBenchConfig",
+    "StorageBenchConfig",
+    "compare_reports",
+    "report_meta",
+    "run_benchmarks",
+    "run_captcha_bench",
+    "run_loadtest",
+    "run_pending_bench",
+    "run_replay_bench",
+    "run_storage_bench",
+    "write_report",
+]
@@ -0,0 +1,114 @@
+import glob
+import io
+import os
+import random
+import tempfile
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from pkg.bench.harness import report_meta
+from pkg.bench.stats import summarize
+from pkg.internal.captcha import MODEL_VARIANTS, CaptchaSolver, DatasetConfig
+
+
+@dataclass
+class CaptchaBenchConfig:
+    # Labeled captchas, named by their answer like `captcha train` expects
+    training_dir: str
+    variants: List[str] = field(default_factory=lambda: list(MODEL_VARIANTS))
+    # Share of the images held out of training to measure accuracy on
+    holdout: float = .2
+    epochs: int = 60
+    # Single image predictions timed per variant, and the batch size of the batched ones
+    samples: int = 200
+    batch: int = 32
+    # Tries a login gets at the captcha, see `service login-all --attempts`
+    attempts: int = 3
+    # The recommended variant is the fastest whose login success stays at or above this
+    min_login_success: float = .99
+    # Keep the trained weights as <models_dir>/<variant>, to use the winner
+    models_dir: Optional[str] = None
+    seed: int = 0
+
+
+def _split(config: CaptchaBenchConfig):
+    """ The same held out images on every run and for every variant """
+    filenames = sorted(os.listdir(config.training_dir))
+    random.Random(config.seed).shuffle(filenames)
+    holdout = max(int(len(filenames) * config.holdout), 1)
+    return filenames[holdout:], filenames[:holdout]
+
+
+def _weights_size(solver: CaptchaSolver) -> int:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model')
+        solver.save(path)
+        return sum(os.path.getsize(file) for file in glob.glob(path + '*'))
+
+
+def _bench_variant(variant: str, config: CaptchaBenchConfig, train: List[str], held_out: List[str]) -> Dict[str, Any]:
+    solver = CaptchaSolver(DatasetConfig(variant=variant))
+    started = time.perf_counter()
+    solver.fit(*solver.load_dataset(config.training_dir, train), epochs=config.epochs)
+    training_seconds = time.perf_counter() - started
+    if config.models_dir:
+        os.makedirs(config.models_dir, exist_ok=True)
+        solver.save(os.path.join(config.models_dir, variant))
+
+    accuracy = solver.evaluate(*solver.load_dataset(config.training_dir, held_out))
+    images = []
+    for filename in held_out:
+        with open(os.path.join(config.training_dir, filename), 'rb') as fd:
+            images.append(fd.read())
+
+    # The first calls build the model's graph
+    solver.predict_batch(images[:config.batch])
+    solver.predict(io.BytesIO(images[0]))  # type: ignore
+
+    single = []
+    for i in range(config.samples):
+        data = io.BytesIO(images[i % len(images)])
+        call_started = time.perf_counter()
+        solver.predict(data)  # type: ignore
+        single.append((time.perf_counter() - call_started) * 1000)
+
+    batched = []
+    batch = (images * (config.batch // len(images) + 1))[:config.batch]
+    for _ in range(max(config.samples // config.batch, 1)):
+        call_started = time.perf_counter()
+        solver.predict_batch(batch)
+        batched.append((time.perf_counter() - call_started) * 1000 / len(batch))
+
+    return {
+        'parameters': solver.model.count_params(),
+        'weights_bytes': _weights_size(solver),
+        'training_seconds': training_seconds,
+        **accuracy,
+        # Each try is a fresh captcha
+        'login_success': 1 - (1 - accuracy['captcha_accuracy']) ** config.attempts,
+        'latency_ms': summarize(single),
+        'batched_latency_ms_per_image': summarize(batched),
+    }
+
+
+def run_captcha_bench(config: CaptchaBenchConfig) -> Dict[str, Any]:
+    """ Train every variant on the same images and compare their inference cost and accuracy on
+    the held out ones, recommending the fastest that keeps logins succeeding
+    """
+    unknown = set(config.variants) - set(MODEL_VARIANTS)
+    if unknown:
+        raise ValueError(f"unknown captcha model variants {', '.join(sorted(unknown))}")
+    train, held_out = _split(config)
+    variants = {variant: _bench_variant(variant, config, train, held_out) for variant in config.variants}
+
+    good_enough = [
+        variant for variant, report in variants.items()
+        if report['login_success'] >= config.min_login_success
+    ]
+    return {
+        'meta': report_meta(config),
+        'images': {'train': len(train), 'held_out': len(held_out)},
+        'variants': variants,
+        'recommended': min(good_enough, key=lambda variant: variants[variant]['latency_ms']['p50'], default=None),
+    }
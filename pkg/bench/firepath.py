@@ -0,0 +1,152 @@
+import json
+import ssl
+import time
+from typing import Any, Dict, List
+
+from pkg.bench.stats import summarize
+from pkg.internal.requests import ArmedRequest, RawRequest, Request
+from pkg.internal.tls import create_client_context
+
+order_headers = {
+    'User-Agent': 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/111.0',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/avif,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Authorization': 'BasicAuthentication 0123456789abcdef',
+}
+
+order_req = {
+    'isin': 'IRO1FAKE0001',
+    'orderCount': 1,
+    'orderPrice': 1000,
+    'orderSide': '65',
+    'orderValidity': 74,
+}
+
+
+def _micros(samples: List[int]) -> Dict[str, float]:
+    return summarize([sample / 1000 for sample in samples])
+
+
+class _TimedTransport:
+    """ Delegates to transport and remembers when the first write happened.
+    uvloop transports don't let their write be replaced, so the protocol gets this instead.
+    """
+
+    def __init__(self, transport) -> None:
+        self.transport = transport
+        self.first_write_at = 0
+
+    def write(self, data):
+        if not self.first_write_at:
+            self.first_write_at = time.perf_counter_ns()
+        self.transport.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.transport, name)
+
+
+async def _first_write_after(conn, fire) -> int:
+    """ Run fire on conn and return nanoseconds from wake up to the first byte handed to the socket """
+    protocol = conn.protocol
+    timed = _TimedTransport(protocol.transport)
+    protocol.transport = timed
+    try:
+        woke_at = time.perf_counter_ns()
+        async with fire(conn) as response:
+            await response.read()
+    finally:
+        protocol.transport = timed.transport
+    return timed.first_write_at - woke_at
+
+
+async def fire_path_cost(n: int, url: str) -> Dict[str, Any]:
+    """ Microseconds from waking up at the deadline to the first byte on the wire """
+
+    def fire_built(conn):
+        # What used to happen after the probe loop: build the payload and the request, then send
+        request = Request(
+            method='post',
+            url=url,
+            headers={**order_headers, 'Content-Type': 'application/json'},
+            data=json.dumps(order_req).encode(),
+        )
+        return request.send(conn)
+
+    armed = ArmedRequest(
+        method='post',
+        url=url,
+        headers={**order_headers, 'Content-Type': 'application/json'},
+        data=json.dumps(order_req).encode(),
+    )
+
+    report = {}
+    for name, fire in (('built_at_fire_time', fire_built), ('armed', armed.send)):
+        samples = []
+        for _ in range(n):
+            async with armed.make_connection() as conn:
+                samples.append(await _first_write_after(conn, fire))
+        report[name] = _micros(samples)
+    return report
+
+
+async def raw_sender_cost(n: int, url: str, cafile: str) -> Dict[str, Any]:
+    """ Microseconds from fire to the parsed response headers over TLS,
+    plus fire to write complete for the raw sender
+    """
+    ssl_context = ssl.create_default_context(cafile=cafile)
+
+    report = {}
+    for request_class in (ArmedRequest, RawRequest):
+        request = request_class(
+            method='post',
+            url=url,
+            headers={**order_headers, 'Content-Type': 'application/json'},
+            data=json.dumps(order_req).encode(),
+            ssl_context=ssl_context,
+        )
+
+        write_times = []
+        response_times = []
+        for _ in range(n):
+            async with request.make_connection() as conn:
+                fired_at = time.perf_counter_ns()
+                async with request.send(conn) as response:
+                    responded_at = time.perf_counter_ns()
+                    await response.read()
+                if isinstance(request, RawRequest):
+                    write_times.append(response.written_at - response.fired_at)
+                response_times.append(responded_at - fired_at)
+
+        report[request_class.__name__] = {'response': _micros(response_times)}
+        if write_times:
+            report[request_class.__name__]['write_complete'] = _micros(write_times)
+    return report
+
+
+async def handshake_cost(n: int, url: str, cafile: str) -> Dict[str, Any]:
+    """ Microseconds to open an order connection over TLS, full handshakes against resumed ones.
+    Also on TLS 1.3, where resuming saves the certificate work rather than a round trip.
+    """
+    contexts = {
+        'full': ssl.create_default_context(cafile=cafile),
+        'resumed': create_client_context(cafile),
+    }
+
+    report: Dict[str, Any] = {}
+    for name, ssl_context in contexts.items():
+        request = ArmedRequest(method='get', url=url, ssl_context=ssl_context)
+        # Leaves the session behind for the resuming context to offer
+        async with request.make_connection():
+            pass
+
+        samples = []
+        reused = 0
+        for _ in range(n):
+            started = time.perf_counter_ns()
+            async with request.make_connection() as conn:
+                samples.append(time.perf_counter_ns() - started)
+                ssl_object = conn.transport.get_extra_info('ssl_object')  # type: ignore
+                reused += ssl_object.session_reused
+                version = ssl_object.version()
+        report[name] = {**_micros(samples), 'session_reused': reused, 'tls_version': version}
+    return report
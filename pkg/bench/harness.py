@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import json
+import os
+import platform
+import ssl
+import subprocess
+import tempfile
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Literal, Optional
+
+import aiohttp
+
+from pkg.bench.firepath import fire_path_cost, handshake_cost, raw_sender_cost
+from pkg.bench.proxy import NetworkProfile, run_delay_proxy
+from pkg.bench.scheduling import arrival_error
+from pkg.bench.servers import free_port, make_self_signed_cert, run_test_server, start_process
+from pkg.internal.runtime import describe_runtime
+
+Transport = Literal["plain", "tls"]
+
+
+@dataclass
+class BenchConfig:
+    rounds: int = 5
+    # Seconds between scheduling a round and its deadline
+    lead: float = 2
+    concurrency: List[int] = field(default_factory=lambda: [1, 10, 100])
+    transports: List[Transport] = field(default_factory=lambda: ["plain", "tls"])
+    profiles: List[NetworkProfile] = field(
+        default_factory=lambda: [NetworkProfile(), NetworkProfile(latency=.02, jitter=.005)])
+    fire_path_samples: int = 200
+    seed: int = 0
+
+
+def report_meta(config: Any) -> Dict[str, Any]:
+    """ Where and how a report was produced, config is the benchmark's dataclass config """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'date': datetime.datetime.utcnow().isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'aiohttp': aiohttp.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'runtime': describe_runtime(),
+        'config': asdict(config),
+    }
+
+
+def compare_reports(reports: Dict[str, Dict[str, Any]], by: str) -> Dict[str, Any]:
+    """ Reports of the same benchmark keyed by what differs between them, `by` names it.
+    A single report is returned as is, so every report has its meta at the top.
+    """
+    if len(reports) == 1:
+        return next(iter(reports.values()))
+    return {'meta': next(iter(reports.values()))['meta'], by: reports}
+
+
+def write_report(report: Dict[str, Any], output: Optional[str] = None):
+    """ The JSON report to the output file, stdout without one """
+    if output:
+        with open(output, 'w') as fd:
+            json.dump(report, fd, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+def run_benchmarks(config: BenchConfig) -> Dict[str, Any]:
+    """ Run every benchmark against local test servers and return a JSON serializable report """
+
+    with tempfile.TemporaryDirectory() as certdir:
+        certfile, keyfile = make_self_signed_cert(certdir)
+        client_ssl_context = ssl.create_default_context(cafile=certfile)
+
+        ports = {"plain": free_port(), "tls": free_port()}
+        servers = [
+            start_process(run_test_server, ports["plain"], port=ports["plain"]),
+            start_process(run_test_server, ports["tls"], certfile, keyfile, port=ports["tls"]),
+        ]
+
+        try:
+            report: Dict[str, Any] = {
+                'meta': report_meta(config),
+                'fire_path_us': asyncio.run(
+                    fire_path_cost(config.fire_path_samples, f'http://localhost:{ports["plain"]}/post')),
+                'tls_send_us': asyncio.run(
+                    raw_sender_cost(config.fire_path_samples, f'https://localhost:{ports["tls"]}/post', certfile)),
+                'tls_handshake_us': asyncio.run(
+                    handshake_cost(config.fire_path_samples, f'https://localhost:{ports["tls"]}/', certfile)),
+                'scheduling': [],
+            }
+
+            for profile in config.profiles:
+                for transport in config.transports:
+                    port, proxy = ports[transport], None
+                    if profile.latency or profile.jitter:
+                        port = free_port()
+                        proxy = start_process(
+                            run_delay_proxy, port, ports[transport], profile.latency, profile.jitter, config.seed,
+                            port=port,
+                        )
+
+                    scheme = 'https' if transport == "tls" else 'http'
+                    try:
+                        for concurrency in config.concurrency:
+                            result = asyncio.run(arrival_error(
+                                f'{scheme}://localhost:{port}',
+                                concurrency=concurrency,
+                                rounds=config.rounds,
+                                lead=config.lead,
+                                ssl_context=client_ssl_context if transport == "tls" else None,
+                            ))
+                            report['scheduling'].append({
+                                'network': profile.name,
+                                'transport': transport,
+                                'concurrency': concurrency,
+                                **result,
+                            })
+                    finally:
+                        if proxy:
+                            proxy.terminate()
+        finally:
+            for server in servers:
+                server.terminate()
+
+    return report
@@ -0,0 +1,212 @@
+import asyncio
+import datetime
+import itertools
+import logging
+import os
+import random
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Literal
+
+import aiohttp
+from aiohttp import web
+
+from pkg.bench.harness import report_meta
+from pkg.bench.servers import free_port, start_process
+from pkg.bench.stats import summarize
+from pkg.internal import jsoncodec
+from pkg.internal.brokers import FakeBroker
+from pkg.internal.brokers.simulator import LatencyModel, SimulatorConfig, run_simulator
+from pkg.internal.jsoncodec import JsonBackend
+from pkg.server.factory import create_server
+from pkg.service import Service
+from pkg.storage import SqliteStorage
+
+Operation = Literal["order", "balance", "stocks", "accounts"]
+
+
+@dataclass
+class LoadTestConfig:
+    duration: float = 30
+    concurrency: int = 50
+    # Relative weight of each API call in the generated traffic
+    mix: Dict[Operation, float] = field(
+        default_factory=lambda: {"order": 1, "balance": 10, "stocks": 10, "accounts": 1})
+    accounts: int = 20
+    # Seconds between scheduling an order and its deadline
+    lead: float = 3
+    simulator_latency: float = .01
+    simulator_jitter: float = .002
+    seed: int = 0
+    json_backend: JsonBackend = 'auto'
+
+
+def run_api_server(port: int, simulator_url: str, db_path: str, json_backend: JsonBackend = 'auto'):
+    """ `main.py serve` as it would run against the simulator, plus a route reading its loop lag """
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    jsoncodec.use(json_backend)
+    storage = SqliteStorage(f'sqlite+pysqlite:///{db_path}')
+    storage.migrate()
+
+    service = Service(storage, {"FAKE": FakeBroker(simulator_url)})
+    app = create_server(service, statics_dir=None)
+    monitor = service.critical_window.monitor
+
+    async def lag_handler(request: web.Request):
+        samples = [lag * 1000 for lag in monitor.samples]
+        monitor.samples.clear()
+        return web.json_response(summarize(samples))
+
+    app.router.add_get('/_loadtest/lag', lag_handler)
+    web.run_app(app, host='localhost', port=port, print=lambda _: None)
+
+
+class LoadGenerator:
+    def __init__(self, config: LoadTestConfig, api_url: str, usernames: List[str]) -> None:
+        self.config = config
+        self.api_url = api_url
+        self.usernames = usernames
+        self.random = random.Random(config.seed)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        # Unique prices tell the orders apart in the simulator's arrival log
+        self.prices = itertools.count(1)
+        self.deadlines: Dict[int, datetime.datetime] = {}
+
+    async def call(self, session: aiohttp.ClientSession, operation: Operation):
+        username = self.random.choice(self.usernames)
+        if operation == "order":
+            price = next(self.prices)
+            deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.config.lead)
+            self.deadlines[price] = deadline
+            request = session.post(self.api_url + '/api/order', json={
+                'username': username,
+                'deadline': deadline.isoformat(),
+                'count': 1,
+                'price': price,
+                'isin': 'IRO1FAKE0001',
+            })
+        elif operation == "balance":
+            request = session.get(self.api_url + '/api/balance', params={'username': username})
+        elif operation == "stocks":
+            request = session.get(self.api_url + '/api/stocks', params={'label': 'fold', 'broker': 'FAKE'})
+        else:
+            request = session.get(self.api_url + '/api/accounts')
+
+        started = time.perf_counter()
+        try:
+            async with request as response:
+                await response.read()
+                if response.status != 200:
+                    self.errors[operation] += 1
+        except aiohttp.ClientError:
+            self.errors[operation] += 1
+        self.latencies[operation].append((time.perf_counter() - started) * 1000)
+
+    async def worker(self, session: aiohttp.ClientSession, until: float):
+        operations = list(self.config.mix.keys())
+        weights = list(self.config.mix.values())
+        while time.perf_counter() < until:
+            await self.call(session, self.random.choices(operations, weights)[0])
+
+    async def run(self) -> float:
+        connector = aiohttp.TCPConnector(limit=self.config.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            started = time.perf_counter()
+            until = started + self.config.duration
+            await asyncio.gather(*(self.worker(session, until) for _ in range(self.config.concurrency)))
+            return time.perf_counter() - started
+
+
+async def _login_accounts(api_url: str, count: int) -> List[str]:
+    usernames = [f'loadtest{i}' for i in range(count)]
+    async with aiohttp.ClientSession() as session:
+        for username in usernames:
+            async with session.post(api_url + '/api/login', json={
+                'username': username,
+                'password': username,
+                'broker': 'FAKE',
+            }) as response:
+                response.raise_for_status()
+    return usernames
+
+
+async def _arrival_errors(simulator_url: str, deadlines: Dict[int, datetime.datetime]) -> List[float]:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(simulator_url + '_sim/arrivals') as response:
+            arrivals = await response.json()
+
+    errors = []
+    for arrival in arrivals:
+        deadline = deadlines.get(arrival['price'])
+        if deadline:
+            deadline_at = deadline.replace(tzinfo=datetime.timezone.utc).timestamp()
+            errors.append((arrival['arrived_at'] - deadline_at) * 1000)
+    return errors
+
+
+async def _drive(config: LoadTestConfig, api_url: str, simulator_url: str) -> Dict[str, Any]:
+    usernames = await _login_accounts(api_url, config.accounts)
+    async with aiohttp.ClientSession() as session:
+        # Drop the lag collected during start up and logins
+        await (await session.get(api_url + '/_loadtest/lag')).read()
+
+    generator = LoadGenerator(config, api_url, usernames)
+    elapsed = await generator.run()
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(api_url + '/_loadtest/lag') as response:
+            loop_lag = await response.json()
+
+    # Let the orders scheduled near the end fire
+    await asyncio.sleep(config.lead + 1)
+    arrival_errors = await _arrival_errors(simulator_url, generator.deadlines)
+
+    total = sum(len(latencies) for latencies in generator.latencies.values())
+    return {
+        'throughput_rps': total / elapsed,
+        'requests': total,
+        'endpoints': {
+            operation: {
+                'requests': len(latencies),
+                'errors': generator.errors[operation],
+                'throughput_rps': len(latencies) / elapsed,
+                'latency_ms': summarize(latencies),
+            }
+            for operation, latencies in generator.latencies.items()
+        },
+        'server_loop_lag_ms': loop_lag,
+        'orders': {
+            'scheduled': len(generator.deadlines),
+            'arrived': len(arrival_errors),
+            'arrival_error_ms': summarize(arrival_errors),
+        },
+    }
+
+
+def run_loadtest(config: LoadTestConfig) -> Dict[str, Any]:
+    """ Load one API server process backed by the broker simulator and report its capacity """
+    simulator_port, api_port = free_port(), free_port()
+    simulator_url = f'http://localhost:{simulator_port}/'
+    api_url = f'http://localhost:{api_port}'
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        simulator_config = SimulatorConfig(
+            latency=LatencyModel("normal", config.simulator_latency, config.simulator_jitter),
+            seed=config.seed,
+        )
+        processes = [
+            start_process(run_simulator, 'localhost', simulator_port, simulator_config, port=simulator_port),
+            start_process(
+                run_api_server, api_port, simulator_url, os.path.join(data_dir, 'sqlite.db'), config.json_backend,
+                port=api_port),
+        ]
+        try:
+            report = asyncio.run(_drive(config, api_url, simulator_url))
+        finally:
+            for process in processes:
+                process.terminate()
+
+    return {'meta': report_meta(config), **report}
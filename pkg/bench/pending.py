@@ -0,0 +1,124 @@
+import asyncio
+import datetime
+import gc
+import multiprocessing
+import os
+import resource
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Literal
+
+import aiohttp
+from yarl import URL
+
+from pkg.bench.harness import report_meta
+from pkg.bench.stats import summarize
+from pkg.internal.pending import PendingOrders
+from pkg.models import Account, Order
+
+# compact: PendingOrders as the service keeps them now
+# coroutines: what it did before, a sleeping task per order holding its Order and its own Account
+Representation = Literal["compact", "coroutines"]
+
+
+@dataclass
+class PendingBenchConfig:
+    representations: List[Representation] = field(default_factory=lambda: ["coroutines", "compact"])
+    orders: int = 100_000
+    accounts: int = 100
+    # Full collections timed per representation
+    collections: int = 5
+
+
+def _rss_bytes() -> int:
+    try:
+        with open('/proc/self/statm') as fd:
+            return int(fd.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Peak rather than current, but it only grows here
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _account(username: str) -> Account:
+    """ Like the ones storage hands out, each with its own CookieJar """
+    cookies = aiohttp.CookieJar()
+    cookies.update_cookies({'ASP.NET_SessionId': 'x' * 24, 'Token': 'y' * 64}, URL('https://example.com'))
+    return Account(
+        id=uuid.uuid4(),
+        broker='FAKE',
+        username=username,
+        password='password',
+        last_login=datetime.datetime.utcnow(),
+        cookies=cookies,
+        headers={'User-Agent': 'Mozilla/5.0', 'Authorization': 'BasicAuthentication 0123456789abcdef'},
+    )
+
+
+async def _sleeping_worker(accounts: List[Account], orders: List[Order], deadline: datetime.datetime):
+    await asyncio.sleep((deadline - datetime.datetime.utcnow()).total_seconds())
+
+
+async def _hold(representation: Representation, config: PendingBenchConfig) -> Dict[str, Any]:
+    gc.collect()
+    rss_before = _rss_bytes()
+    deadline = datetime.datetime.utcnow() + datetime.timedelta(days=1)
+
+    pending = PendingOrders(lambda _: None)
+    tasks = []
+    started = time.perf_counter()
+    for i in range(config.orders):
+        username = f'user{i % config.accounts}'
+        order = Order(
+            id=uuid.uuid4(),
+            broker='FAKE',
+            isin='IRO1FAKE0001',
+            count=1,
+            price=1000 + i % 100,
+            status='SCHEDULED',
+            username=username,
+            deadline=deadline + datetime.timedelta(milliseconds=i),
+        )
+        order.trace.mark("scheduled")
+        if representation == "compact":
+            pending.add([order])
+        else:
+            tasks.append(asyncio.create_task(_sleeping_worker([_account(username)], [order], order.deadline)))  # type: ignore
+    schedule_seconds = time.perf_counter() - started
+    # Let the tasks start and suspend in their sleep
+    await asyncio.sleep(0)
+
+    pauses = []
+    for _ in range(config.collections):
+        collection_started = time.perf_counter()
+        gc.collect()
+        pauses.append((time.perf_counter() - collection_started) * 1000)
+    report = {
+        'rss_mb': (_rss_bytes() - rss_before) / 2 ** 20,
+        'schedule_seconds': schedule_seconds,
+        'gc_tracked_objects': len(gc.get_objects()),
+        'gc_full_collection_ms': summarize(pauses),
+    }
+
+    await pending.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return report
+
+
+def _run(representation: Representation, config: PendingBenchConfig, results: Any):
+    results.put(asyncio.run(_hold(representation, config)))
+
+
+def run_pending_bench(config: PendingBenchConfig) -> Dict[str, Any]:
+    """ Memory and gc cost of holding config.orders scheduled orders, each representation in a fresh process """
+    context = multiprocessing.get_context('spawn')
+    reports = {}
+    for representation in config.representations:
+        results = context.Queue()
+        process = context.Process(target=_run, args=(representation, config, results))
+        process.start()
+        reports[representation] = results.get()
+        process.join()
+    return {'meta': report_meta(config), 'representations': reports}
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+import random
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger('myapp')
+
+
+@dataclass
+class NetworkProfile:
+    """ One way delay injected by DelayProxy, in seconds """
+    latency: float = 0
+    jitter: float = 0
+
+    @property
+    def name(self) -> str:
+        return f'{self.latency * 1000:g}ms+-{self.jitter * 1000:g}ms'
+
+
+class DelayProxy:
+    """ TCP proxy delaying every chunk by latency +- jitter in both directions.
+    Works below TLS, so it can sit in front of plain and TLS test servers alike.
+    Chunks are never reordered: a chunk is not delivered before the one ahead of it.
+    """
+
+    def __init__(self, target_port: int, profile: NetworkProfile, seed: Optional[int] = None) -> None:
+        self.target_port = target_port
+        self.profile = profile
+        self.random = random.Random(seed)
+
+    def delay(self) -> float:
+        jitter = self.random.uniform(-self.profile.jitter, self.profile.jitter)
+        return max(self.profile.latency + jitter, 0)
+
+    async def __pipe(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        async def deliver():
+            while True:
+                deliver_at, chunk = await queue.get()
+                wait = deliver_at - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                if not chunk:
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    return
+                writer.write(chunk)
+
+        deliverer = asyncio.create_task(deliver())
+        last_delivery = 0.0
+        try:
+            while True:
+                chunk = await reader.read(65536)
+                last_delivery = max(loop.time() + self.delay(), last_delivery)
+                queue.put_nowait((last_delivery, chunk))
+                if not chunk:
+                    break
+            await deliverer
+        except ConnectionError:
+            deliverer.cancel()
+            writer.close()
+
+    async def handle(self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection('localhost', self.target_port)
+        except OSError as exc:
+            logger.warning(f"proxy can't reach upstream: {exc}")
+            client_writer.close()
+            return
+
+        await asyncio.gather(
+            self.__pipe(client_reader, upstream_writer),
+            self.__pipe(upstream_reader, client_writer),
+            return_exceptions=True,
+        )
+        upstream_writer.close()
+        client_writer.close()
+
+    async def serve(self, port: int):
+        server = await asyncio.start_server(self.handle, 'localhost', port)
+        async with server:
+            await server.serve_forever()
+
+
+def run_delay_proxy(port: int, target_port: int, latency: float, jitter: float, seed: Optional[int] = None):
+    proxy = DelayProxy(target_port, NetworkProfile(latency, jitter), seed)
+    asyncio.run(proxy.serve(port))
@@ -0,0 +1,154 @@
+import asyncio
+import datetime
+import json
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+from yarl import URL
+
+from pkg.bench.harness import report_meta
+from pkg.bench.servers import free_port, start_process
+from pkg.bench.stats import summarize
+from pkg.internal.brokers import AuthenticationError, BrokerError, FakeBroker
+from pkg.internal.brokers.replay import Archive, Exchange, run_replay
+from pkg.internal.brokers.simulator import API_PREFIX
+from pkg.internal.captcha import CaptchaSolver, DatasetConfig
+from pkg.internal.tracing import OrderTrace
+
+# Recorded requests the bench makes through the broker, the captcha and probe requests the broker makes itself
+OPERATIONS = {
+    ('POST', '/login'): 'login',
+    ('GET', API_PREFIX + '/Symbol/GetSymbol'): 'stock',
+    ('GET', API_PREFIX + '/Accounting/GetCustomerAccount'): 'balance',
+    ('POST', API_PREFIX + '/Order/Post'): 'order',
+}
+
+
+@dataclass
+class ReplayBenchConfig:
+    archive: str
+    # Multiplies the recorded offsets and response times, 0 replays as fast as possible
+    time_scale: float = 1
+    # Seconds before its recorded send time an order is handed to the broker
+    lead: float = 3
+    # Solve the recorded captchas with this model, timing inference, instead of skipping it
+    captcha_model: Optional[str] = None
+    captcha_variant: str = 'baseline'
+
+
+class _Replayer:
+    def __init__(self, config: ReplayBenchConfig, archive: Archive, broker: FakeBroker) -> None:
+        self.config = config
+        self.archive = archive
+        self.broker = broker
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.fire_errors: List[float] = []
+        # The session of the last login, the replay server answers any
+        self.session = (aiohttp.CookieJar(), {'User-Agent': 'replay'})
+
+    async def run(self, exchanges: List[Exchange]) -> float:
+        loop = asyncio.get_running_loop()
+        first_at = exchanges[0].at if exchanges else 0
+        # Room for the orders due right at the start to be armed
+        started = loop.time() + self.config.lead
+        tasks = []
+        for exchange in exchanges:
+            operation = OPERATIONS.get((exchange.method, URL(exchange.path).path))
+            if operation:
+                due = started + (exchange.at - first_at) * self.config.time_scale
+                tasks.append(asyncio.create_task(self.__replay(operation, exchange, due)))
+        await asyncio.gather(*tasks)
+        return loop.time() - started
+
+    async def __replay(self, operation: str, exchange: Exchange, due: float):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(due - loop.time() - (self.config.lead if operation == 'order' else 0), 0))
+
+        started = time.perf_counter()
+        try:
+            if operation == 'login':
+                headers, cookies = await self.broker.login('replay', 'replay', 'replay')
+                self.session = (cookies, headers)
+            elif operation == 'stock':
+                await self.broker.get_stock(URL(exchange.path).query.get('term', ''))
+            elif operation == 'balance':
+                cookies, headers = self.session
+                await self.broker.get_account_balance(headers, cookies)
+            else:
+                await self.__order(exchange, due)
+                return
+        except (AuthenticationError, BrokerError, aiohttp.ClientError, asyncio.TimeoutError, ValueError):
+            self.errors[operation] += 1
+        self.latencies[operation].append((time.perf_counter() - started) * 1000)
+
+    async def __order(self, exchange: Exchange, due: float):
+        """ Fire at the recorded send time, its error is how far off the first byte went out """
+        body = json.loads(self.archive.blob(exchange.request_body) or b'{}')
+        loop = asyncio.get_running_loop()
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=due - loop.time())
+        trace = OrderTrace()
+        cookies, headers = self.session
+        try:
+            await self.broker.schedule_order(
+                cookies, headers, deadline,
+                body.get('isin', ''), body.get('orderPrice', 0), body.get('orderCount', 1), trace)
+        except (BrokerError, aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            self.errors['order'] += 1
+            return
+
+        events = dict(trace.events)
+        if 'first_byte_written' in events:
+            written = trace.wall_time(events['first_byte_written'])
+            self.fire_errors.append((written - deadline).total_seconds() * 1000)
+        if 'first_byte_written' in events and 'response_headers' in events:
+            self.latencies['order'].append((events['response_headers'] - events['first_byte_written']) / 1e6)
+
+
+async def _drive(config: ReplayBenchConfig, archive: Archive, replay_url: str) -> Dict[str, Any]:
+    solver = None
+    if config.captcha_model:
+        solver = CaptchaSolver(DatasetConfig(variant=config.captcha_variant))
+        solver.load(config.captcha_model)
+    broker = FakeBroker(replay_url, captcha_ml=solver)
+    replayer = _Replayer(config, archive, broker)
+    try:
+        elapsed = await replayer.run(sorted(archive.exchanges, key=lambda exchange: exchange.at))
+    finally:
+        await broker.close()
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(replay_url + '_replay/misses') as response:
+            misses = await response.json()
+
+    return {
+        'archive': archive.summary(),
+        'elapsed': elapsed,
+        'operations': {
+            operation: {
+                'errors': replayer.errors[operation],
+                'latency_ms': summarize(replayer.latencies[operation]),
+            }
+            for operation in sorted(set(OPERATIONS.values()))
+        },
+        'order_fire_error_ms': summarize(replayer.fire_errors),
+        'unrecorded_requests': misses,
+    }
+
+
+def run_replay_bench(config: ReplayBenchConfig) -> Dict[str, Any]:
+    """ Replay a recorded session through the broker code, against its recorded responses served
+    with their recorded timing by a replay server process. Two commits replaying the same archive
+    see the same broker.
+    """
+    archive = Archive(config.archive)
+    port = free_port()
+    process = start_process(run_replay, 'localhost', port, config.archive, config.time_scale, port=port)
+    try:
+        report = asyncio.run(_drive(config, archive, f'http://localhost:{port}/'))
+    finally:
+        process.terminate()
+    return {'meta': report_meta(config), **report}
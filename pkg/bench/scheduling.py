@@ -0,0 +1,64 @@
+import asyncio
+import datetime
+import json
+import ssl
+import time
+from typing import Any, Dict, Optional
+
+from pkg.bench.firepath import order_headers, order_req
+from pkg.bench.stats import summarize
+from pkg.internal.requests import ArmedRequest, calc_latency, schedule_request
+
+
+async def estimate_latency(url: str, ssl_context: Optional[ssl.SSLContext] = None, probes: int = 5) -> float:
+    """ Same estimate the brokers use: the minimum of a few calc_latency probes """
+    min_latency = 0.0
+    for _ in range(probes):
+        latency = await calc_latency('get', url, ssl_context=ssl_context)
+        if latency < min_latency or min_latency == 0:
+            min_latency = latency
+    return min_latency
+
+
+async def arrival_error(
+        url: str,
+        concurrency: int,
+        rounds: int,
+        lead: float,
+        ssl_context: Optional[ssl.SSLContext] = None,
+) -> Dict[str, Any]:
+    """ Schedule `concurrency` orders sharing one deadline, `rounds` times,
+    and compare the time the test server got each one with the deadline.
+    """
+    latency = await estimate_latency(url + '/', ssl_context)
+    body = json.dumps(order_req).encode()
+
+    async def fire(deadline: datetime.datetime) -> float:
+        request = ArmedRequest(
+            method='post',
+            url=url + '/post',
+            headers={**order_headers, 'Content-Type': 'application/json'},
+            data=body,
+            ssl_context=ssl_context,
+        )
+        async with schedule_request(request, deadline, latency) as response:
+            arrived_at = (await response.json())['timeit']
+        return arrived_at - deadline.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    errors = []
+    cpu_started, wall_started = time.process_time(), time.perf_counter()
+    for _ in range(rounds):
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=lead)
+        errors.extend(await asyncio.gather(*(fire(deadline) for _ in range(concurrency))))
+    cpu, wall = time.process_time() - cpu_started, time.perf_counter() - wall_started
+
+    return {
+        'latency_estimate_ms': latency * 1000,
+        'arrival_error_ms': summarize([error * 1000 for error in errors]),
+        'early': sum(1 for error in errors if error < 0),
+        'cpu': {
+            'cpu_seconds': cpu,
+            'wall_seconds': wall,
+            'utilization': cpu / wall,
+        },
+    }
@@ -0,0 +1,80 @@
+import multiprocessing
+import os
+import socket
+import ssl
+import subprocess
+import time
+from typing import Optional, Tuple
+
+from aiohttp import web
+
+
+async def time_handler(request: web.Request):
+    """ Reply with the wall clock time the request arrived at """
+    arrived_at = time.time()
+    await request.read()
+    return web.json_response({'timeit': arrived_at})
+
+
+def create_test_app() -> web.Application:
+    app = web.Application()
+    app.add_routes([
+        web.get('/', time_handler),
+        web.post('/post', time_handler),
+    ])
+    return app
+
+
+def make_self_signed_cert(directory: str) -> Tuple[str, str]:
+    """ Create a throwaway certificate for localhost, returns (certfile, keyfile) """
+    certfile = os.path.join(directory, 'cert.pem')
+    keyfile = os.path.join(directory, 'key.pem')
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+        '-keyout', keyfile, '-out', certfile, '-days', '1',
+        '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+    ], check=True, capture_output=True)
+    return certfile, keyfile
+
+
+def server_ssl_context(certfile: str, keyfile: str) -> ssl.SSLContext:
+    ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ssl_context.load_cert_chain(certfile, keyfile)
+    return ssl_context
+
+
+def run_test_server(port: int, certfile: Optional[str] = None, keyfile: Optional[str] = None):
+    ssl_context = server_ssl_context(certfile, keyfile) if certfile and keyfile else None
+    web.run_app(
+        create_test_app(),
+        host='localhost',
+        port=port,
+        ssl_context=ssl_context,
+        print=lambda _: None,
+    )
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port: int, timeout: float = 10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with socket.create_connection(('localhost', port), timeout=1):
+                return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(.05)
+
+
+def start_process(target, *args, port: int) -> multiprocessing.Process:
+    """ Run target(*args) in a daemon process and wait until it listens on port """
+    process = multiprocessing.Process(target=target, args=args, daemon=True)
+    process.start()
+    wait_for_port(port)
+    return process
@@ -0,0 +1,28 @@
+import math
+import statistics
+from typing import Dict, Sequence
+
+
+def percentile(sorted_samples: Sequence[float], q: float) -> float:
+    """ Nearest-rank percentile of already sorted samples, q in [0, 100] """
+    if not sorted_samples:
+        return math.nan
+    rank = max(math.ceil(q / 100 * len(sorted_samples)), 1)
+    return sorted_samples[rank - 1]
+
+
+def summarize(samples: Sequence[float]) -> Dict[str, float]:
+    """ Distribution summary used by every benchmark report """
+    ordered = sorted(samples)
+    if not ordered:
+        return {'count': 0}
+
+    return {
+        'count': len(ordered),
+        'min': ordered[0],
+        'mean': statistics.fmean(ordered),
+        'p50': percentile(ordered, 50),
+        'p95': percentile(ordered, 95),
+        'p99': percentile(ordered, 99),
+        'max': ordered[-1],
+    }
@@ -0,0 +1,104 @@
+import datetime
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Literal
+
+import aiohttp
+
+from pkg.bench.harness import report_meta
+from pkg.bench.stats import summarize
+from pkg.internal.tracing import OrderTrace
+from pkg.journal import JournalStorage
+from pkg.models import Account, Order
+from pkg.storage import AbstractStorage, SqliteStorage
+
+Engine = Literal["sqlite", "journal"]
+
+
+@dataclass
+class StorageBenchConfig:
+    engines: List[Engine] = field(default_factory=lambda: ["sqlite", "journal"])
+    # Orders written, read and updated per engine
+    orders: int = 2000
+    accounts: int = 20
+
+
+def _create(engine: Engine, directory: str) -> AbstractStorage:
+    """ File backed like in production, an in-memory sqlite would flatter it """
+    if engine == "journal":
+        return JournalStorage(directory)
+    storage = SqliteStorage(f'sqlite+pysqlite:///{directory}/sqlite.db')
+    storage.migrate()
+    return storage
+
+
+def _time(operation: Callable[[Any], Any], args: List[Any]) -> Dict[str, float]:
+    """ Per call latency in microseconds and throughput of calling operation on each of args """
+    samples = []
+    started = time.perf_counter()
+    for arg in args:
+        call_started = time.perf_counter_ns()
+        operation(arg)
+        samples.append((time.perf_counter_ns() - call_started) / 1000)
+    elapsed = time.perf_counter() - started
+    return {**summarize(samples), 'ops_per_second': len(args) / elapsed}
+
+
+def _bench_engine(engine: Engine, config: StorageBenchConfig) -> Dict[str, Any]:
+    with tempfile.TemporaryDirectory() as directory:
+        storage = _create(engine, directory)
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        orders = [
+            Order(
+                id=uuid.uuid4(),
+                broker='FAKE',
+                isin='IRO1FAKE0001',
+                count=1,
+                price=1000 + i,
+                status='SCHEDULED',
+                username=f'user{i % config.accounts}',
+                deadline=deadline + datetime.timedelta(milliseconds=i),
+            )
+            for i in range(config.orders)
+        ]
+        usernames = [f'user{i}' for i in range(config.accounts)]
+        trace = OrderTrace()
+        trace.mark('scheduled')
+        trace.mark('fire')
+
+        report: Dict[str, Any] = {}
+        report['add_account'] = _time(storage.add_account, [
+            Account(
+                id=uuid.uuid4(),
+                broker='FAKE',
+                username=username,
+                password='password',
+                last_login=datetime.datetime.utcnow(),
+                cookies=aiohttp.CookieJar(),
+                headers={'Authorization': 'BasicAuthentication 0123456789abcdef'},
+            )
+            for username in usernames
+        ])
+        report['add_order'] = _time(storage.add_order, orders)
+        report['get_account_by_username'] = _time(
+            storage.get_account_by_username, [orders[i].username for i in range(config.orders)])
+        report['get_order_by_id'] = _time(storage.get_order_by_id, [order.id for order in orders])
+        report['get_scheduled_orders'] = _time(lambda _: storage.get_scheduled_orders(), range(10))
+        report['update_order_trace'] = _time(lambda order: storage.update_order_trace(order.id, trace), orders)
+        report['update_order_status'] = _time(
+            lambda order: storage.update_order_status(order.id, 'DONE'), orders)
+
+        started = time.perf_counter()
+        storage.close()
+        report['close_seconds'] = time.perf_counter() - started
+        return report
+
+
+def run_storage_bench(config: StorageBenchConfig) -> Dict[str, Any]:
+    """ Hot path storage calls of each engine, one after the other on one thread """
+    return {
+        'meta': report_meta(config),
+        'engines': {engine: _bench_engine(engine, config) for engine in config.engines},
+    }
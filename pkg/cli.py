@@ -1,16 +1,38 @@
 import os
 import asyncio
+import csv
+import time
 import logging
 from aiohttp import web
-from typing import Optional
+from aiohttp.resolver import DefaultResolver
+from typing import Dict, List, Optional, Tuple
 import typer
+from yarl import URL
 
-from pkg.config import get_config
-from pkg.internal.brokers import TavanaBroker
-from pkg.internal.captcha import CaptchaSolver
+from pkg.bench import (
+    BenchConfig, CaptchaBenchConfig, LoadTestConfig, NetworkProfile, PendingBenchConfig, ReplayBenchConfig,
+    StorageBenchConfig, compare_reports, run_benchmarks, run_captcha_bench, run_loadtest, run_pending_bench,
+    run_replay_bench, run_storage_bench, write_report,
+)
+from pkg.config import MainConfig, RuntimeConfig, get_config
+from pkg.internal.brokers import (
+    AbstractBroker, BrokerName, EndpointResolver, FakeBroker, RateLimiter, StaticResolver, TavanaBroker)
+from pkg.internal.brokers.replay import API_URL, SITE_URL, Archive, run_recorder, run_replay
+from pkg.internal.brokers.resolver import parse_hosts
+from pkg.internal.brokers.simulator import API_PREFIX, LatencyModel, SimulatorConfig, run_simulator
+from pkg.internal.captcha import MODEL_VARIANTS, CaptchaSolver, DatasetConfig
+from pkg.internal.critical import CriticalWindow
+from pkg.internal.looplag import LoopLagMonitor
+from pkg.internal import jsoncodec
+from pkg.internal.events import EventHub
+from pkg.internal.latencyprofile import LatencyProfile
+from pkg.internal.marketdata import MarketDataEngine
+from pkg.internal.runtime import install_runtime
+from pkg.journal import JournalStorage, path_from_url
+from pkg.server.cluster import run_cluster
 from pkg.server.factory import create_server
-from pkg.service import Service
-from pkg.storage import SqliteStorage
+from pkg.service import Service, ServiceRole
+from pkg.storage import AbstractStorage, SqliteStorage
 
 srv_cli = typer.Typer()
 captcha_cli = typer.Typer()
@@ -26,19 +48,159 @@ cli.add_typer(
     help='Predict and train captcha model'
 )
 
+# Taken by every benchmark command, their reports are written by pkg.bench.write_report
+REPORT_OUTPUT = typer.Option(None, help='Write the JSON report to this file instead of stdout')
+COMPARE_LOOPS = typer.Option([], help='Compare these event loops instead of runtime.loop, repeatable')
+
+
+def create_storage(config: MainConfig, url: Optional[str] = None) -> AbstractStorage:
+    url = url or config.storage.url
+    if url.startswith('journal:'):
+        return JournalStorage(
+            path_from_url(url),
+            commit_interval=config.storage.journal_commit_interval,
+            compact_bytes=config.storage.journal_compact_bytes,
+            snapshot_interval=config.storage.journal_snapshot_interval,
+        )
+    return SqliteStorage(url)
+
+
+def create_critical_window(config: MainConfig) -> CriticalWindow:
+    return CriticalWindow(
+        LoopLagMonitor(),
+        before=config.critical_window.before,
+        after=config.critical_window.after,
+    )
+
+
+def create_limiter(config: MainConfig, name: BrokerName, window: CriticalWindow) -> RateLimiter:
+    return RateLimiter(
+        name,
+        rate=config.broker.rate_limit,
+        burst=config.broker.burst,
+        max_concurrency=config.broker.max_concurrency,
+        window=window,
+    )
+
+
+def create_resolver(config: MainConfig, name: BrokerName, limiter: RateLimiter) -> Optional[EndpointResolver]:
+    if not config.broker.pin_endpoints:
+        return None
+    return EndpointResolver(
+        name,
+        limiter,
+        resolver=StaticResolver(parse_hosts(config.broker.hosts), fallback=DefaultResolver()),
+        ttl=config.broker.dns_ttl,
+        reevaluate_interval=config.broker.endpoint_reevaluate_interval,
+    )
+
+
+def create_latency_profile(
+        config: MainConfig, name: BrokerName, storage: Optional[AbstractStorage]) -> Optional[LatencyProfile]:
+    if storage is None or not config.latency_profile.enabled:
+        return None
+    return LatencyProfile(
+        name,
+        storage,
+        timezone=config.latency_profile.timezone,
+        days=config.latency_profile.days,
+        window=config.latency_profile.window,
+        quantile=config.latency_profile.quantile,
+        min_days=config.latency_profile.min_days,
+    )
+
+
+def create_solver(config: MainConfig) -> CaptchaSolver:
+    """ An untrained model of the configured variant, load config.captcha.model into it """
+    return CaptchaSolver(DatasetConfig(variant=config.captcha.variant))
+
+
+def create_brokers(
+        config: MainConfig,
+        ml: CaptchaSolver,
+        storage: Optional[AbstractStorage] = None,
+        window: Optional[CriticalWindow] = None,
+) -> Dict[BrokerName, AbstractBroker]:
+    """ storage: where the brokers keep their latency profile, none without it
+    window: the service's critical window, the brokers shed calls while it's open
+    """
+    window = window or create_critical_window(config)
+    limiter = create_limiter(config, "TAVANA", window)
+    urls = {}
+    if config.broker.tavana_url:
+        urls = {
+            'base_url': URL(config.broker.tavana_url),
+            'base_api_url': URL(config.broker.tavana_url).with_path(API_PREFIX + '/'),
+        }
+    brokers: Dict[BrokerName, AbstractBroker] = {
+        "TAVANA": TavanaBroker(
+            ml,
+            raw_sender=config.broker.raw_sender,
+            **urls,
+            limiter=limiter,
+            latency_profile=create_latency_profile(config, "TAVANA", storage),
+            resolver=create_resolver(config, "TAVANA", limiter),
+        ),
+    }
+    if config.broker.fake_url:
+        limiter = create_limiter(config, "FAKE", window)
+        brokers["FAKE"] = FakeBroker(
+            config.broker.fake_url,
+            raw_sender=config.broker.raw_sender,
+            limiter=limiter,
+            latency_profile=create_latency_profile(config, "FAKE", storage),
+            resolver=create_resolver(config, "FAKE", limiter),
+        )
+    return brokers
+
+
+def runtimes_to_compare(config: MainConfig, loops: List[str]) -> List[RuntimeConfig]:
+    """ The configured runtime, once per requested loop implementation """
+    if not loops:
+        return [config.runtime]
+    return [config.runtime.copy(update={'loop': loop}) for loop in loops]
+
+
+def create_service(config: MainConfig, role: ServiceRole = 'standalone') -> Service:
+    """ The service `main.py serve` runs, loads the captcha model """
+    ml = create_solver(config)
+    ml.load(config.captcha.model)
+
+    storage = create_storage(config)
+    critical_window = create_critical_window(config)
+    brokers = create_brokers(config, ml, storage, critical_window)
+    return Service(
+        storage=storage,
+        brokers=brokers,
+        market_data={
+            name: MarketDataEngine(
+                broker,
+                min_interval=config.market_data.min_interval,
+                max_interval=config.market_data.max_interval,
+                near=config.market_data.near,
+            )
+            for name, broker in brokers.items()
+        },
+        critical_window=critical_window,
+        role=role,
+        poll_interval=config.server.scheduler_poll_interval,
+        events=EventHub(config.server.ws_queue_size),
+        balance_interval=config.server.ws_balance_interval,
+        stats_interval=config.server.ws_stats_interval,
+    )
+
 
 @srv_cli.command('login')
 def login(broker: str, username: str, password: str):
     config = get_config()
+    install_runtime(config.runtime)
 
-    ml = CaptchaSolver()
+    ml = create_solver(config)
     ml.load(config.captcha.model)
 
     service = Service(
-        storage=SqliteStorage(config.storage.url),
-        brokers={
-            "TAVANA": TavanaBroker(ml),
-        }
+        storage=create_storage(config),
+        brokers=create_brokers(config, ml)
     )
 
     try:
@@ -47,20 +209,81 @@ def login(broker: str, username: str, password: str):
         print('account id:', account.id)
     except Exception as exc:
         print(exc)
+    finally:
+        service.storage.close()
+
+
+@srv_cli.command('login-all')
+def login_all(
+    csv_path: Optional[str] = typer.Option(
+        None, '--csv', help='File of broker,username,password rows, every stored account without it'),
+    concurrency: int = typer.Option(20, help='Logins in flight at once'),
+    attempts: int = typer.Option(3, help='Tries per account, a misread captcha is retried'),
+    retry_delay: float = typer.Option(.5, help='Seconds between the tries of an account'),
+):
+    """ Log in many accounts at once with one captcha model and connection pool """
+    config = get_config()
+    install_runtime(config.runtime)
+
+    ml = create_solver(config)
+    ml.load(config.captcha.model)
+
+    service = Service(
+        storage=create_storage(config),
+        brokers=create_brokers(config, ml)
+    )
+
+    credentials: List[Tuple[BrokerName, str, str]] = []
+    if csv_path:
+        with open(csv_path, newline='') as fd:
+            for row in csv.reader(fd):
+                if not row or row[0].strip().lower() == 'broker':
+                    continue
+                broker, username, password = (field.strip() for field in row[:3])
+                credentials.append((broker, username, password))  # type: ignore
+    else:
+        credentials = [(account.broker, account.username, account.password) for account in service.storage.get_accounts()]
+
+    async def run():
+        try:
+            return await service.login_all(credentials, concurrency, attempts, retry_delay)
+        finally:
+            for broker in service.brokers.values():
+                await broker.close()
+
+    try:
+        started = time.perf_counter()
+        results = asyncio.run(run())
+        elapsed = time.perf_counter() - started
+    finally:
+        service.storage.close()
+
+    print(f"{'username':<20} {'broker':<8} {'attempts':>8} {'seconds':>8}  result")
+    for result in results:
+        print(f"{result.username:<20} {result.broker:<8} {result.attempts:>8} {result.seconds:>8.2f}  "
+              f"{result.error or 'ok'}")
+    seconds = sorted(result.seconds for result in results if result.account)
+    logged_in = len(seconds)
+    print(f"{logged_in}/{len(results)} logged in within {elapsed:.2f}s", end='')
+    if seconds:
+        print(f", per account p50 {seconds[len(seconds) // 2]:.2f}s max {seconds[-1]:.2f}s")
+    else:
+        print()
+    if logged_in < len(results):
+        raise typer.Exit(1)
 
 
 @srv_cli.command('balance')
 def account_balance(username: str):
     config = get_config()
+    install_runtime(config.runtime)
 
-    ml = CaptchaSolver()
+    ml = create_solver(config)
     ml.load(config.captcha.model)
 
     service = Service(
-        storage=SqliteStorage(config.storage.url),
-        brokers={
-            "TAVANA": TavanaBroker(ml),
-        }
+        storage=create_storage(config),
+        brokers=create_brokers(config, ml)
     )
 
     try:
@@ -68,6 +291,8 @@ def account_balance(username: str):
         print(f'account balance is: {balance}IRR')
     except Exception as exc:
         print(exc)
+    finally:
+        service.storage.close()
 
 
 @cli.command('migrate')
@@ -79,8 +304,9 @@ def migrate(url: Optional[str] = None):
     if not url:
         url = config.storage.url
 
-    storage = SqliteStorage(url)
+    storage = create_storage(config, url)
     storage.migrate()
+    storage.close()
 
 
 @captcha_cli.command('train')
@@ -93,7 +319,7 @@ def captcha_train(training_dir: Optional[str] = None, model: Optional[str] = Non
     if not model:
         model = config.captcha.model
 
-    ml = CaptchaSolver()
+    ml = create_solver(config)
     ml.train_model(training_dir)
     ml.save(model)
 
@@ -101,47 +327,278 @@ def captcha_train(training_dir: Optional[str] = None, model: Optional[str] = Non
 @captcha_cli.command('predict')
 def captcha_predict(filepath: str):
     config = get_config()
-    ml = CaptchaSolver()
+    ml = create_solver(config)
     ml.load(config.captcha.model)
     with open(filepath, 'rb') as fd:
         print("Predicted:", ml.predict(fd))
     ml.save(config.captcha.model)
 
 
+@captcha_cli.command('bench')
+def captcha_bench(
+    training_dir: Optional[str] = None,
+    variant: Optional[List[str]] = typer.Option(
+        None, help=f"Variants to compare, repeatable, all by default: {', '.join(MODEL_VARIANTS)}"),
+    holdout: float = typer.Option(.2, help='Share of the images held out of training to measure accuracy on'),
+    epochs: int = 60,
+    samples: int = typer.Option(200, help='Timed single image predictions per variant'),
+    batch: int = typer.Option(32, help='Images per batched prediction'),
+    attempts: int = typer.Option(3, help='Captcha tries per login, for the login success rate'),
+    min_login_success: float = typer.Option(.99, help='Recommend the fastest variant with at least this success'),
+    models_dir: Optional[str] = typer.Option(None, help='Keep the trained weights of each variant here'),
+    output: Optional[str] = REPORT_OUTPUT,
+):
+    """ Train the model variants and compare their inference latency, size and accuracy """
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    config = get_config()
+    report = run_captcha_bench(CaptchaBenchConfig(
+        training_dir=training_dir or config.captcha.training_dir,
+        variants=variant or list(MODEL_VARIANTS),
+        holdout=holdout,
+        epochs=epochs,
+        samples=samples,
+        batch=batch,
+        attempts=attempts,
+        min_login_success=min_login_success,
+        models_dir=models_dir,
+    ))
+
+    write_report(report, output)
+
+
 @cli.command('serve')
-def serve():
+def serve(
+    workers: Optional[int] = typer.Option(None, help='Api processes, overrides server.workers'),
+    profile: Optional[str] = typer.Option(
+        None, help='Profile from startup and write collapsed stacks to this directory on shutdown'),
+    trace_memory: bool = typer.Option(False, help='With --profile, trace allocations from startup too'),
+):
     """ Serve APIs """
     os.environ['TF_CPP_MIN_VLOG_LEVEL'] = '0'
     os.environ['TF_CPP_MIN_LOG_LEVEL'] = '0'
     config = get_config()
+    if workers is not None:
+        config.server.workers = workers
+    if profile:
+        config.profiling.output_dir = profile
+        config.profiling.trace_memory = config.profiling.trace_memory or trace_memory
+    install_runtime(config.runtime)
 
     logging.basicConfig(
         format=config.logging.format,
         level=config.logging.level
     )
 
-    ml = CaptchaSolver()
-    ml.load(config.captcha.model)
-
-    app = create_server(
-        service=Service(
-            storage=SqliteStorage(config.storage.url),
-            brokers={
-                "TAVANA": TavanaBroker(ml),
-            }
-        )
-    )
+    logging.info(f"encoding JSON with {jsoncodec.use(config.server.json_backend)}")
     logging.info(f"server is running on http://{config.server.host}:{config.server.port}")
-    web.run_app(
-        app,
-        host=config.server.host,
-        port=config.server.port,
-        print=lambda _: None,
-        reuse_address=True
-    )
+    if config.server.workers > 1:
+        if config.storage.url.startswith('journal:'):
+            raise typer.BadParameter("journal storage lives in one process, it can't serve more than one worker")
+        run_cluster(config, create_service)
+    else:
+        web.run_app(
+            create_server(
+                service=create_service(config),
+                admin_token=config.server.admin_token,
+                profiling=config.profiling,
+            ),
+            host=config.server.host,
+            port=config.server.port,
+            print=lambda _: None,
+            reuse_address=True
+        )
     logging.info(f"server is shutting down")
 
 
+@cli.command('bench')
+def bench(
+    output: Optional[str] = REPORT_OUTPUT,
+    rounds: int = 5,
+    lead: float = typer.Option(2.0, help='Seconds between scheduling a round and its deadline'),
+    concurrency: List[int] = typer.Option([1, 10, 100], help='Orders sharing one deadline, repeatable'),
+    transport: List[str] = typer.Option(['plain', 'tls'], help='plain and/or tls, repeatable'),
+    latency: float = typer.Option(0.02, help='One way latency injected by the delay proxy in seconds, 0 disables it'),
+    jitter: float = typer.Option(0.005, help='Jitter injected by the delay proxy in seconds'),
+    fire_path_samples: int = 200,
+    loop: List[str] = COMPARE_LOOPS,
+):
+    """ Benchmark scheduling accuracy against local test servers """
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    config = get_config()
+
+    profiles = [NetworkProfile()]
+    if latency or jitter:
+        profiles.append(NetworkProfile(latency=latency, jitter=jitter))
+
+    reports = {}
+    for runtime in runtimes_to_compare(config, loop):
+        install_runtime(runtime)
+        reports[runtime.loop] = run_benchmarks(BenchConfig(
+            rounds=rounds,
+            lead=lead,
+            concurrency=concurrency,
+            transports=transport,  # type: ignore
+            profiles=profiles,
+            fire_path_samples=fire_path_samples,
+        ))
+    report = compare_reports(reports, 'runtimes')
+
+    write_report(report, output)
+
+
+@cli.command('loadtest')
+def loadtest(
+    output: Optional[str] = REPORT_OUTPUT,
+    duration: float = 30,
+    concurrency: int = 50,
+    mix: str = typer.Option('order:1,balance:10,stocks:10,accounts:1', help='Weight of each API call'),
+    accounts: int = 20,
+    lead: float = typer.Option(3.0, help='Seconds between scheduling an order and its deadline'),
+    simulator_latency: float = 0.01,
+    simulator_jitter: float = 0.002,
+    loop: List[str] = COMPARE_LOOPS,
+    json_backend: List[str] = typer.Option(
+        [], '--json', help='Compare these JSON codecs, orjson or stdlib, instead of server.json_backend, repeatable'),
+):
+    """ Load test one API server process backed by the broker simulator """
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    config = get_config()
+
+    weights = {}
+    for item in mix.split(','):
+        operation, weight = item.split(':')
+        weights[operation.strip()] = float(weight)
+
+    reports = {}
+    for runtime in runtimes_to_compare(config, loop):
+        install_runtime(runtime)
+        by_codec = {}
+        for backend in json_backend or [config.server.json_backend]:
+            by_codec[backend] = run_loadtest(LoadTestConfig(
+                duration=duration,
+                concurrency=concurrency,
+                mix=weights,  # type: ignore
+                accounts=accounts,
+                lead=lead,
+                simulator_latency=simulator_latency,
+                simulator_jitter=simulator_jitter,
+                json_backend=backend,  # type: ignore
+            ))
+        reports[runtime.loop] = compare_reports(by_codec, 'json')
+    report = compare_reports(reports, 'runtimes')
+
+    write_report(report, output)
+
+
+@cli.command('bench-storage')
+def bench_storage(
+    output: Optional[str] = REPORT_OUTPUT,
+    engine: List[str] = typer.Option(['sqlite', 'journal'], help='sqlite and/or journal, repeatable'),
+    orders: int = 2000,
+    accounts: int = 20,
+):
+    """ Benchmark the storage engines on the calls of the order hot path """
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    report = run_storage_bench(StorageBenchConfig(
+        engines=engine,  # type: ignore
+        orders=orders,
+        accounts=accounts,
+    ))
+
+    write_report(report, output)
+
+
+@cli.command('bench-pending')
+def bench_pending(
+    output: Optional[str] = REPORT_OUTPUT,
+    orders: int = 100_000,
+    accounts: int = 100,
+    representation: List[str] = typer.Option(['coroutines', 'compact'], help='coroutines and/or compact, repeatable'),
+):
+    """ Benchmark RSS and gc pauses of holding many scheduled orders """
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    report = run_pending_bench(PendingBenchConfig(
+        representations=representation,  # type: ignore
+        orders=orders,
+        accounts=accounts,
+    ))
+
+    write_report(report, output)
+
+
+@cli.command('bench-replay')
+def bench_replay(
+    archive: str,
+    output: Optional[str] = REPORT_OUTPUT,
+    time_scale: float = typer.Option(1.0, help='Multiplies the recorded timing, 0 replays as fast as possible'),
+    lead: float = typer.Option(3.0, help='Seconds before its recorded send time an order is scheduled'),
+    captcha_model: Optional[str] = typer.Option(None, help='Solve the recorded captchas with this model'),
+    captcha_variant: str = typer.Option('baseline', help='Architecture of --captcha-model'),
+):
+    """ Benchmark the broker code against a recorded session, the same one every run """
+    logging.basicConfig(format="%(message)s", level=logging.WARNING)
+    report = run_replay_bench(ReplayBenchConfig(
+        archive=archive,
+        time_scale=time_scale,
+        lead=lead,
+        captcha_model=captcha_model,
+        captcha_variant=captcha_variant,
+    ))
+
+    write_report(report, output)
+
+
+@cli.command('record')
+def record(
+    archive: str,
+    host: str = 'localhost',
+    port: int = 8092,
+    site_url: str = typer.Option(str(SITE_URL), help='Tavana web site the proxy forwards to'),
+    api_url: str = typer.Option(str(API_URL), help='Tavana API the proxy forwards API_PREFIX to'),
+):
+    """ Proxy the Tavana broker and record its traffic, point broker.tavana_url at it """
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    print(f"recording proxy is running on http://{host}:{port}, writing {archive} on exit")
+    run_recorder(host, port, archive, URL(site_url), URL(api_url))
+
+
+@cli.command('replay')
+def replay(
+    archive: str,
+    host: str = 'localhost',
+    port: int = 8092,
+    time_scale: float = typer.Option(1.0, help='Multiplies the recorded timing, 0 answers right away'),
+):
+    """ Serve a recorded broker session with its timing, point broker.tavana_url at it """
+    logging.basicConfig(format="%(message)s", level=logging.INFO)
+    summary = Archive(archive).summary()
+    print(f"replaying {summary['meta']['exchanges']} exchanges recorded {summary['meta']['started']} "
+          f"on http://{host}:{port}")
+    run_replay(host, port, archive, time_scale)
+
+
+@cli.command('simulator')
+def simulator(
+    host: str = 'localhost',
+    port: int = 8090,
+    distribution: str = typer.Option('constant', help='constant, uniform, normal or lognormal'),
+    latency: float = typer.Option(0.0, help='Mean one way latency in seconds'),
+    jitter: float = typer.Option(0.0, help='Latency spread in seconds'),
+    error_rate: float = typer.Option(0.0, help='Share of API calls answered with 503'),
+    login_failure_rate: float = typer.Option(0.0, help='Share of logins rejected as a misread captcha'),
+    seed: Optional[int] = None,
+):
+    """ Serve a local broker simulator for the FAKE broker """
+    config = SimulatorConfig(
+        latency=LatencyModel(distribution=distribution, mean=latency, jitter=jitter),  # type: ignore
+        error_rate=error_rate,
+        login_failure_rate=login_failure_rate,
+        seed=seed,
+    )
+    print(f"simulator is running on http://{host}:{port}")
+    run_simulator(host, port, config)
+
+
 @cli.command("config")
 def print_config():
     """ Print current config """
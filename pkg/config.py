@@ -1,17 +1,39 @@
 import json
 import logging
-from typing import Optional
+from typing import Dict, List, Literal, Optional
 
 import pydantic
 
+from pkg.internal.jsoncodec import JsonBackend
+
 
 class StorageConfig(pydantic.BaseSettings):
+    # sqlalchemy url, or journal:///data/journal for the in-memory journaled storage (one process only)
     url: str = 'sqlite+pysqlite:///data/sqlite.db'
+    # Journal writes are group committed this often, a crash loses at most the last interval
+    journal_commit_interval: float = .005
+    # Snapshot the state and start a new journal past this size or age
+    journal_compact_bytes: int = 64 * 1024 * 1024
+    journal_snapshot_interval: float = 3600
 
 
 class ServerConfig(pydantic.BaseSettings):
     host: str = 'localhost'
     port: int = 8080
+    # More than one runs that many api processes sharing the port plus a scheduler process
+    workers: int = 1
+    # The scheduler process only serves /metrics
+    scheduler_port: int = 8081
+    scheduler_poll_interval: float = .5
+    # Events a /ws client may fall behind by before its oldest ones are dropped
+    ws_queue_size: int = 256
+    # Seconds between balance and stats pushes to /ws clients
+    ws_balance_interval: float = 30
+    ws_stats_interval: float = 5
+    # Codec of API responses, auto picks orjson when it's installed
+    json_backend: JsonBackend = 'auto'
+    # Bearer token of the /admin endpoints, they're not served without one
+    admin_token: Optional[str] = None
 
 
 class LoggingConfig(pydantic.BaseSettings):
@@ -23,6 +45,76 @@ class LoggingConfig(pydantic.BaseSettings):
 class CaptchaConfig(pydantic.BaseSettings):
     model: str = './data/captcha-clf'
     training_dir: str = './data/captcha/training'
+    # Architecture of the model, one of captcha.MODEL_VARIANTS, `main.py captcha bench` compares them
+    variant: str = 'baseline'
+
+
+class BrokerConfig(pydantic.BaseSettings):
+    raw_sender: bool = False
+    # Url of a running `main.py simulator`, enables the FAKE broker
+    fake_url: Optional[str] = None
+    # Send the TAVANA broker's traffic to a `main.py record` proxy or a `main.py replay` server instead
+    tavana_url: Optional[str] = None
+    # Outbound calls per second and bucket size, per broker
+    rate_limit: float = 20
+    burst: float = 40
+    max_concurrency: int = 16
+    # Probe every address of the api host and connect the orders to the fastest one
+    pin_endpoints: bool = True
+    # Seconds resolved addresses are kept, and between probes of them while orders are pending
+    dns_ttl: float = 300
+    endpoint_reevaluate_interval: float = 60
+    # Fixed addresses per host instead of DNS, {"localhost": ["127.0.0.1:8091", "127.0.0.1:8092"]}
+    hosts: Dict[str, List[str]] = {}
+
+
+class LatencyProfileConfig(pydantic.BaseSettings):
+    enabled: bool = True
+    # Market time the minutes of the profile are counted in
+    timezone: str = 'Asia/Tehran'
+    # Trading days of history kept and used
+    days: int = 20
+    # Minutes either side of the deadline's minute looked at
+    window: int = 2
+    quantile: float = .5
+    # Days with data needed before predictions replace the live estimate
+    min_days: int = 3
+
+
+class CriticalWindowConfig(pydantic.BaseSettings):
+    # Seconds before and after an armed deadline during which non-essential work is deferred,
+    # and the brokers refuse probe and dashboard calls
+    before: float = 10
+    after: float = 2
+
+
+class MarketDataConfig(pydantic.BaseSettings):
+    # Seconds between price polls of one symbol, far from and right at a trigger price
+    max_interval: float = 2
+    min_interval: float = .05
+    # Relative distance to a trigger price under which polling speeds up
+    near: float = .02
+
+
+class RuntimeConfig(pydantic.BaseSettings):
+    # uvloop needs `pip install uvloop`
+    loop: Literal['asyncio', 'uvloop'] = 'asyncio'
+    # Threads of the default executor, None keeps asyncio's default
+    executor_workers: Optional[int] = None
+    # Seconds, timers due within it fire early in the current iteration. asyncio loop only
+    clock_resolution: Optional[float] = None
+    # Linux timer slack of the process, lower wakes sleeping timers closer to their deadline
+    timer_slack_ns: Optional[int] = None
+
+
+class ProfilingConfig(pydantic.BaseSettings):
+    # Profile every process from startup and write collapsed stacks here on shutdown, `serve --profile`
+    output_dir: Optional[str] = None
+    # Seconds between samples
+    interval: float = .01
+    # Trace allocations from startup too, keeping this many frames of each
+    trace_memory: bool = False
+    memory_frames: int = 16
 
 
 class MainConfig(pydantic.BaseSettings):
@@ -30,6 +122,12 @@ class MainConfig(pydantic.BaseSettings):
     server: ServerConfig = ServerConfig()
     logging: LoggingConfig = LoggingConfig()
     captcha: CaptchaConfig = CaptchaConfig()
+    broker: BrokerConfig = BrokerConfig()
+    critical_window: CriticalWindowConfig = CriticalWindowConfig()
+    runtime: RuntimeConfig = RuntimeConfig()
+    market_data: MarketDataConfig = MarketDataConfig()
+    latency_profile: LatencyProfileConfig = LatencyProfileConfig()
+    profiling: ProfilingConfig = ProfilingConfig()
 
 
 def get_config() -> MainConfig:
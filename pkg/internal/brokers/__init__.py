@@ -1,11 +1,21 @@
 from .tavana import TavanaBroker
+from .fake import FakeBroker
 from .abc import AbstractBroker, BrokerName
-from .exceptions import AuthenticationError, BrokerError
+from .exceptions import AuthenticationError, BrokerError, RateLimitedError
+from .ratelimit import RateLimiter
+from .prober import LatencyProber
+from .resolver import EndpointResolver, StaticResolver
 
 __all__ = [
     "AbstractBroker",
     "TavanaBroker",
+    "FakeBroker",
     "AuthenticationError",
     "BrokerName",
-    "BrokerError"
+    "BrokerError",
+    "RateLimitedError",
+    "RateLimiter",
+    "LatencyProber",
+    "EndpointResolver",
+    "StaticResolver",
 ]
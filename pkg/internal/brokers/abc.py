@@ -1,10 +1,15 @@
 import abc
+import asyncio
 import datetime
 import aiohttp
-from typing import Dict, Literal, Tuple
+from typing import Any, Dict, List, Literal, Optional, Sequence, Tuple, Union
+
+from pkg.internal.tracing import OrderTrace
 
 
 BrokerName = Literal["TAVANA", "FAKE"]
+# Cookies and headers of a logged in account
+Session = Tuple[aiohttp.CookieJar, Dict[str, str]]
 
 
 class AbstractBroker(abc.ABC):
@@ -25,6 +30,11 @@ class AbstractBroker(abc.ABC):
     async def get_stock(self, stock_name: str) -> Dict[str, str]:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    async def get_quote(self, isin: str) -> int:
+        """ Last traded price """
+        raise NotImplementedError
+
     @abc.abstractmethod
     async def login(
             self,
@@ -51,5 +61,42 @@ class AbstractBroker(abc.ABC):
         isin: str,
         price: int,
         count: int = 1,
+        trace: Optional[OrderTrace] = None,
     ):
         raise NotImplementedError
+
+    @abc.abstractmethod
+    async def fire_on(
+        self,
+        condition: asyncio.Future,
+        cookies: aiohttp.CookieJar,
+        headers: Dict[str, str],
+        isin: str,
+        price: int,
+        count: int = 1,
+        trace: Optional[OrderTrace] = None,
+        hold: float = 600,
+    ) -> Optional[Tuple[int, Any]]:
+        """ Send the order as soon as condition resolves.
+        Gives up and returns None after hold seconds, so the caller can refresh the session.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """ Release connections kept open between calls """
+
+    async def schedule_orders(
+        self,
+        sessions: Sequence[Session],
+        deadline: datetime.datetime,
+        isin: str,
+        price: int,
+        count: int = 1,
+        traces: Optional[Sequence[Optional[OrderTrace]]] = None,
+    ) -> List[Union[Tuple[int, Any], BaseException]]:
+        """ The same order for several accounts, result or exception of each in order """
+        traces = traces or [None] * len(sessions)
+        return await asyncio.gather(*(
+            self.schedule_order(cookies, headers, deadline, isin, price, count, trace)
+            for (cookies, headers), trace in zip(sessions, traces)
+        ), return_exceptions=True)
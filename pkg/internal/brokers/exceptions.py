@@ -4,3 +4,7 @@ class BrokerError(Exception):
 
 class AuthenticationError(BrokerError):
     ...
+
+
+class RateLimitedError(BrokerError):
+    """ The call was shed by the broker's rate limiter """
@@ -0,0 +1,47 @@
+from typing import Dict, Optional
+
+import aiohttp
+from yarl import URL
+
+from pkg.internal.brokers.ratelimit import RateLimiter
+from pkg.internal.brokers.resolver import EndpointResolver
+from pkg.internal.brokers.simulator import API_PREFIX, CAPTCHA_ANSWER_HEADER
+from pkg.internal.brokers.tavana import TavanaBroker
+from pkg.internal.captcha import CaptchaSolver
+from pkg.internal.latencyprofile import LatencyProfile
+
+
+class FakeBroker(TavanaBroker):
+    """ TavanaBroker talking to the local simulator (see simulator.py).
+    Everything but the urls goes through the real broker code path.
+    Without a captcha model it reads the answer the simulator sends along with the image.
+    Use a host name in url, aiohttp's cookie jar ignores cookies set by IP addresses.
+    """
+
+    def __init__(
+            self,
+            url: str = 'http://localhost:8090/',
+            captcha_ml: Optional[CaptchaSolver] = None,
+            raw_sender: bool = False,
+            limiter: Optional[RateLimiter] = None,
+            latency_profile: Optional[LatencyProfile] = None,
+            resolver: Optional[EndpointResolver] = None,
+    ):
+        base_url = URL(url)
+        super().__init__(
+            captcha_ml,
+            raw_sender=raw_sender,
+            base_url=base_url,
+            base_api_url=base_url.with_path(API_PREFIX + '/'),
+            limiter=limiter or RateLimiter("FAKE"),
+            latency_profile=latency_profile,
+            resolver=resolver,
+        )
+        self.name = "FAKE"
+
+    async def _get_captcha(self, cookies: aiohttp.CookieJar, headers: Dict[str, str]) -> str:
+        if self.captcha_detector:
+            return await super()._get_captcha(cookies, headers)
+
+        _, captcha_headers = await self._download_captcha(cookies, headers)
+        return captcha_headers[CAPTCHA_ANSWER_HEADER]
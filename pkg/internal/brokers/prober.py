@@ -0,0 +1,226 @@
+import asyncio
+import bisect
+import collections
+import datetime
+import logging
+import math
+import ssl
+import time
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp.abc import AbstractResolver
+from yarl import URL
+
+from pkg.internal.brokers.exceptions import RateLimitedError
+from pkg.internal.brokers.ratelimit import RateLimiter
+from pkg.internal.metrics import BROKER_REQUEST_SECONDS, LATENCY_PROBES
+
+logger = logging.getLogger('myapp')
+
+
+class LatencyProber:
+    """ One-way latency estimate of a broker host, shared by every order scheduled on it.
+
+    Probes go over a single kept-alive connection, so they measure the round trip of a request
+    rather than DNS, TCP and TLS handshakes; a sample that had to open a new connection is dropped.
+    The estimate is the minimum of the last `window` samples. Sampling speeds up as the closest
+    deadline gets near, one probe every tenth of the time left within [min_interval, max_interval],
+    and goes on until `stop_before` seconds before it, when the rate limiter starts shedding probes.
+    An order gets its estimate early if it's held steady (within `tolerance`) for `window` samples
+    in the last `settle_within` seconds.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            url: URL,
+            limiter: RateLimiter,
+            on_sample: Optional[Callable[[float], None]] = None,
+            min_interval: float = .25,
+            max_interval: float = 30,
+            stop_before: Optional[float] = None,
+            window: int = 5,
+            tolerance: float = .05,
+            settle_within: float = 60,
+            resolver: Optional[AbstractResolver] = None,
+            ssl_context: Optional[ssl.SSLContext] = None,
+    ) -> None:
+        """ resolver and ssl_context: the ones the orders connect with, so the probes measure the same
+        address and their handshakes leave a TLS session behind for the orders to resume
+        """
+        self.name = name
+        self.url = url
+        self.limiter = limiter
+        self.on_sample = on_sample
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.stop_before = limiter.window.before if stop_before is None else stop_before
+        self.window = window
+        self.tolerance = tolerance
+        self.settle_within = settle_within
+        self.resolver = resolver
+        self.ssl_context = ssl_context
+
+        self.samples: Deque[float] = collections.deque(maxlen=window)
+        self.sampled_at = 0.0
+        self.estimates: Deque[float] = collections.deque(maxlen=window)
+        # Sorted (time.time() to stop sampling for, sequence, waiting order)
+        self.waiters: List[Tuple[float, int, asyncio.Future]] = []
+        self.sequence = 0
+        self.headers: Dict[str, str] = {}
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.task: Optional[asyncio.Task] = None
+        self.changed: Optional[asyncio.Event] = None
+        self.connected = False
+
+    @property
+    def estimate(self) -> Optional[float]:
+        return min(self.samples) if self.samples else None
+
+    def is_stable(self) -> bool:
+        if len(self.estimates) < self.window:
+            return False
+        return max(self.estimates) - min(self.estimates) <= self.tolerance * self.estimates[-1]
+
+    async def wait_for_estimate(
+            self,
+            deadline: datetime.datetime,
+            headers: Optional[Dict[str, str]] = None,
+    ) -> Optional[float]:
+        """ Keep sampling for deadline, returns the estimate once it's final, None without any sample """
+        if headers:
+            self.headers = headers
+        stop_at = deadline.replace(tzinfo=datetime.timezone.utc).timestamp() - self.stop_before
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        bisect.insort(self.waiters, (stop_at, self.sequence, future))
+
+        if self.changed is None:
+            self.changed = asyncio.Event()
+        self.changed.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.__run())
+
+        try:
+            # Bounded in case sampling stalls, the order falls back to the latency profile then
+            await asyncio.wait_for(future, max(stop_at - time.time(), 0))
+        except asyncio.TimeoutError:
+            logger.warning(f"latency prober of {self.name} didn't release an order in time")
+        finally:
+            if not future.done() or future.cancelled():
+                self.waiters = [waiter for waiter in self.waiters if waiter[2] is not future]
+        return self.estimate
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.session:
+            await self.session.close()
+            self.session = None
+
+    def __release(self, until: float):
+        while self.waiters and self.waiters[0][0] <= until:
+            _, _, future = self.waiters.pop(0)
+            if not future.done():
+                future.set_result(None)
+
+    def interval(self, now: Optional[float] = None) -> float:
+        if not self.waiters:
+            return self.max_interval
+        time_left = self.waiters[0][0] - (now or time.time())
+        return min(self.max_interval, max(self.min_interval, time_left / 10))
+
+    async def __run(self):
+        assert self.changed
+        # Samples left from an earlier order tell nothing about the network now
+        if time.time() - self.sampled_at > 2 * self.max_interval:
+            self.samples.clear()
+            self.estimates.clear()
+        try:
+            while self.waiters:
+                now = time.time()
+                self.__release(now)
+                if self.is_stable():
+                    self.__release(now + self.settle_within)
+                if not self.waiters:
+                    break
+
+                await self.__sample()
+
+                now = time.time()
+                self.changed.clear()
+                timeout = min(self.interval(now), max(self.waiters[0][0] - now, 0)) if self.waiters else 0
+                try:
+                    await asyncio.wait_for(self.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        except asyncio.CancelledError:
+            self.__release(math.inf)
+            raise
+        except Exception:
+            # The waiting orders go on with whatever estimate there is rather than hang
+            logger.exception(f"latency prober of {self.name} failed")
+            self.__release(math.inf)
+        finally:
+            # Nobody to sample for, don't keep the connection open until the next order
+            if self.session and not self.waiters:
+                await self.session.close()
+                self.session = None
+
+    def __get_session(self) -> aiohttp.ClientSession:
+        if self.session is None:
+            trace_config = aiohttp.TraceConfig()
+
+            async def on_connection_create_end(session, context, params):
+                self.connected = True
+
+            trace_config.on_connection_create_end.append(on_connection_create_end)
+            self.session = aiohttp.ClientSession(
+                # One connection, kept open between samples at the slowest rate
+                connector=aiohttp.TCPConnector(
+                    limit=1,
+                    keepalive_timeout=self.max_interval + 5,
+                    resolver=self.resolver,
+                    ssl=self.ssl_context,
+                ),
+                trace_configs=[trace_config],
+            )
+        return self.session
+
+    async def __sample(self):
+        session = self.__get_session()
+        self.connected = False
+        try:
+            async with self.limiter.acquire("probe"):
+                started = time.perf_counter()
+                async with session.get(self.url, headers=self.headers, allow_redirects=False) as response:
+                    round_trip = time.perf_counter() - started
+                    # The connection goes back to the pool only once the body is consumed
+                    await response.read()
+        except RateLimitedError:
+            LATENCY_PROBES.labels(self.name, 'shed').inc()
+            return
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            LATENCY_PROBES.labels(self.name, 'error').inc()
+            logger.warning(f"latency probe to {self.url} failed", exc_info=True)
+            return
+
+        if self.connected:
+            LATENCY_PROBES.labels(self.name, 'handshake').inc()
+            return
+        LATENCY_PROBES.labels(self.name, 'reused').inc()
+        BROKER_REQUEST_SECONDS.labels(self.name, 'probe').observe(round_trip)
+
+        latency = round_trip * .5
+        self.samples.append(latency)
+        self.sampled_at = time.time()
+        self.estimates.append(self.estimate)  # type: ignore
+        if self.on_sample:
+            self.on_sample(latency)
+        logger.debug(f"got latency: {latency}, estimate {self.estimate}")
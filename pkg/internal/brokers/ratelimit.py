@@ -0,0 +1,122 @@
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+from typing import AsyncIterator, Dict, List, Literal, Optional, Tuple
+
+from pkg.internal.brokers.exceptions import RateLimitedError
+from pkg.internal.critical import CriticalWindow
+from pkg.internal.looplag import LoopLagMonitor
+from pkg.internal.metrics import RATE_LIMIT_WAIT_SECONDS, SHED_REQUESTS
+
+# From the most to the least important. Quote polls feed price triggered orders, so they come right after them
+Priority = Literal["order", "quote", "login", "probe", "dashboard"]
+PRIORITIES: Dict[Priority, int] = {"order": 0, "quote": 1, "login": 2, "probe": 3, "dashboard": 4}
+# Refused outright while an order deadline is near
+SHEDDABLE = {"probe", "dashboard"}
+
+
+class RateLimiter:
+    """ Token bucket plus a cap on in-flight calls, shared by every outbound call to one broker.
+    Waiting calls are admitted by priority, then in arrival order. Orders are never held back,
+    they take their token even if that leaves the bucket in debt. Probe and dashboard calls are
+    refused with RateLimitedError while the critical window of an armed deadline is open.
+    """
+
+    def __init__(
+            self,
+            name: str = '',
+            rate: float = 5,
+            burst: float = 10,
+            max_concurrency: int = 8,
+            window: Optional[CriticalWindow] = None,
+    ) -> None:
+        """ window: where the order deadlines are armed, the service's one so both see every deadline """
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.window = window or CriticalWindow(LoopLagMonitor())
+
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+        self.in_flight = 0
+        self.waiters: List[Tuple[int, int, Priority, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.refill_handle: Optional[asyncio.TimerHandle] = None
+
+    @contextlib.asynccontextmanager
+    async def acquire(self, priority: Priority) -> AsyncIterator[None]:
+        if priority == "order":
+            self.__refill()
+            self.__take()
+        else:
+            await self.__wait(priority)
+
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.__dispatch()
+
+    async def __wait(self, priority: Priority):
+        if priority in SHEDDABLE and self.window.is_active():
+            SHED_REQUESTS.labels(self.name, priority).inc()
+            raise RateLimitedError(f'{priority} call shed, an order deadline is near')
+
+        started = time.perf_counter()
+        self.__refill()
+        if not self.waiters and self.__has_capacity():
+            self.__take()
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiters, (PRIORITIES[priority], next(self.sequence), priority, future))
+            self.__dispatch()
+            try:
+                await future
+            except asyncio.CancelledError:
+                # Admitted right before the cancellation, give the slot back
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    self.in_flight -= 1
+                    self.__dispatch()
+                raise
+        RATE_LIMIT_WAIT_SECONDS.labels(self.name, priority).observe(time.perf_counter() - started)
+
+    def __refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def __has_capacity(self) -> bool:
+        return self.tokens >= 1 and self.in_flight < self.max_concurrency
+
+    def __take(self):
+        self.tokens -= 1
+        self.in_flight += 1
+
+    def __dispatch(self):
+        self.__refill()
+        while self.waiters:
+            _, _, priority, future = self.waiters[0]
+            if future.done():
+                heapq.heappop(self.waiters)
+            elif priority in SHEDDABLE and self.window.is_active():
+                heapq.heappop(self.waiters)
+                SHED_REQUESTS.labels(self.name, priority).inc()
+                future.set_exception(RateLimitedError(f'{priority} call shed, an order deadline is near'))
+            elif self.__has_capacity():
+                heapq.heappop(self.waiters)
+                self.__take()
+                future.set_result(None)
+            else:
+                break
+
+        # Out of tokens rather than slots, a finishing call won't wake the waiters up
+        if self.waiters and self.tokens < 1 and self.refill_handle is None:
+            self.refill_handle = asyncio.get_running_loop().call_later(
+                (1 - self.tokens) / self.rate, self.__on_refill)
+
+    def __on_refill(self):
+        self.refill_handle = None
+        self.__dispatch()
@@ -0,0 +1,299 @@
+""" Record the HTTP traffic of the Tavana broker through a local proxy and serve it back with its timing.
+
+Both listen with the simulator's layout, the web site at / and its API at API_PREFIX, so the TAVANA
+broker pointed at them with broker.tavana_url (or FakeBroker) works unchanged.
+"""
+import asyncio
+import collections
+import dataclasses
+import datetime
+import hashlib
+import json
+import logging
+import re
+import time
+import zipfile
+from dataclasses import dataclass, field
+from typing import Any, Counter, Deque, Dict, List, Optional, Tuple
+
+import aiohttp
+from aiohttp import web
+from multidict import CIMultiDict
+from yarl import URL
+
+from pkg.internal.brokers.simulator import API_PREFIX, CAPTCHA_ANSWER_HEADER, CAPTCHA_PATH
+
+logger = logging.getLogger('myapp')
+
+ARCHIVE_VERSION = 1
+SITE_URL = URL('https://onlinetavana.ir/')
+API_URL = URL('https://api.onlinetavana.ir/Web/V1/')
+# Connection level or describing the encoded body, aiohttp sets them for the bodies it sends
+HOP_HEADERS = {
+    'connection', 'content-encoding', 'content-length', 'host', 'keep-alive', 'proxy-connection',
+    'te', 'trailer', 'transfer-encoding', 'upgrade',
+}
+# Secrets of the recorded accounts are left out of the archive
+SECRET_HEADERS = {'authorization', 'cookie'}
+# The login form carries the password
+UNRECORDED_BODIES = {'/login'}
+# The cookies of the broker's domain have to stick to the proxy's host, over plain http
+_COOKIE_ATTRIBUTES = re.compile(r';\s*(domain=[^;]*|secure)(?=;|$)', re.IGNORECASE)
+
+
+@dataclass
+class Exchange:
+    """ One request to the broker and its response, times in seconds """
+    # Since the recording started, when the request went out
+    at: float
+    method: str
+    # Path and query as sent to the proxy
+    path: str
+    status: int
+    # From sending the request to the response headers, and to the end of the body
+    first_byte: float
+    completed: float
+    request_headers: Dict[str, str] = field(default_factory=dict)
+    # Pairs, Set-Cookie repeats
+    response_headers: List[Tuple[str, str]] = field(default_factory=list)
+    # Blob ids, None for an empty or unrecorded body
+    request_body: Optional[str] = None
+    response_body: Optional[str] = None
+    # Set when the broker couldn't be reached, status is 502 then
+    error: Optional[str] = None
+
+
+class ArchiveWriter:
+    """ A zip of the exchanges as JSON lines plus their bodies as blobs, each stored once.
+    The exchanges are written on close, an archive that wasn't closed can't be read.
+    """
+
+    def __init__(self, path: str, meta: Optional[Dict[str, Any]] = None) -> None:
+        self.zip = zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED)
+        self.meta = {
+            'version': ARCHIVE_VERSION,
+            'started': datetime.datetime.utcnow().isoformat(),
+            **(meta or {}),
+        }
+        self.blobs: set = set()
+        self.exchanges: List[Exchange] = []
+
+    def blob(self, data: bytes, content_type: str = '') -> Optional[str]:
+        if not data:
+            return None
+        key = hashlib.sha1(data).hexdigest()
+        if key not in self.blobs:
+            self.blobs.add(key)
+            # Images are compressed already, captcha images come in by the thousand
+            compression = zipfile.ZIP_STORED if content_type.startswith('image/') else zipfile.ZIP_DEFLATED
+            self.zip.writestr(f'blobs/{key}', data, compress_type=compression)
+        return key
+
+    def add(self, exchange: Exchange):
+        self.exchanges.append(exchange)
+
+    def close(self):
+        self.zip.writestr('meta.json', json.dumps({**self.meta, 'exchanges': len(self.exchanges)}))
+        self.zip.writestr('exchanges.jsonl', ''.join(
+            json.dumps(dataclasses.asdict(exchange)) + '\n' for exchange in self.exchanges))
+        self.zip.close()
+
+
+class Archive:
+    def __init__(self, path: str) -> None:
+        self.zip = zipfile.ZipFile(path)
+        self.meta: Dict[str, Any] = json.loads(self.zip.read('meta.json'))
+        if self.meta['version'] != ARCHIVE_VERSION:
+            raise ValueError(f"archive version {self.meta['version']} is not supported")
+        self.exchanges = list(map(self.__exchange, self.zip.read('exchanges.jsonl').decode().splitlines()))
+        self.blobs: Dict[str, bytes] = {}
+
+    @staticmethod
+    def __exchange(line: str) -> Exchange:
+        data = json.loads(line)
+        data['response_headers'] = [tuple(pair) for pair in data['response_headers']]
+        return Exchange(**data)
+
+    def blob(self, key: Optional[str]) -> bytes:
+        if key is None:
+            return b''
+        data = self.blobs.get(key)
+        if data is None:
+            data = self.blobs[key] = self.zip.read(f'blobs/{key}')
+        return data
+
+    def summary(self) -> Dict[str, Any]:
+        """ Exchanges and median first byte time per method and path """
+        times: Dict[str, List[float]] = collections.defaultdict(list)
+        for exchange in self.exchanges:
+            times[f'{exchange.method} {URL(exchange.path).path}'].append(exchange.first_byte)
+        return {
+            'meta': self.meta,
+            'duration': max((exchange.at for exchange in self.exchanges), default=0),
+            'paths': {
+                path: {'count': len(samples), 'first_byte_p50': sorted(samples)[len(samples) // 2]}
+                for path, samples in sorted(times.items())
+            },
+        }
+
+
+class RecordingProxy:
+    """ Forwards every request to the broker and records it, with its timing, into writer """
+
+    def __init__(self, writer: ArchiveWriter, site_url: URL = SITE_URL, api_url: URL = API_URL) -> None:
+        self.writer = writer
+        self.site_url = site_url
+        self.api_url = api_url
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.started = time.perf_counter()
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        app.on_startup.append(self.__start)
+        app.on_cleanup.append(self.__stop)
+        return app
+
+    def upstream_url(self, path_qs: str) -> URL:
+        if path_qs == API_PREFIX or path_qs.startswith((API_PREFIX + '/', API_PREFIX + '?')):
+            return self.api_url.join(URL(path_qs[len(API_PREFIX):].lstrip('/')))
+        return self.site_url.join(URL(path_qs.lstrip('/')))
+
+    def rewrite(self, name: str, value: str) -> str:
+        if name.lower() == 'set-cookie':
+            return _COOKIE_ATTRIBUTES.sub('', value)
+        if name.lower() == 'location':
+            # Redirects have to come back through the proxy
+            if value.startswith(str(self.api_url)):
+                return API_PREFIX + '/' + value[len(str(self.api_url)):]
+            if value.startswith(str(self.site_url)):
+                return '/' + value[len(str(self.site_url)):]
+        return value
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await request.read()
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_HEADERS}
+
+        started = time.perf_counter()
+        error = None
+        try:
+            async with self.session.request(  # type: ignore
+                request.method,
+                self.upstream_url(request.path_qs),
+                headers=headers,
+                data=body or None,
+                allow_redirects=False,
+            ) as upstream:
+                first_byte = time.perf_counter() - started
+                payload = await upstream.read()
+                completed = time.perf_counter() - started
+                status = upstream.status
+                response_headers = [
+                    (name, self.rewrite(name, value))
+                    for name, value in upstream.headers.items()
+                    if name.lower() not in HOP_HEADERS
+                ]
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            logger.warning(f"recording proxy can't reach the broker for {request.path}: {exc!r}")
+            first_byte = completed = time.perf_counter() - started
+            status, payload, response_headers, error = 502, b'', [], repr(exc)
+
+        self.writer.add(Exchange(
+            at=started - self.started,
+            method=request.method,
+            path=request.path_qs,
+            status=status,
+            first_byte=first_byte,
+            completed=completed,
+            request_headers={name: value for name, value in headers.items() if name.lower() not in SECRET_HEADERS},
+            response_headers=response_headers,
+            request_body=None if request.path in UNRECORDED_BODIES else self.writer.blob(body),
+            response_body=self.writer.blob(payload, dict(response_headers).get('Content-Type', '')),
+            error=error,
+        ))
+        return web.Response(status=status, body=payload, headers=CIMultiDict(response_headers))
+
+    async def __start(self, app: web.Application):
+        self.session = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar())
+        self.started = time.perf_counter()
+
+    async def __stop(self, app: web.Application):
+        await self.session.close()  # type: ignore
+        self.writer.close()
+        logger.info(f"recorded {len(self.writer.exchanges)} exchanges")
+
+
+class ReplayServer:
+    """ Answers every request with the next recorded response to the same method and path, after
+    the recorded time to first byte and to completion, times time_scale.
+
+    Requests to a path are answered with its recordings in order, starting over once they run out.
+    A path never recorded falls back to the recordings of the same path with any query. Captcha
+    responses get an answer header so FakeBroker logs in without a model, any answer gets the
+    recorded login response.
+    """
+
+    def __init__(self, archive: Archive, time_scale: float = 1) -> None:
+        self.archive = archive
+        self.time_scale = time_scale
+        self.exact: Dict[Tuple[str, str], Deque[Exchange]] = collections.defaultdict(collections.deque)
+        self.by_path: Dict[Tuple[str, str], Deque[Exchange]] = collections.defaultdict(collections.deque)
+        for exchange in archive.exchanges:
+            self.exact[(exchange.method, exchange.path)].append(exchange)
+            self.by_path[(exchange.method, URL(exchange.path).path)].append(exchange)
+        self.misses: Counter[str] = collections.Counter()
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/_replay/misses', self.misses_handler)
+        app.router.add_route('*', '/{tail:.*}', self.handle)
+        return app
+
+    def next(self, method: str, path_qs: str) -> Optional[Exchange]:
+        recorded = self.exact.get((method, path_qs)) or self.by_path.get((method, URL(path_qs).path))
+        if not recorded:
+            return None
+        exchange = recorded.popleft()
+        recorded.append(exchange)
+        return exchange
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        await request.read()
+        exchange = self.next(request.method, request.path_qs)
+        if exchange is None:
+            self.misses[f'{request.method} {request.path}'] += 1
+            raise web.HTTPNotFound(reason='not recorded')
+
+        await asyncio.sleep(exchange.first_byte * self.time_scale)
+        response = web.StreamResponse(status=exchange.status, headers=CIMultiDict(exchange.response_headers))
+        if request.path == CAPTCHA_PATH and CAPTCHA_ANSWER_HEADER not in response.headers:
+            response.headers[CAPTCHA_ANSWER_HEADER] = '0000'
+        body = self.archive.blob(exchange.response_body)
+        response.content_length = len(body)
+        await response.prepare(request)
+        await asyncio.sleep((exchange.completed - exchange.first_byte) * self.time_scale)
+        await response.write(body)
+        await response.write_eof()
+        return response
+
+    async def misses_handler(self, request: web.Request):
+        return web.json_response(self.misses)
+
+
+def run_recorder(host: str, port: int, path: str, site_url: URL = SITE_URL, api_url: URL = API_URL):
+    writer = ArchiveWriter(path, {'site_url': str(site_url), 'api_url': str(api_url)})
+    web.run_app(
+        RecordingProxy(writer, site_url, api_url).create_app(),
+        host=host,
+        port=port,
+        print=lambda _: None,
+    )
+
+
+def run_replay(host: str, port: int, path: str, time_scale: float = 1):
+    web.run_app(
+        ReplayServer(Archive(path), time_scale).create_app(),
+        host=host,
+        port=port,
+        print=lambda _: None,
+    )
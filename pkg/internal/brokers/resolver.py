@@ -0,0 +1,286 @@
+import asyncio
+import contextlib
+import logging
+import socket
+import ssl
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from aiohttp.abc import AbstractResolver
+from aiohttp.resolver import DefaultResolver
+from yarl import URL
+
+from pkg.internal.brokers.exceptions import RateLimitedError
+from pkg.internal.brokers.ratelimit import RateLimiter
+from pkg.internal.metrics import ENDPOINT_PROBE_SECONDS
+
+logger = logging.getLogger('myapp')
+
+
+class StaticResolver(AbstractResolver):
+    """ Resolves hosts from a fixed mapping to (address, port) pairs, ports may differ per address.
+    Points a broker host at several local listeners, hosts it doesn't know go to fallback.
+    """
+
+    def __init__(
+            self,
+            hosts: Dict[str, Sequence[Tuple[str, int]]],
+            fallback: Optional[AbstractResolver] = None,
+    ) -> None:
+        self.hosts = hosts
+        self.fallback = fallback
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict[str, Any]]:
+        if host not in self.hosts:
+            if self.fallback is None:
+                raise OSError(f'{host} is not in the static hosts')
+            return await self.fallback.resolve(host, port, family)
+        return [
+            {
+                'hostname': host,
+                'host': address,
+                'port': address_port,
+                'family': socket.AF_INET6 if ':' in address else socket.AF_INET,
+                'proto': 0,
+                'flags': socket.AI_NUMERICHOST,
+            }
+            for address, address_port in self.hosts[host]
+        ]
+
+    async def close(self) -> None:
+        if self.fallback:
+            await self.fallback.close()
+
+
+def parse_hosts(hosts: Dict[str, List[str]]) -> Dict[str, List[Tuple[str, int]]]:
+    """ {'api.example.com': ['127.0.0.1:8091', ...]} as StaticResolver takes it """
+    parsed: Dict[str, List[Tuple[str, int]]] = {}
+    for host, addresses in hosts.items():
+        for address in addresses:
+            ip, _, port = address.rpartition(':')
+            parsed.setdefault(host, []).append((ip.strip('[]'), int(port)))
+    return parsed
+
+
+@dataclass
+class Endpoint:
+    """ One address of a host, with the best times of its last probe in seconds """
+    info: Dict[str, Any]
+    # TCP connect, one round trip
+    connect: Optional[float] = None
+    # TLS handshake on top of it, zero for plain http
+    handshake: Optional[float] = None
+
+    @property
+    def address(self) -> str:
+        return f"{self.info['host']}:{self.info['port']}"
+
+    @property
+    def cost(self) -> float:
+        """ Time to a ready connection, unreachable and unprobed endpoints last """
+        if self.connect is None:
+            return float('inf')
+        return self.connect + (self.handshake or 0)
+
+
+@dataclass
+class _Host:
+    endpoints: List[Endpoint]
+    resolved_at: float
+    ssl_context: Optional[ssl.SSLContext] = None
+    probed_at: float = 0
+    family: int = socket.AF_INET
+
+
+class EndpointResolver(AbstractResolver):
+    """ Resolver of the order connections of one broker, fastest address first.
+
+    Hosts are resolved ahead of time by warm() and kept for `ttl` seconds. Every address is probed
+    `probe_count` times for its TCP connect and TLS handshake time, and the one with the quickest
+    connection is handed out first, so aiohttp and RawRequest connect to it and only move on to
+    the others if it fails. Hosts watched by a pending order are resolved and probed again every
+    `reevaluate_interval`, except while the limiter sheds calls around a deadline: connections are
+    being opened then. Each probe connection takes a "probe" slot of the limiter.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            limiter: Optional[RateLimiter] = None,
+            resolver: Optional[AbstractResolver] = None,
+            ttl: float = 300,
+            reevaluate_interval: float = 60,
+            probe_count: int = 3,
+            probe_timeout: float = 2,
+    ) -> None:
+        self.name = name
+        self.limiter = limiter
+        self.resolver = resolver or DefaultResolver()
+        self.ttl = ttl
+        self.reevaluate_interval = reevaluate_interval
+        self.probe_count = probe_count
+        self.probe_timeout = probe_timeout
+        self.hosts: Dict[Tuple[str, int], _Host] = {}
+        # Pending orders watching each host, it's re-evaluated as long as there are any
+        self.watchers: Dict[Tuple[str, int], int] = {}
+        self.warming = asyncio.Lock()
+        self.task: Optional[asyncio.Task] = None
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict[str, Any]]:
+        entry = self.hosts.get((host, port))
+        if entry is None or time.monotonic() - entry.resolved_at > self.ttl:
+            entry = await self.__resolve(host, port, family)
+        return [endpoint.info for endpoint in entry.endpoints]
+
+    def fastest(self, host: str, port: int) -> Optional[Endpoint]:
+        entry = self.hosts.get((host, port))
+        return entry.endpoints[0] if entry and entry.endpoints else None
+
+    @staticmethod
+    def _key(url: URL) -> Tuple[str, int]:
+        return url.raw_host, url.port or (443 if url.scheme == 'https' else 80)  # type: ignore
+
+    async def warm(self, url: URL, ssl_context: Optional[ssl.SSLContext] = None):
+        """ Resolve and probe url's host now unless done within reevaluate_interval,
+        keep it fresh until a release() for every warm()
+        """
+        key = self._key(url)
+        self.watchers[key] = self.watchers.get(key, 0) + 1
+        if self.task is None:
+            self.task = asyncio.create_task(self.__reevaluate_loop())
+
+        port = key[1]
+        if url.scheme == 'https' and ssl_context is None:
+            ssl_context = ssl.create_default_context()
+        # Orders armed together probe once
+        async with self.warming:
+            entry = self.hosts.get((url.raw_host, port))  # type: ignore
+            if entry is None or time.monotonic() - entry.probed_at > self.reevaluate_interval:
+                entry = await self.__resolve(url.raw_host, port)  # type: ignore
+                entry.ssl_context = ssl_context
+                await self.__probe(url.raw_host, entry)  # type: ignore
+
+    def release(self, url: URL):
+        """ The order that warmed url is done, re-evaluating stops once no order is left """
+        key = self._key(url)
+        left = self.watchers.get(key, 0) - 1
+        if left > 0:
+            self.watchers[key] = left
+        else:
+            self.watchers.pop(key, None)
+        if not self.watchers and self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def reevaluate(self):
+        """ Resolve the expired watched hosts again and probe every watched one """
+        for (host, port), entry in list(self.hosts.items()):
+            if (host, port) not in self.watchers:
+                continue
+            if time.monotonic() - entry.resolved_at > self.ttl:
+                entry = await self.__resolve(host, port, entry.family)
+            await self.__probe(host, entry)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        await self.resolver.close()
+
+    async def __resolve(self, host: str, port: int, family: int = socket.AF_INET) -> _Host:
+        infos = await self.resolver.resolve(host, port, family)
+        previous = self.hosts.get((host, port))
+        known = {endpoint.address: endpoint for endpoint in previous.endpoints} if previous else {}
+        endpoints = []
+        for info in infos:
+            endpoint = Endpoint(info)
+            # Addresses still listed keep their times until the next probe
+            if endpoint.address in known:
+                endpoint.connect = known[endpoint.address].connect
+                endpoint.handshake = known[endpoint.address].handshake
+            endpoints.append(endpoint)
+        endpoints.sort(key=lambda endpoint: endpoint.cost)
+
+        entry = _Host(endpoints, time.monotonic(), family=family)
+        if previous:
+            entry.ssl_context = previous.ssl_context
+            entry.probed_at = previous.probed_at
+        self.hosts[(host, port)] = entry
+        return entry
+
+    async def __probe(self, host: str, entry: _Host):
+        await asyncio.gather(*(self.__probe_endpoint(host, endpoint, entry.ssl_context) for endpoint in entry.endpoints))
+        entry.endpoints.sort(key=lambda endpoint: endpoint.cost)
+        entry.probed_at = time.monotonic()
+        fastest = entry.endpoints[0] if entry.endpoints else None
+        if fastest and fastest.connect is not None:
+            logger.info(
+                f"{self.name} pinned to {fastest.address} of {len(entry.endpoints)} addresses of {host}, "
+                f"connect {fastest.connect * 1000:.1f}ms handshake {(fastest.handshake or 0) * 1000:.1f}ms")
+        else:
+            logger.warning(f"no address of {host} answered the probes")
+
+    @contextlib.asynccontextmanager
+    async def __slot(self):
+        async with contextlib.AsyncExitStack() as stack:
+            if self.limiter:
+                await stack.enter_async_context(self.limiter.acquire("probe"))
+            yield
+
+    async def __probe_endpoint(self, host: str, endpoint: Endpoint, ssl_context: Optional[ssl.SSLContext]):
+        try:
+            best = await self.__time_endpoint(host, endpoint, ssl_context)
+        except RateLimitedError:
+            # A deadline came near, the last probe's times stand
+            logger.debug(f"probing {endpoint.address} of {host} shed")
+            return
+        endpoint.connect, endpoint.handshake = best if best else (None, None)
+
+    async def __time_endpoint(
+            self, host: str, endpoint: Endpoint, ssl_context: Optional[ssl.SSLContext]) -> Optional[Tuple[float, float]]:
+        """ Best (connect, handshake) seconds of probe_count connections, None if none connected """
+        loop = asyncio.get_running_loop()
+        best: Optional[Tuple[float, float]] = None
+        for _ in range(self.probe_count):
+            transport = None
+            try:
+                async with self.__slot():
+                    started = time.perf_counter()
+                    transport, protocol = await asyncio.wait_for(
+                        loop.create_connection(asyncio.Protocol, endpoint.info['host'], endpoint.info['port']),
+                        self.probe_timeout,
+                    )
+                    connected = time.perf_counter()
+                    if ssl_context:
+                        transport = await asyncio.wait_for(
+                            loop.start_tls(transport, protocol, ssl_context, server_hostname=host), self.probe_timeout)
+                    handshaken = time.perf_counter()
+            except (OSError, asyncio.TimeoutError) as exc:
+                logger.debug(f"probing {endpoint.address} of {host} failed: {exc!r}")
+                continue
+            finally:
+                if transport:
+                    transport.close()
+
+            ENDPOINT_PROBE_SECONDS.labels(self.name, endpoint.address, 'connect').observe(connected - started)
+            if ssl_context:
+                ENDPOINT_PROBE_SECONDS.labels(self.name, endpoint.address, 'handshake').observe(handshaken - connected)
+            sample = (connected - started, handshaken - connected)
+            if best is None or sum(sample) < sum(best):
+                best = sample
+        return best
+
+    async def __reevaluate_loop(self):
+        while True:
+            await asyncio.sleep(self.reevaluate_interval)
+            if self.limiter and self.limiter.window.is_active():
+                continue
+            try:
+                await self.reevaluate()
+            except Exception:
+                logger.warning(f"re-evaluating the endpoints of {self.name} failed", exc_info=True)
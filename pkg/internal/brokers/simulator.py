@@ -0,0 +1,216 @@
+""" Local stand-in for the Tavana web and API servers, used with FakeBroker """
+import asyncio
+import random
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Dict, List, Literal, Optional
+
+import cv2
+import numpy as np
+from aiohttp import web
+
+Distribution = Literal["constant", "uniform", "normal", "lognormal"]
+
+API_PREFIX = '/Web/V1'
+CAPTCHA_PATH = '/Account/undefined/4051238/Account/Captcha'
+# Lets FakeBroker log in without a trained captcha model
+CAPTCHA_ANSWER_HEADER = 'X-Captcha-Answer'
+
+SYMBOLS = [
+    {'isin': 'IRO1FOLD0001', 'label': 'FOLD', 'title': 'Foolad Mobarakeh'},
+    {'isin': 'IRO1IKCO0001', 'label': 'KHODRO', 'title': 'Iran Khodro'},
+    {'isin': 'IRO1PTEH0001', 'label': 'SHETRAN', 'title': 'Tehran Oil Refining'},
+    {'isin': 'IRO1FAKE0001', 'label': 'FAKE', 'title': 'Fake Industries'},
+]
+
+
+@dataclass
+class LatencyModel:
+    """ One way network delay in seconds """
+    distribution: Distribution = "constant"
+    mean: float = 0
+    # Spread around the mean, standard deviation for normal and lognormal
+    jitter: float = 0
+
+    def sample(self, rnd: random.Random) -> float:
+        if self.distribution == "uniform":
+            value = rnd.uniform(self.mean - self.jitter, self.mean + self.jitter)
+        elif self.distribution == "normal":
+            value = rnd.gauss(self.mean, self.jitter)
+        elif self.distribution == "lognormal" and self.mean > 0:
+            # Parameterized so the samples keep the requested mean and standard deviation
+            sigma2 = np.log1p((self.jitter / self.mean) ** 2)
+            value = rnd.lognormvariate(np.log(self.mean) - sigma2 / 2, np.sqrt(sigma2))
+        else:
+            value = self.mean
+        return max(value, 0)
+
+
+@dataclass
+class SimulatorConfig:
+    latency: LatencyModel = field(default_factory=LatencyModel)
+    # Share of API calls answered with a 503
+    error_rate: float = 0
+    # Share of logins rejected as if the captcha was misread
+    login_failure_rate: float = 0
+    balance: int = 1_000_000_000
+    # Last traded price of each symbol, 10000 when missing. Changed through /_sim/prices
+    prices: Dict[str, int] = field(default_factory=dict)
+    seed: Optional[int] = None
+
+
+@dataclass
+class Arrival:
+    order_id: int
+    isin: str
+    count: int
+    price: int
+    # Wall clock time the request would have reached the exchange, time.time() based
+    arrived_at: float
+
+
+class Simulator:
+    def __init__(self, config: SimulatorConfig) -> None:
+        self.config = config
+        self.random = random.Random(config.seed)
+        self.captchas: Dict[str, str] = {}
+        self.tokens: Dict[str, str] = {}
+        self.arrivals: List[Arrival] = []
+        self.prices = {symbol['isin']: config.prices.get(symbol['isin'], 10000) for symbol in SYMBOLS}
+
+    def create_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.network_middleware])
+        app.add_routes([
+            web.get(CAPTCHA_PATH, self.captcha_handler),
+            web.post('/login', self.login_handler),
+            web.get(API_PREFIX + '/', self.probe_handler),
+            web.get(API_PREFIX + '/Accounting/GetCustomerAccount', self.balance_handler),
+            web.get(API_PREFIX + '/Symbol/GetSymbol', self.symbol_handler),
+            web.post(API_PREFIX + '/Order/Post', self.order_handler),
+            web.get('/_sim/arrivals', self.arrivals_handler),
+            web.delete('/_sim/arrivals', self.clear_arrivals_handler),
+            web.get('/_sim/prices', self.prices_handler),
+            web.post('/_sim/prices', self.set_prices_handler),
+        ])
+        return app
+
+    @web.middleware
+    async def network_middleware(self, request: web.Request, handler) -> web.StreamResponse:
+        if request.path.startswith('/_sim/'):
+            return await handler(request)
+
+        inbound = self.config.latency.sample(self.random)
+        outbound = self.config.latency.sample(self.random)
+        request['arrived_at'] = time.time() + inbound
+
+        await asyncio.sleep(inbound)
+        if request.path.startswith(API_PREFIX) and self.random.random() < self.config.error_rate:
+            response: web.StreamResponse = web.json_response({'message': 'service unavailable'}, status=503)
+        else:
+            response = await handler(request)
+        await asyncio.sleep(outbound)
+        return response
+
+    def authenticated(self, request: web.Request) -> bool:
+        authorization = request.headers.get('Authorization', '')
+        return authorization.removeprefix('BasicAuthentication ') in self.tokens
+
+    def render_captcha(self, answer: str) -> bytes:
+        img = np.full((60, 202), 255, dtype=np.uint8)
+        for i, digit in enumerate(answer):
+            org = (20 + i * 45 + self.random.randint(-4, 4), 42 + self.random.randint(-6, 6))
+            cv2.putText(img, digit, org, cv2.FONT_HERSHEY_SIMPLEX, 1.4, 0, 2)
+        noise = np.array([self.random.randint(0, 40) for _ in range(img.size)], dtype=np.uint8)
+        img = cv2.subtract(img, noise.reshape(img.shape))
+        return cv2.imencode('.jpeg', img)[1].tobytes()
+
+    async def captcha_handler(self, request: web.Request):
+        session = request.cookies.get('captcha_session') or uuid.uuid4().hex
+        answer = ''.join(self.random.choice('0123456789') for _ in range(4))
+        self.captchas[session] = answer
+
+        response = web.Response(
+            body=self.render_captcha(answer),
+            content_type='image/jpeg',
+            headers={CAPTCHA_ANSWER_HEADER: answer},
+        )
+        response.set_cookie('captcha_session', session)
+        return response
+
+    async def login_handler(self, request: web.Request):
+        form = await request.post()
+        session = request.cookies.get('captcha_session', '')
+        answer = self.captchas.pop(session, None)
+
+        if (
+            answer is None
+            or str(form.get('capcha')) != answer
+            or self.random.random() < self.config.login_failure_rate
+        ):
+            # Tavana renders the login page again, without the token cookie
+            return web.Response(text='invalid captcha', content_type='text/html')
+
+        token = uuid.uuid4().hex
+        self.tokens[token] = str(form.get('username'))
+        response = web.Response(text='welcome', content_type='text/html')
+        response.set_cookie('__apitoken__', token)
+        return response
+
+    async def probe_handler(self, request: web.Request):
+        return web.json_response({})
+
+    async def balance_handler(self, request: web.Request):
+        if not self.authenticated(request):
+            return web.json_response({'message': 'unauthorized'}, status=401)
+        return web.json_response({'Data': [{'RealBalance': f'{self.config.balance:,}'}]})
+
+    async def symbol_handler(self, request: web.Request):
+        term = request.query.get('term', '').upper()
+        return web.json_response([
+            {**symbol, 'lastTradedPrice': self.prices[symbol['isin']]} for symbol in SYMBOLS
+            if term in symbol['label'] or term in symbol['isin']
+        ])
+
+    async def order_handler(self, request: web.Request):
+        if not self.authenticated(request):
+            return web.json_response({'message': 'unauthorized'}, status=401)
+
+        data = await request.json()
+        arrival = Arrival(
+            order_id=len(self.arrivals) + 1,
+            isin=data['isin'],
+            count=data['orderCount'],
+            price=data['orderPrice'],
+            arrived_at=request['arrived_at'],
+        )
+        self.arrivals.append(arrival)
+        return web.json_response({
+            'IsSuccessfull': True,
+            'OrderId': arrival.order_id,
+            'ArrivedAt': arrival.arrived_at,
+        })
+
+    async def arrivals_handler(self, request: web.Request):
+        return web.json_response([arrival.__dict__ for arrival in self.arrivals])
+
+    async def clear_arrivals_handler(self, request: web.Request):
+        self.arrivals.clear()
+        return web.json_response({})
+
+
+    async def prices_handler(self, request: web.Request):
+        return web.json_response(self.prices)
+
+    async def set_prices_handler(self, request: web.Request):
+        self.prices.update(await request.json())
+        return web.json_response(self.prices)
+
+
+def run_simulator(host: str, port: int, config: SimulatorConfig):
+    web.run_app(
+        Simulator(config).create_app(),
+        host=host,
+        port=port,
+        print=lambda _: None,
+    )
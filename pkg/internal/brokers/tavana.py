@@ -1,27 +1,65 @@
 import asyncio
 import datetime
 import json
+import functools
 import logging
 import io
-from typing import Dict, Tuple, Union
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
 from urllib.parse import urlencode
 
 import aiohttp
+from multidict import CIMultiDictProxy
 from yarl import URL
 
-from pkg.internal.brokers.abc import AbstractBroker
-from pkg.internal.brokers.exceptions import AuthenticationError
+from pkg.internal.brokers.abc import AbstractBroker, Session
+from pkg.internal.brokers.exceptions import AuthenticationError, BrokerError
+from pkg.internal.brokers.prober import LatencyProber
+from pkg.internal.brokers.ratelimit import RateLimiter
+from pkg.internal.brokers.resolver import EndpointResolver
 from pkg.internal.captcha import CaptchaSolver
-from pkg.internal.requests import Request, schedule_request, calc_latency
+from pkg.internal.latencyprofile import LatencyProfile
+from pkg.internal.metrics import BROKER_REQUEST_SECONDS
+from pkg.internal.requests import ArmedRequest, RawRequest, WarmPool, schedule_request, schedule_requests
+from pkg.internal.tls import create_client_context
+from pkg.internal.tracing import OrderTrace
 
 logger = logging.getLogger('myapp')
 
 
 class TavanaBroker(AbstractBroker):
-    def __init__(self, captcha_ml: CaptchaSolver):
+    def __init__(
+            self,
+            captcha_ml: Optional[CaptchaSolver],
+            raw_sender: bool = False,
+            base_url: URL = URL('https://onlinetavana.ir/'),
+            base_api_url: URL = URL('https://api.onlinetavana.ir/Web/V1/'),
+            limiter: Optional[RateLimiter] = None,
+            latency_profile: Optional[LatencyProfile] = None,
+            resolver: Optional[EndpointResolver] = None,
+    ):
         self.name = "TAVANA"
-        self.base_url = URL('https://onlinetavana.ir/')
-        self.base_api_url = URL('https://api.onlinetavana.ir/Web/V1/')
+        # Every outbound call goes through it
+        self.limiter = limiter or RateLimiter(self.name)
+        # Latency estimate shared by every order on this broker, created on first use
+        self.prober: Optional[LatencyProber] = None
+        # Learns the time of day latency from the probes, its prediction wins over the live estimate
+        self.latency_profile = latency_profile
+        # Pins the order connections and the prober to the fastest address of the api host
+        self.resolver = resolver
+        # Field of the GetSymbol results carrying the last traded price
+        self.price_field = 'lastTradedPrice'
+        # Quotes are polled often, they keep their connections alive between polls
+        self.quote_session: Optional[aiohttp.ClientSession] = None
+        # Connections shared by the captcha and login calls of every account, each keeps its own cookies
+        self.login_connector: Optional[aiohttp.TCPConnector] = None
+        # Connections kept open for the orders waiting on a price condition, replaced after a minute
+        self.warm_pool = WarmPool(max_age=60)
+        # Fire orders over a bare TLS transport instead of aiohttp's connection
+        self.raw_sender = raw_sender
+        self.base_url = base_url
+        self.base_api_url = base_api_url
+        # One for the life of the broker, so reconnects to the api host resume their TLS session
+        self.ssl_context = create_client_context() if base_api_url.scheme == 'https' else None
         self.captcha_url = self.base_url / 'Account/undefined/4051238/Account/Captcha'
         self.captcha_detector = captcha_ml
 
@@ -37,32 +75,80 @@ class TavanaBroker(AbstractBroker):
             'Pragma': 'no-cache',
             'Cache-Control': 'no-cache'
         }
+        self.symbol_headers = {
+            **self.base_headers,
+            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/95.0.4638.54 Safari/537.36 RuxitSynthetic/1.0 v8570808866573625578 t1940058695426470036 ath1fb31b7a altpriv cvcv=2 smf=0',
+        }
 
-    async def __get_captcha(self, cookies: aiohttp.CookieJar, headers: Dict[str, str]) -> int:
-        url = self.base_url / 'Account/undefined/4051238/Account/Captcha'
-
+    async def _download_captcha(
+            self,
+            cookies: aiohttp.CookieJar,
+            headers: Dict[str, str],
+    ) -> Tuple[io.BytesIO, 'CIMultiDictProxy[str]']:
+        """ The captcha image of the session and the headers it came with """
         # TODO: fix Reader incompatibility with BytesIO
         captcha_img = io.BytesIO()
 
-        async with aiohttp.ClientSession(cookie_jar=cookies, headers=headers) as session:
-            async with session.get(url) as res:
-                async for chunk in res.content.iter_chunked(1024):
-                    captcha_img.write(chunk)
+        async with self.limiter.acquire("login"):
+            with BROKER_REQUEST_SECONDS.labels(self.name, 'captcha').time():
+                async with self._login_session(cookies, headers) as session:
+                    async with session.get(self.captcha_url) as res:
+                        async for chunk in res.content.iter_chunked(1024):
+                            captcha_img.write(chunk)
 
         captcha_img.seek(0, 0)
-        return int(self.captcha_detector.predict(captcha_img))  # type: ignore
+        return captcha_img, res.headers
+
+    async def _get_captcha(self, cookies: aiohttp.CookieJar, headers: Dict[str, str]) -> str:
+        captcha_img, _ = await self._download_captcha(cookies, headers)
+        # Kept as a string, int() would drop leading zeros
+        return self.captcha_detector.predict(captcha_img)  # type: ignore
 
     async def get_stock(self, stock_name: str) -> Dict[str, str]:
-        url = 'https://api.onlinetavana.ir/Web/V1/Symbol/GetSymbol?term=' + stock_name
+        url = (self.base_api_url / 'Symbol/GetSymbol').with_query(term=stock_name)
 
-        headers = {
-            **self.base_headers,
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/95.0.4638.54 Safari/537.36 RuxitSynthetic/1.0 v8570808866573625578 t1940058695426470036 ath1fb31b7a altpriv cvcv=2 smf=0',
-        }
+        async with self.limiter.acquire("dashboard"):
+            with BROKER_REQUEST_SECONDS.labels(self.name, 'get_stock').time():
+                async with aiohttp.ClientSession(headers=self.symbol_headers) as session:
+                    async with session.get(url) as response:
+                        return await response.json()
+
+    async def get_quote(self, isin: str) -> int:
+        url = (self.base_api_url / 'Symbol/GetSymbol').with_query(term=isin)
+        if self.quote_session is None or self.quote_session.closed:
+            self.quote_session = aiohttp.ClientSession(headers=self.symbol_headers)
+
+        async with self.limiter.acquire("quote"):
+            with BROKER_REQUEST_SECONDS.labels(self.name, 'quote').time():
+                async with self.quote_session.get(url) as response:
+                    symbols = await response.json()
 
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(url) as response:
-                return await response.json()
+        for symbol in symbols:
+            if symbol.get('isin') == isin and symbol.get(self.price_field) is not None:
+                return int(symbol[self.price_field])
+        raise BrokerError(f'no price for {isin}')
+
+    def _login_session(self, cookies: aiohttp.CookieJar, headers: Dict[str, str]) -> aiohttp.ClientSession:
+        """ Session of one account on the shared login connections, logging in many accounts reuses them """
+        if self.login_connector is None or self.login_connector.closed:
+            self.login_connector = aiohttp.TCPConnector(limit=0, ssl=self.ssl_context or True)
+        return aiohttp.ClientSession(
+            cookie_jar=cookies, headers=headers, connector=self.login_connector, connector_owner=False)
+
+    async def close(self):
+        if self.quote_session:
+            await self.quote_session.close()
+            self.quote_session = None
+        if self.login_connector:
+            await self.login_connector.close()
+            self.login_connector = None
+        await self.warm_pool.close()
+        if self.prober:
+            await self.prober.close()
+        if self.resolver:
+            await self.resolver.close()
+        if self.latency_profile:
+            self.latency_profile.flush()
 
     async def login(self, username: str, password: str, user_agent: str) -> Tuple[Dict[str, str], aiohttp.CookieJar]:
         url = self.base_url / 'login'
@@ -75,18 +161,20 @@ class TavanaBroker(AbstractBroker):
         credentials = {
             'username': username,
             'Password': password,
-            'capcha': await self.__get_captcha(cookies, user_headers),
+            'capcha': await self._get_captcha(cookies, user_headers),
         }
 
         login_headers = {
             **user_headers,
             'Content-Type': 'application/x-www-form-urlencoded',
         }
-        async with aiohttp.ClientSession(cookie_jar=cookies, headers=login_headers) as session:
-            async with session.post(url, data=urlencode(credentials)) as res:
-                if not self.get_api_token(cookies):
-                    raise AuthenticationError("can't authenticate user")
-                return (user_headers, cookies)
+        async with self.limiter.acquire("login"):
+            with BROKER_REQUEST_SECONDS.labels(self.name, 'login').time():
+                async with self._login_session(cookies, login_headers) as session:
+                    async with session.post(url, data=urlencode(credentials)) as res:
+                        if not self.get_api_token(cookies):
+                            raise AuthenticationError("can't authenticate user")
+                        return (user_headers, cookies)
 
     def get_api_token(self, cookies: aiohttp.CookieJar) -> Union[str, None]:
         filtered = cookies.filter_cookies(self.base_url)
@@ -109,27 +197,29 @@ class TavanaBroker(AbstractBroker):
             'Authorization': f'BasicAuthentication {self.get_api_token(cookies)}',
         }
 
-        async with aiohttp.ClientSession(cookie_jar=cookies, headers=headers) as session:
-            async with session.get(url) as res:
-                if res.status == 200:
-                    return self.convert_to_int((await res.json())['Data'][0]['RealBalance'])
-                elif res.status == 401:
-                    raise AuthenticationError(
-                        'got 401, please login again') from None
+        async with self.limiter.acquire("dashboard"):
+            with BROKER_REQUEST_SECONDS.labels(self.name, 'balance').time():
+                async with aiohttp.ClientSession(cookie_jar=cookies, headers=headers) as session:
+                    async with session.get(url) as res:
+                        if res.status == 200:
+                            return self.convert_to_int((await res.json())['Data'][0]['RealBalance'])
+                        elif res.status == 401:
+                            raise AuthenticationError(
+                                'got 401, please login again') from None
         raise ValueError("")
 
     def convert_to_int(self, str_number: str):
         return int(str_number.replace(',', ''))
 
-    async def schedule_order(
+    def arm_order(
         self,
         cookies: aiohttp.CookieJar,
         headers: Dict[str, str],
-        deadline: datetime.datetime,
         isin: str,
         price: int,
         count: int = 1,
-    ):
+    ) -> ArmedRequest:
+        """ Encode the order request ahead of time, leaving only a socket write for the deadline """
 
         url = self.base_api_url / 'Order/Post'
         headers = {
@@ -157,27 +247,170 @@ class TavanaBroker(AbstractBroker):
             'shortSellIsEnabled': False,
         }
 
-        # check network traffic from time to 3 minute before deadline
-        logger.debug("checking latency...")
-        while datetime.datetime.utcnow() + datetime.timedelta(minutes=3) < deadline:
-            latency = await calc_latency(
-                'get',
-                self.base_api_url,
-                cookies=cookies.filter_cookies(self.base_api_url),
-                headers=headers
-            )
-            logger.debug(f"got latency: {latency}")
-            self.update_latencies(latency)
-            await asyncio.sleep(30)
-
-        request = Request(
+        request_class = RawRequest if self.raw_sender else ArmedRequest
+        return request_class(
             method='post',
             url=url,
             headers=headers,
             cookies=cookies.filter_cookies(url),
-            data=json.dumps(order_req).encode()
+            data=json.dumps(order_req).encode(),
+            ssl_context=self.ssl_context,
+            resolver=self.resolver,
         )
-        logger.debug(f"sending request with latency of {self.min_latency}")
-        logger.debug(f"with header {headers}, cookies {cookies.filter_cookies(url)}")
-        async with schedule_request(request, deadline, self.min_latency) as response:
-            return response.status, await response.text()
+
+    def _get_prober(self) -> LatencyProber:
+        if self.prober is None:
+            self.prober = LatencyProber(
+                self.name,
+                self.base_api_url,
+                self.limiter,
+                on_sample=self._on_latency_sample,
+                resolver=self.resolver,
+                ssl_context=self.ssl_context,
+            )
+        return self.prober
+
+    async def _warm_endpoints(self):
+        """ Pick the api address the order connections go to, they connect to the default one if it fails """
+        if self.resolver:
+            try:
+                await self.resolver.warm(self.base_api_url, self.ssl_context)
+            except Exception:
+                logger.warning(f"warming the endpoints of {self.base_api_url.host} failed", exc_info=True)
+
+    def _release_endpoints(self):
+        """ Once per _warm_endpoints, after the order is done """
+        if self.resolver:
+            self.resolver.release(self.base_api_url)
+
+    def _on_latency_sample(self, latency: float):
+        self.update_latencies(latency)
+        if self.latency_profile:
+            self.latency_profile.record(latency)
+
+    async def _estimate_latency(
+            self, deadline: datetime.datetime, cookies: aiohttp.CookieJar, headers: Dict[str, str]) -> float:
+        """ Wait for the shared prober's final estimate for deadline """
+        probe_headers = {
+            **headers,
+            'Authorization': f'BasicAuthentication {self.get_api_token(cookies)}',
+        }
+        logger.debug("checking latency...")
+        estimate = await self._get_prober().wait_for_estimate(deadline, probe_headers)
+        if self.latency_profile:
+            predicted = self.latency_profile.predict(deadline)
+            if predicted is not None:
+                logger.info(f"latency predicted for {deadline} is {predicted}, live estimate {estimate}")
+                return predicted
+        return self.min_latency if estimate is None else estimate
+
+    async def schedule_order(
+        self,
+        cookies: aiohttp.CookieJar,
+        headers: Dict[str, str],
+        deadline: datetime.datetime,
+        isin: str,
+        price: int,
+        count: int = 1,
+        trace: Optional[OrderTrace] = None,
+    ):
+
+        request = self.arm_order(cookies, headers, isin, price, count)
+        if trace:
+            trace.mark("armed")
+        logger.debug(f"order armed with {len(request.payload)} bytes payload")
+
+        self.limiter.window.arm(deadline)
+        try:
+            await self._warm_endpoints()
+            latency = await self._estimate_latency(deadline, cookies, headers)
+
+            logger.debug(f"sending request with latency of {latency}")
+            order_metric = BROKER_REQUEST_SECONDS.labels(self.name, 'order')
+            # Only the write takes the order's slot, not the wait for the deadline
+            send_guard = functools.partial(self.limiter.acquire, "order")
+            async with schedule_request(request, deadline, latency, order_metric, trace, send_guard) as response:
+                return response.status, await response.text()
+        finally:
+            self._release_endpoints()
+            self.limiter.window.disarm(deadline)
+
+    async def fire_on(
+        self,
+        condition: asyncio.Future,
+        cookies: aiohttp.CookieJar,
+        headers: Dict[str, str],
+        isin: str,
+        price: int,
+        count: int = 1,
+        trace: Optional[OrderTrace] = None,
+        hold: float = 600,
+    ) -> Optional[Tuple[int, Any]]:
+        """ Keep an armed order waiting on the broker's pool of warm connections,
+        and write it on one of them the moment condition resolves.
+        """
+        request = self.arm_order(cookies, headers, isin, price, count)
+        if trace:
+            trace.mark("armed")
+        try:
+            await self._warm_endpoints()
+            async with self.warm_pool.watching(request):
+                if not condition.done():
+                    # Wakes up in the iteration condition resolves in, no wrapping task in between
+                    await asyncio.wait([condition], timeout=hold)
+                if not condition.done() or condition.cancelled():
+                    return None
+
+                if trace:
+                    trace.mark("triggered")
+                async with self.warm_pool.take(request) as conn:
+                    if trace:
+                        trace.mark("connection_established")
+                        trace.mark("fire")
+                    async with self.limiter.acquire("order"):
+                        async with request.send(conn, trace) as response:
+                            logger.info(f"order for {isin} fired at price {condition.result()}")
+                            return response.status, await response.text()
+        finally:
+            self._release_endpoints()
+
+    async def schedule_orders(
+        self,
+        sessions: Sequence[Session],
+        deadline: datetime.datetime,
+        isin: str,
+        price: int,
+        count: int = 1,
+        traces: Optional[Sequence[Optional[OrderTrace]]] = None,
+    ) -> List[Union[Tuple[int, Any], BaseException]]:
+        """ One probe loop and one timer for the whole group, every order fired in the same loop iteration """
+        traces = traces or [None] * len(sessions)
+        if not sessions:
+            return []
+        if len(sessions) == 1:
+            (cookies, headers), = sessions
+            try:
+                return [await self.schedule_order(cookies, headers, deadline, isin, price, count, traces[0])]
+            except Exception as exc:
+                return [exc]
+
+        requests = []
+        for (cookies, headers), trace in zip(sessions, traces):
+            requests.append(self.arm_order(cookies, headers, isin, price, count))
+            if trace:
+                trace.mark("armed")
+        logger.debug(f"{len(requests)} orders armed")
+
+        self.limiter.window.arm(deadline)
+        try:
+            await self._warm_endpoints()
+            cookies, headers = sessions[0]
+            latency = await self._estimate_latency(deadline, cookies, headers)
+
+            logger.debug(f"sending {len(requests)} requests with latency of {latency}")
+            order_metric = BROKER_REQUEST_SECONDS.labels(self.name, 'order')
+            send_guard = functools.partial(self.limiter.acquire, "order")
+            return await schedule_requests(requests, deadline, latency, order_metric, traces, send_guard)
+        finally:
+            self._release_endpoints()
+            self.limiter.window.disarm(deadline)
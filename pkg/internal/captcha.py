@@ -3,7 +3,7 @@ import os
 import uuid
 import io
 from pathlib import Path
-from typing import Union
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import aiohttp
 import cv2
@@ -11,6 +11,31 @@ import numpy as np
 from yarl import URL
 from dataclasses import dataclass
 
+from pkg.internal.metrics import CAPTCHA_INFERENCE_SECONDS
+
+
+@dataclass(frozen=True)
+class ModelVariant:
+    """ Architecture of the captcha model, weights only load into the variant that saved them """
+    filters: Tuple[int, ...] = (16, 32, 32)
+    # Depthwise-separable convolutions after the first one, a fraction of the multiply-adds
+    separable: bool = False
+    # One dense layer shared by the digit heads instead of one per digit
+    shared_trunk: bool = False
+    dense: int = 64
+    # Images are resized by this factor before the model sees them
+    scale: float = 1.0
+    # The original heads, kept so models trained before variants existed still load
+    sigmoid: bool = False
+
+
+MODEL_VARIANTS: Dict[str, ModelVariant] = {
+    'baseline': ModelVariant(sigmoid=True),
+    'shared': ModelVariant(shared_trunk=True, dense=128),
+    'separable': ModelVariant(separable=True, shared_trunk=True, dense=128),
+    'small': ModelVariant(filters=(16, 32), separable=True, shared_trunk=True, dense=128, scale=.5),
+}
+
 
 @dataclass
 class DatasetConfig:
@@ -18,36 +43,73 @@ class DatasetConfig:
     labels = "1234567890"
     length: int = 4
     n_sample: int = 1000
+    # One of MODEL_VARIANTS
+    variant: str = 'baseline'
+
+    @property
+    def model_variant(self) -> ModelVariant:
+        return MODEL_VARIANTS[self.variant]
+
+    @property
+    def input_shape(self) -> Tuple[int, int, int]:
+        height, width, channels = self.shape
+        scale = self.model_variant.scale
+        return round(height * scale), round(width * scale), channels
 
 
 class CaptchaSolver:
     def __init__(self, dataset_config: DatasetConfig = DatasetConfig()) -> None:
+        if dataset_config.variant not in MODEL_VARIANTS:
+            raise ValueError(f"unknown captcha model variant {dataset_config.variant}, "
+                             f"one of {', '.join(MODEL_VARIANTS)}")
         self.dataset_config = dataset_config
         self.model = self.__create_model()
 
-    def train_model(self, training_dir: str):
+    def train_model(self, training_dir: str, epochs: int = 60):
         """ 
         After labeling files in download directory, use this function to build training model
         """
-        X, y = self.__preprocess(training_dir)
-        return self.model.fit(X, [y[0], y[1], y[2], y[3]], batch_size=32, epochs=60, validation_split=0.2, verbose="0")
+        X, y = self.load_dataset(training_dir)
+        return self.fit(X, y, epochs)
 
-    def predict(self, reader: io.BufferedReader) -> str:
-        bytes_as_np_array = np.frombuffer(reader.read(), dtype=np.uint8)
-        img = cv2.imdecode(bytes_as_np_array, cv2.IMREAD_GRAYSCALE)
-        img = img / 255.0
+    def fit(self, X: np.ndarray, y: np.ndarray, epochs: int = 60):
+        return self.model.fit(X, list(y), batch_size=32, epochs=epochs, validation_split=0.2, verbose="0")
 
-        res = np.array(self.model.predict(img[np.newaxis, :, :, np.newaxis]))
+    @CAPTCHA_INFERENCE_SECONDS.time()
+    def predict(self, reader: io.BufferedReader) -> str:
+        return self.predict_batch([reader.read()])[0]
+
+    def predict_batch(self, images: Sequence[bytes]) -> List[str]:
+        """ Solve many captchas in one model call, cheaper per image than predict """
+        X = np.stack([self.__image(cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_GRAYSCALE))
+                      for data in images])
+        return self.__decode(self.__infer(X))
+
+    def evaluate(self, X: np.ndarray, y: np.ndarray) -> Dict[str, float]:
+        """ Share of digits and of whole captchas read right, y as load_dataset returns it """
+        predicted = self.__infer(X).argmax(axis=-1)
+        correct = predicted == y.argmax(axis=-1)
+        return {
+            'digit_accuracy': float(correct.mean()),
+            'captcha_accuracy': float(correct.all(axis=0).mean()),
+        }
+
+    def __infer(self, X: np.ndarray) -> np.ndarray:
+        """ Scores shaped (length, images, labels). Calling the model skips model.predict's
+        per call setup, which costs more than the inference of a single image
+        """
+        return np.stack([np.asarray(scores) for scores in self.model(X, training=False)])
 
-        result = np.reshape(res, (self.dataset_config.length, len(self.dataset_config.labels)))
-        k_ind = []
-        for i in result:
-            k_ind.append(np.argmax(i))
+    def __decode(self, scores: np.ndarray) -> List[str]:
+        labels = self.dataset_config.labels
+        return [''.join(labels[k] for k in digits) for digits in scores.argmax(axis=-1).T]
 
-        capt = ''
-        for k in k_ind:
-            capt += self.dataset_config.labels[k]
-        return capt
+    def __image(self, img: np.ndarray) -> np.ndarray:
+        """ A grayscale image as the model's input """
+        height, width, channels = self.dataset_config.input_shape
+        if img.shape[:2] != (height, width):
+            img = cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+        return np.reshape(img / 255.0, (height, width, channels))
 
     def save(self, filepath: str):
         self.model.save_weights(filepath)
@@ -71,25 +133,35 @@ class CaptchaSolver:
             await tasks
 
     def __create_model(self):
-        from keras.layers import Input, Conv2D, Dense, MaxPooling2D, BatchNormalization, Dropout, Flatten
+        from keras.layers import (
+            Input, Conv2D, Dense, MaxPooling2D, BatchNormalization, Dropout, Flatten, SeparableConv2D,
+        )
         from keras.models import Model
 
-        img = Input(shape=self.dataset_config.shape)
-        conv1 = Conv2D(16, (3, 3), padding='same', activation='relu')(img)  # 50*200
-        mp1 = MaxPooling2D(padding='same')(conv1)  # 25*100
-        conv2 = Conv2D(32, (3, 3), padding='same', activation='relu')(mp1)
-        mp2 = MaxPooling2D(padding='same')(conv2)  # 13*50
-        conv3 = Conv2D(32, (3, 3), padding='same', activation='relu')(mp2)
-        bn = BatchNormalization()(conv3)  # to improve the stability of model
-        mp3 = MaxPooling2D(padding='same')(bn)  # 7*25
-
-        flat = Flatten()(mp3)  # convert the layer into 1-D
+        variant = self.dataset_config.model_variant
+        img = Input(shape=self.dataset_config.input_shape)
+        layer = img
+        for i, filters in enumerate(variant.filters):
+            # Separable convolutions gain nothing on a single input channel
+            conv = SeparableConv2D if variant.separable and i > 0 else Conv2D
+            layer = conv(filters, (3, 3), padding='same', activation='relu')(layer)
+            if i == len(variant.filters) - 1:
+                layer = BatchNormalization()(layer)  # to improve the stability of model
+            layer = MaxPooling2D(padding='same')(layer)
+
+        flat = Flatten()(layer)  # convert the layer into 1-D
+        if variant.shared_trunk:
+            flat = Dropout(0.5)(Dense(variant.dense, activation='relu')(flat))
 
         outs = []
         for _ in range(self.dataset_config.length):
-            dens1 = Dense(64, activation='relu')(flat)
-            drop = Dropout(0.5)(dens1)  # drops 0.5 fraction of nodes
-            res = Dense(len(self.dataset_config.labels), activation='sigmoid')(drop)
+            if variant.shared_trunk:
+                drop = flat
+            else:
+                dens1 = Dense(variant.dense, activation='relu')(flat)
+                drop = Dropout(0.5)(dens1)  # drops 0.5 fraction of nodes
+            activation = 'sigmoid' if variant.sigmoid else 'softmax'
+            res = Dense(len(self.dataset_config.labels), activation=activation)(drop)
 
             outs.append(res)
 
@@ -97,23 +169,22 @@ class CaptchaSolver:
         model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=["accuracy"])
         return model
 
-    def __preprocess(self, training_dir: str):
-        n_sample = len(os.listdir(training_dir))
-        X = np.zeros((n_sample, *self.dataset_config.shape))
+    def load_dataset(self, directory: str, filenames: Optional[Sequence[str]] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """ Images and one-hot labels of the labeled files in directory, named by their answer """
+        if filenames is None:
+            filenames = os.listdir(directory)
+        n_sample = len(filenames)
+        X = np.zeros((n_sample, *self.dataset_config.input_shape))
         y = np.zeros((self.dataset_config.length, n_sample, len(self.dataset_config.labels)))
 
-        for i, filename in enumerate(os.listdir(training_dir)):
-            img = cv2.imread(
-                os.path.join(training_dir, filename),
-                cv2.IMREAD_GRAYSCALE
-            ) / 255  # type: ignore
+        for i, filename in enumerate(filenames):
+            img = cv2.imread(os.path.join(directory, filename), cv2.IMREAD_GRAYSCALE)
 
             label = filename.split('.')[0]
             # There might be more than one sample with the same number
             if label.endswith('_'):
                 label = label.replace('_', '')
 
-            img = np.reshape(img, self.dataset_config.shape)  # reshapes image to width 200 , height 50 ,channel 1
             target = np.zeros((self.dataset_config.length, len(self.dataset_config.labels))
                               )  # creates an array of size 5*36 with all entries 0
 
@@ -121,7 +192,7 @@ class CaptchaSolver:
                 index = self.dataset_config.labels.find(k)
                 target[j, index] = 1
 
-            X[i] = img
+            X[i] = self.__image(img)
             y[:, i] = target
 
         return X, y
@@ -0,0 +1,134 @@
+import asyncio
+import bisect
+import datetime
+import gc
+import logging
+import time
+from typing import List, Optional
+
+from pkg.internal.looplag import LoopLagMonitor
+
+logger = logging.getLogger('myapp')
+
+
+class CriticalWindow:
+    """ Tracks the armed deadlines and protects the seconds around them.
+    While a window is open the garbage collector is disabled (after a collection right at
+    the start of the window), callers are expected to defer non-essential work and loop lag
+    is recorded separately.
+    """
+
+    def __init__(self, monitor: LoopLagMonitor, before: float = 10, after: float = 2) -> None:
+        self.monitor = monitor
+        self.before = before
+        self.after = after
+        # Sorted time.time() based deadlines, one entry per armed order
+        self.deadlines: List[float] = []
+        self.entered = False
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.gc_was_enabled = True
+
+    @staticmethod
+    def _timestamp(deadline: datetime.datetime) -> float:
+        return deadline.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+    def arm(self, deadline: datetime.datetime):
+        bisect.insort(self.deadlines, self._timestamp(deadline))
+        self.changed.set()
+
+    def disarm(self, deadline: datetime.datetime):
+        timestamp = self._timestamp(deadline)
+        index = bisect.bisect_left(self.deadlines, timestamp)
+        if index < len(self.deadlines) and self.deadlines[index] == timestamp:
+            del self.deadlines[index]
+            self.changed.set()
+
+    def is_active(self, now: Optional[float] = None) -> bool:
+        """ Whether now falls in [deadline - before, deadline + after] of any armed deadline """
+        if now is None:
+            now = time.time()
+        index = bisect.bisect_left(self.deadlines, now - self.after)
+        return index < len(self.deadlines) and self.deadlines[index] <= now + self.before
+
+    async def wait_until_clear(self, until: Optional[datetime.datetime] = None):
+        """ Sleep while a window is open, but never past `until` """
+        until_timestamp = self._timestamp(until) if until else None
+        while self.is_active():
+            now = time.time()
+            if until_timestamp is not None and now >= until_timestamp:
+                return
+            await asyncio.sleep(.1 if until_timestamp is None else min(.1, until_timestamp - now))
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.entered:
+            self.__exit()
+
+    def remaining(self) -> float:
+        """ Seconds until the open window closes, 0 when none is open """
+        now = time.time()
+        return self.__window_end(now) - now if self.is_active(now) else 0
+
+    def __window_end(self, now: float) -> float:
+        """ End of the open window containing now, overlapping windows are merged """
+        end = now
+        index = bisect.bisect_left(self.deadlines, now - self.after)
+        while index < len(self.deadlines) and self.deadlines[index] - self.before <= end:
+            end = max(end, self.deadlines[index] + self.after)
+            index += 1
+        return end
+
+    def __next_start(self, now: float) -> Optional[float]:
+        index = bisect.bisect_left(self.deadlines, now - self.after)
+        if index < len(self.deadlines):
+            return self.deadlines[index] - self.before
+        return None
+
+    def __enter(self):
+        self.entered = True
+        self.gc_was_enabled = gc.isenabled()
+        started = time.perf_counter()
+        gc.collect()
+        gc.disable()
+        self.monitor.critical_samples.clear()
+        self.monitor.in_critical_window = True
+        logger.info(f"critical window entered, gc took {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    def __exit(self):
+        self.entered = False
+        self.monitor.in_critical_window = False
+        if self.gc_was_enabled:
+            gc.enable()
+        lags = self.monitor.critical_samples
+        if lags:
+            logger.info(f"critical window left, max loop lag {max(lags) * 1000:.1f}ms over {len(lags)} samples")
+
+    async def __run(self):
+        while True:
+            self.changed.clear()
+            now = time.time()
+            if self.is_active(now):
+                if not self.entered:
+                    self.__enter()
+                timeout: Optional[float] = self.__window_end(now) - now
+            else:
+                if self.entered:
+                    self.__exit()
+                next_start = self.__next_start(now)
+                timeout = None if next_start is None else next_start - now
+
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
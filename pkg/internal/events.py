@@ -0,0 +1,88 @@
+import asyncio
+import collections
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterable, List, Literal, Optional, Set, Tuple
+
+from pkg.internal.metrics import WS_DROPPED_EVENTS
+
+# orders: lifecycle of scheduled orders, balances: account balances, stats: loop lag and pending orders
+Topic = Literal["orders", "balances", "stats"]
+TOPICS: Tuple[Topic, ...] = ("orders", "balances", "stats")
+
+
+@dataclass
+class Event:
+    topic: Topic
+    data: Dict[str, Any]
+    # Account the event is about, None for the ones every subscriber of the topic gets
+    username: Optional[str] = None
+
+
+class Subscription:
+    """ One client's bounded queue. A client that can't keep up loses its oldest events,
+    publishing never waits for it.
+    """
+
+    def __init__(self, topics: Iterable[Topic], usernames: Iterable[str], maxsize: int) -> None:
+        self.topics = set(topics)
+        # Empty follows every account
+        self.usernames = set(usernames)
+        self.queue: Deque[Event] = collections.deque(maxlen=maxsize)
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def matches(self, event: Event) -> bool:
+        if event.topic not in self.topics:
+            return False
+        return event.username is None or not self.usernames or event.username in self.usernames
+
+    def put(self, event: Event):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+            WS_DROPPED_EVENTS.labels(self.queue[0].topic).inc()
+        self.queue.append(event)
+        self.ready.set()
+
+    async def get(self) -> Tuple[List[Event], int]:
+        """ Every queued event and how many were dropped since the last call """
+        await self.ready.wait()
+        self.ready.clear()
+        events = list(self.queue)
+        self.queue.clear()
+        dropped, self.dropped = self.dropped, 0
+        return events, dropped
+
+
+class EventHub:
+    """ Fans events out to the subscribed clients of this process """
+
+    def __init__(self, maxsize: int = 256) -> None:
+        self.maxsize = maxsize
+        self.subscriptions: Set[Subscription] = set()
+
+    def subscribe(self, topics: Iterable[Topic] = TOPICS, usernames: Iterable[str] = ()) -> Subscription:
+        subscription = Subscription(topics, usernames, self.maxsize)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        self.subscriptions.discard(subscription)
+
+    def has_subscribers(self, topic: Topic) -> bool:
+        return any(topic in subscription.topics for subscription in self.subscriptions)
+
+    def followed(self, topic: Topic) -> Set[str]:
+        """ Usernames explicitly followed on topic """
+        usernames: Set[str] = set()
+        for subscription in self.subscriptions:
+            if topic in subscription.topics:
+                usernames |= subscription.usernames
+        return usernames
+
+    def publish(self, topic: Topic, data: Dict[str, Any], username: Optional[str] = None):
+        if not self.subscriptions:
+            return
+        event = Event(topic, data, username)
+        for subscription in self.subscriptions:
+            if subscription.matches(event):
+                subscription.put(event)
@@ -0,0 +1,74 @@
+""" JSON encoding and decoding of the API and WebSocket payloads.
+
+orjson is used when it's installed (it's in requirements.txt), the stdlib json module otherwise.
+Both accept datetimes, UUIDs, Decimals, Enums and dataclasses, raise TypeError on anything else
+and produce compact UTF-8 bytes.
+"""
+import dataclasses
+import datetime
+import decimal
+import enum
+import json
+import uuid
+from typing import Any, Callable, Literal, Tuple
+
+JsonBackend = Literal['auto', 'orjson', 'stdlib']
+
+
+def _default(obj: Any) -> Any:
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (uuid.UUID, decimal.Decimal)):
+        # Decimals as strings, a float would lose their precision
+        return str(obj)
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+
+_stdlib_encoder = json.JSONEncoder(default=_default, separators=(',', ':'), ensure_ascii=False)
+
+
+def _stdlib_dumps(obj: Any) -> bytes:
+    return _stdlib_encoder.encode(obj).encode()
+
+
+def _codec(backend: JsonBackend) -> Tuple[str, Callable[[Any], bytes], Callable[[Any], Any]]:
+    if backend != 'stdlib':
+        try:
+            import orjson
+        except ImportError:
+            if backend == 'orjson':
+                raise RuntimeError("json backend is orjson but orjson isn't installed, pip install orjson")
+        else:
+            option = orjson.OPT_NON_STR_KEYS
+
+            def orjson_dumps(obj: Any) -> bytes:
+                return orjson.dumps(obj, default=_default, option=option)
+
+            return 'orjson', orjson_dumps, orjson.loads
+    return 'stdlib', _stdlib_dumps, json.loads
+
+
+_name, _dumps, _loads = _codec('auto')
+
+
+def use(backend: JsonBackend) -> str:
+    """ Switch the codec of this process, returns the one actually in use """
+    global _name, _dumps, _loads
+    _name, _dumps, _loads = _codec(backend)
+    return _name
+
+
+def backend() -> str:
+    return _name
+
+
+def dumps(obj: Any) -> bytes:
+    return _dumps(obj)
+
+
+def loads(data: Any) -> Any:
+    return _loads(data)
@@ -0,0 +1,115 @@
+import datetime
+import logging
+import math
+import statistics
+import zoneinfo
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+if TYPE_CHECKING:
+    from pkg.storage import AbstractStorage
+
+logger = logging.getLogger('myapp')
+
+MINUTES_PER_DAY = 24 * 60
+
+
+@dataclass
+class LatencyBucket:
+    """ One-way latency samples of a broker during one minute of one day, in seconds """
+    broker: str
+    day: datetime.date
+    # Minute of the day in market time
+    minute: int
+    count: int
+    min: float
+    p50: float
+    p90: float
+
+
+def _quantile(ordered: List[float], q: float) -> float:
+    """ Nearest-rank quantile of already sorted values, q in [0, 1] """
+    return ordered[max(math.ceil(q * len(ordered)), 1) - 1]
+
+
+class LatencyProfile:
+    """ Time of day latency of one broker, learned from the live probes.
+
+    Samples are folded into one LatencyBucket per minute, persisted once the minute is over and
+    kept for `days` days. predict() looks at the buckets within `window` minutes of the deadline's
+    minute on each of the last `days` days with data, which are the trading days since we only
+    probe ahead of orders, and returns the `quantile` of their per-day medians.
+    """
+
+    def __init__(
+            self,
+            broker: str,
+            storage: 'AbstractStorage',
+            timezone: str = 'Asia/Tehran',
+            days: int = 20,
+            window: int = 2,
+            quantile: float = .5,
+            min_days: int = 3,
+    ) -> None:
+        self.broker = broker
+        self.storage = storage
+        self.timezone = zoneinfo.ZoneInfo(timezone)
+        self.days = days
+        self.window = window
+        self.quantile = quantile
+        self.min_days = min_days
+        # Samples of the minutes not persisted yet
+        self.pending: Dict[Tuple[datetime.date, int], List[float]] = defaultdict(list)
+
+    def _market_minute(self, at: datetime.datetime) -> Tuple[datetime.date, int]:
+        """ at: naive UTC like every other datetime here """
+        local = at.replace(tzinfo=datetime.timezone.utc).astimezone(self.timezone)
+        return local.date(), local.hour * 60 + local.minute
+
+    def record(self, latency: float, at: Optional[datetime.datetime] = None):
+        key = self._market_minute(at or datetime.datetime.utcnow())
+        if self.pending and key not in self.pending:
+            # A new minute started, the earlier ones are complete
+            self.flush()
+        self.pending[key].append(latency)
+
+    def flush(self):
+        if not self.pending:
+            return
+        buckets = []
+        for (day, minute), samples in self.pending.items():
+            samples.sort()
+            buckets.append(LatencyBucket(
+                broker=self.broker,
+                day=day,
+                minute=minute,
+                count=len(samples),
+                min=samples[0],
+                p50=_quantile(samples, .5),
+                p90=_quantile(samples, .9),
+            ))
+        self.pending.clear()
+        try:
+            self.storage.add_latency_buckets(buckets)
+            oldest = max(bucket.day for bucket in buckets) - datetime.timedelta(days=self.days)
+            self.storage.delete_latency_buckets(self.broker, before=oldest)
+        except Exception:
+            logger.exception(f"persisting {len(buckets)} latency buckets of {self.broker} failed")
+
+    def predict(self, deadline: datetime.datetime) -> Optional[float]:
+        """ Expected one-way latency at deadline, None until `min_days` days have data around that time """
+        day, minute = self._market_minute(deadline)
+        minutes = [(minute + offset) % MINUTES_PER_DAY for offset in range(-self.window, self.window + 1)]
+        buckets = self.storage.get_latency_buckets(
+            self.broker, minutes, since=day - datetime.timedelta(days=self.days))
+
+        by_day: Dict[datetime.date, List[float]] = defaultdict(list)
+        for bucket in buckets:
+            by_day[bucket.day].append(bucket.p50)
+        recent_days = sorted(by_day, reverse=True)[:self.days]
+        if len(recent_days) < self.min_days:
+            return None
+
+        medians = sorted(statistics.median(by_day[day]) for day in recent_days)
+        return _quantile(medians, self.quantile)
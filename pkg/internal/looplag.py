@@ -0,0 +1,44 @@
+import asyncio
+import collections
+from typing import Deque, Optional
+
+from pkg.internal.metrics import CRITICAL_WINDOW_LAG_SECONDS, EVENT_LOOP_LAG_SECONDS
+
+
+class LoopLagMonitor:
+    """ Samples how late the event loop wakes up a task sleeping for `interval` seconds.
+    Anything blocking the loop (sync IO, model inference, GC) shows up as lag.
+    """
+
+    def __init__(self, interval: float = .01, maxlen: int = 100_000) -> None:
+        self.interval = interval
+        self.samples: Deque[float] = collections.deque(maxlen=maxlen)
+        # Set by CriticalWindow while a deadline is near
+        self.in_critical_window = False
+        self.critical_samples: Deque[float] = collections.deque(maxlen=maxlen)
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def __run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = loop.time() - expected
+            self.samples.append(lag)
+            EVENT_LOOP_LAG_SECONDS.observe(lag)
+            if self.in_critical_window:
+                self.critical_samples.append(lag)
+                CRITICAL_WINDOW_LAG_SECONDS.observe(lag)
@@ -0,0 +1,150 @@
+import asyncio
+import bisect
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from pkg.internal.brokers import AbstractBroker
+from pkg.internal.metrics import QUOTE_POLLS
+from pkg.models import Direction
+
+logger = logging.getLogger('myapp')
+
+
+@dataclass
+class Trigger:
+    """ Fires once the price of isin reaches threshold from the given direction.
+    fired resolves with the price that met it.
+    """
+    isin: str
+    direction: Direction
+    threshold: int
+    fired: asyncio.Future = field(default_factory=lambda: asyncio.get_running_loop().create_future())
+    # time.monotonic_ns() of the poll that met the threshold, same clock as OrderTrace
+    detected_at: int = 0
+
+
+class _Watchlist:
+    """ Triggers of one isin sorted by threshold, so a tick only touches the ones it fires """
+
+    def __init__(self) -> None:
+        self.sequence = itertools.count()
+        # (threshold, sequence, trigger), sequence keeps equal thresholds comparable
+        self.above: List[Tuple[int, int, Trigger]] = []
+        self.below: List[Tuple[int, int, Trigger]] = []
+
+    def __len__(self) -> int:
+        return len(self.above) + len(self.below)
+
+    def add(self, trigger: Trigger):
+        entries = self.above if trigger.direction == "above" else self.below
+        bisect.insort(entries, (trigger.threshold, next(self.sequence), trigger))
+
+    def remove(self, trigger: Trigger):
+        entries = self.above if trigger.direction == "above" else self.below
+        index = bisect.bisect_left(entries, (trigger.threshold, -1))
+        while index < len(entries) and entries[index][0] == trigger.threshold:
+            if entries[index][2] is trigger:
+                del entries[index]
+                return
+            index += 1
+
+    def pop_met(self, price: int) -> List[Trigger]:
+        # above triggers at or under price and below triggers at or over it
+        split = bisect.bisect_right(self.above, (price, float('inf')))
+        met = [trigger for _, _, trigger in self.above[:split]]
+        del self.above[:split]
+
+        split = bisect.bisect_left(self.below, (price, -1))
+        met.extend(trigger for _, _, trigger in self.below[split:])
+        del self.below[split:]
+        return met
+
+    def distance(self, price: int) -> Optional[float]:
+        """ Relative distance from price to the closest threshold still waiting """
+        thresholds = []
+        if self.above:
+            thresholds.append(self.above[0][0])
+        if self.below:
+            thresholds.append(self.below[-1][0])
+        if not thresholds or price <= 0:
+            return None
+        return min(abs(threshold - price) for threshold in thresholds) / price
+
+
+class MarketDataEngine:
+    """ Polls the prices of every watched isin through one broker and fires the triggers they meet.
+    Each isin has a single poll loop however many orders watch it. The loop polls every
+    `max_interval` seconds while the price is far from every threshold and speeds up linearly
+    to `min_interval` once it's within `near` (relative) of one.
+    """
+
+    def __init__(
+            self,
+            broker: AbstractBroker,
+            min_interval: float = .05,
+            max_interval: float = 2,
+            near: float = .02,
+    ) -> None:
+        self.broker = broker
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.near = near
+        self.watchlists: Dict[str, _Watchlist] = {}
+        self.prices: Dict[str, int] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    def watch(self, isin: str, direction: Direction, threshold: int) -> Trigger:
+        trigger = Trigger(isin, direction, threshold)
+        self.watchlists.setdefault(isin, _Watchlist()).add(trigger)
+        if isin not in self.tasks:
+            self.tasks[isin] = asyncio.create_task(self.__poll(isin))
+        return trigger
+
+    def unwatch(self, trigger: Trigger):
+        watchlist = self.watchlists.get(trigger.isin)
+        if watchlist:
+            watchlist.remove(trigger)
+        if not trigger.fired.done():
+            trigger.fired.cancel()
+
+    def interval(self, isin: str) -> float:
+        watchlist = self.watchlists.get(isin)
+        price = self.prices.get(isin)
+        if not watchlist or price is None:
+            return self.min_interval
+        distance = watchlist.distance(price)
+        if distance is None:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, self.max_interval * distance / self.near))
+
+    async def stop(self):
+        for task in self.tasks.values():
+            task.cancel()
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.tasks.clear()
+
+    async def __poll(self, isin: str):
+        try:
+            while self.watchlists.get(isin):
+                try:
+                    price = await self.broker.get_quote(isin)
+                except Exception:
+                    QUOTE_POLLS.labels(self.broker.name, 'error').inc()
+                    logger.exception(f"quote for {isin} failed")
+                else:
+                    QUOTE_POLLS.labels(self.broker.name, 'ok').inc()
+                    detected_at = time.monotonic_ns()
+                    self.prices[isin] = price
+                    for trigger in self.watchlists[isin].pop_met(price):
+                        if not trigger.fired.done():
+                            trigger.detected_at = detected_at
+                            trigger.fired.set_result(price)
+                await asyncio.sleep(self.interval(isin))
+        finally:
+            self.tasks.pop(isin, None)
+            if not self.watchlists.get(isin):
+                self.watchlists.pop(isin, None)
+                self.prices.pop(isin, None)
@@ -0,0 +1,254 @@
+""" Minimal Prometheus style metrics.
+
+Recording is lock free: it only touches plain ints and lists owned by the metric,
+which is safe on the event loop thread and good enough for the occasional executor thread.
+"""
+import bisect
+import math
+import time
+from contextlib import ContextDecorator
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+# Symmetric around zero, in seconds, for errors that can be early or late
+ERROR_BUCKETS = (
+    -.1, -.05, -.025, -.01, -.005, -.001, -.0005,
+    0,
+    .0005, .001, .005, .01, .025, .05, .1, .25, .5, 1,
+)
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def _format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    pairs = [
+        '{}="{}"'.format(key, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for key, value in labels
+    ]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Timer(ContextDecorator):
+    def __init__(self, metric: "HistogramChild") -> None:
+        self.metric = metric
+
+    def _recreate_cm(self):
+        # Decorated functions may run concurrently, give each call its own start time
+        return _Timer(self.metric)
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metric.observe(time.perf_counter() - self.started)
+        return False
+
+
+class CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self) -> None:
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class HistogramChild:
+    __slots__ = ('upper_bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, upper_bounds: Sequence[float]) -> None:
+        self.upper_bounds = upper_bounds
+        # One slot per bucket plus the +Inf one, cumulated only when rendering
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> _Timer:
+        """ Observe the duration of a block or a function, in seconds """
+        return _Timer(self)
+
+
+class _Metric:
+    kind = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children: Dict[Tuple[str, ...], object] = {}
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str, **kwargs: str):
+        """ Child metric for a set of label values, cache it on hot paths """
+        if kwargs:
+            values = tuple(kwargs[name] for name in self.labelnames)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}')
+
+        child = self.children.get(values)  # type: ignore
+        if child is None:
+            child = self.children.setdefault(values, self._new_child())  # type: ignore
+        return child
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+        ]
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def _samples(self) -> List[str]:
+        return [
+            f'{self.name}_total{_format_labels(zip(self.labelnames, values))} {_format_value(child.value)}'
+            for values, child in list(self.children.items())  # type: ignore
+        ]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def time(self) -> _Timer:
+        return self.labels().time()
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for values, child in list(self.children.items()):
+            labels = list(zip(self.labelnames, values))
+            cumulative = 0
+            for upper_bound, count in zip((*self.buckets, math.inf), list(child.counts)):  # type: ignore
+                cumulative += count
+                bucket_labels = _format_labels([*labels, ('le', _format_value(upper_bound))])
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(labels)} {_format_value(child.sum)}')  # type: ignore
+            lines.append(f'{self.name}_count{_format_labels(labels)} {child.count}')  # type: ignore
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'metric {metric.name} already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """ Prometheus text exposition format 0.0.4 """
+        return '\n'.join(metric.render() for metric in self.metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def histogram(
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        registry: Optional[Registry] = None,
+) -> Histogram:
+    return (registry or REGISTRY).register(Histogram(name, documentation, labelnames, buckets))  # type: ignore
+
+
+def counter(
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional[Registry] = None,
+) -> Counter:
+    return (registry or REGISTRY).register(Counter(name, documentation, labelnames))  # type: ignore
+
+
+BROKER_REQUEST_SECONDS = histogram(
+    'broker_request_seconds', 'Latency of outbound broker calls', ['broker', 'endpoint'])
+CAPTCHA_INFERENCE_SECONDS = histogram(
+    'captcha_inference_seconds', 'Captcha model prediction time')
+STORAGE_QUERY_SECONDS = histogram(
+    'storage_query_seconds', 'Storage query time', ['operation'])
+ORDER_FIRE_DELAY_SECONDS = histogram(
+    'order_fire_delay_seconds', 'Time the order was written minus the time it was planned to be written',
+    buckets=ERROR_BUCKETS)
+ORDER_ARRIVAL_ERROR_SECONDS = histogram(
+    'order_arrival_error_seconds', 'Fire time plus half the order round trip minus the deadline',
+    buckets=ERROR_BUCKETS)
+LOGIN_ATTEMPTS = histogram(
+    'login_attempts', 'Login attempts needed per account login', ['broker'], buckets=(1, 2, 3))
+EVENT_LOOP_LAG_SECONDS = histogram(
+    'event_loop_lag_seconds', 'How late the event loop woke up a sleeping task')
+CRITICAL_WINDOW_LAG_SECONDS = histogram(
+    'critical_window_lag_seconds', 'Event loop lag sampled while an armed deadline was near')
+DEFERRED_REQUESTS = counter(
+    'deferred_requests', 'API requests answered from cache or with 503 during a critical window',
+    ['path', 'answer'])
+ORDERS = counter(
+    'orders', 'Scheduled orders by outcome', ['broker', 'outcome'])
+RATE_LIMIT_WAIT_SECONDS = histogram(
+    'rate_limit_wait_seconds', 'Time outbound broker calls waited for the rate limiter', ['broker', 'priority'])
+SHED_REQUESTS = counter(
+    'shed_requests', 'Outbound broker calls refused because an order deadline was near', ['broker', 'priority'])
+QUOTE_POLLS = counter(
+    'quote_polls', 'Price polls made by the market data engine', ['broker', 'result'])
+TRIGGER_FIRE_DELAY_SECONDS = histogram(
+    'trigger_fire_delay_seconds', 'Time from detecting a met price condition to writing the order',
+    buckets=ERROR_BUCKETS)
+WS_CONNECTIONS = counter(
+    'ws_connections', 'WebSocket clients connected to /ws')
+WS_DROPPED_EVENTS = counter(
+    'ws_dropped_events', 'Events dropped from the queue of a WebSocket client too slow to keep up', ['topic'])
+LATENCY_PROBES = counter(
+    'latency_probes', 'Latency probes by outcome, only the ones over a reused connection are samples',
+    ['broker', 'result'])
+JOURNAL_COMMIT_SECONDS = histogram(
+    'journal_commit_seconds', 'Time to write and fsync one group commit of the storage journal')
+ENDPOINT_PROBE_SECONDS = histogram(
+    'endpoint_probe_seconds', 'TCP connect and TLS handshake time of each address of a broker host',
+    ['broker', 'address', 'phase'])
+WARM_RECONNECTS = counter(
+    'warm_reconnects', 'Armed order connections that dropped before firing and were reopened in the background')
+TLS_HANDSHAKES = counter(
+    'tls_handshakes', 'TLS handshakes of armed order connections, full or resumed', ['kind'])
@@ -0,0 +1,132 @@
+import asyncio
+import datetime
+import heapq
+import itertools
+import logging
+import sys
+import time
+import uuid
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from pkg.internal.brokers import BrokerName
+from pkg.internal.tracing import OrderTrace, TraceEvent
+from pkg.models import Order
+
+logger = logging.getLogger('myapp')
+
+# Orders wake up this long before their deadline to refresh their sessions and get armed
+WAKE_BEFORE = datetime.timedelta(minutes=15)
+
+
+class PendingOrder:
+    """ A scheduled order until it wakes up. Only what's needed to rebuild the Order, the account
+    is referenced by username and loaded from storage at wake up with its latest session.
+    """
+    __slots__ = (
+        'id', 'broker', 'username', 'isin', 'count', 'price', 'deadline', 'group_id',
+        'wall_anchor_ns', 'monotonic_anchor_ns', 'events',
+    )
+
+    def __init__(self, order: Order) -> None:
+        self.id: uuid.UUID = order.id
+        self.broker: BrokerName = order.broker
+        self.username: Optional[str] = order.username
+        # Orders of the same stock share one string instead of one per request
+        self.isin: str = sys.intern(order.isin)
+        self.count: int = order.count
+        self.price: int = order.price
+        self.deadline: datetime.datetime = order.deadline  # type: ignore
+        self.group_id: Optional[uuid.UUID] = order.group_id
+        self.wall_anchor_ns: int = order.trace.wall_anchor_ns
+        self.monotonic_anchor_ns: int = order.trace.monotonic_anchor_ns
+        self.events: Tuple[Tuple[TraceEvent, int], ...] = tuple(order.trace.events)
+
+    def trace(self) -> OrderTrace:
+        return OrderTrace(self.wall_anchor_ns, self.monotonic_anchor_ns, list(self.events))
+
+    def to_order(self) -> Order:
+        return Order(
+            id=self.id,
+            broker=self.broker,
+            isin=self.isin,
+            count=self.count,
+            price=self.price,
+            status='SCHEDULED',
+            username=self.username,
+            deadline=self.deadline,
+            group_id=self.group_id,
+            trace=self.trace(),
+        )
+
+
+class PendingOrders:
+    """ Scheduled orders of this process waiting for their wake up.
+    One timer task for all of them instead of a sleeping coroutine each, on_wake gets the
+    orders added together once `wake_before` their deadline and is where their worker starts.
+    """
+
+    def __init__(
+            self,
+            on_wake: Callable[[List[PendingOrder]], None],
+            wake_before: datetime.timedelta = WAKE_BEFORE,
+    ) -> None:
+        self.on_wake = on_wake
+        self.wake_before = wake_before
+        self.orders: Dict[uuid.UUID, PendingOrder] = {}
+        # (time.time() to wake at, insertion order, orders woken together)
+        self.heap: List[Tuple[float, int, Tuple[PendingOrder, ...]]] = []
+        self.sequence = itertools.count()
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.orders)
+
+    def __contains__(self, order_id: uuid.UUID) -> bool:
+        return order_id in self.orders
+
+    def __iter__(self) -> Iterator[PendingOrder]:
+        return iter(list(self.orders.values()))
+
+    def get(self, order_id: uuid.UUID) -> Optional[PendingOrder]:
+        return self.orders.get(order_id)
+
+    def add(self, orders: Sequence[Order]):
+        """ Orders sharing a deadline, call it from inside the running loop """
+        group = tuple(map(PendingOrder, orders))
+        for pending in group:
+            self.orders[pending.id] = pending
+        wake_at = (group[0].deadline - self.wake_before).replace(tzinfo=datetime.timezone.utc).timestamp()
+        heapq.heappush(self.heap, (wake_at, next(self.sequence), group))
+        if self.heap[0][2] is group:
+            self.changed.set()
+        if self.task is None:
+            self.task = asyncio.create_task(self.__run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def __run(self):
+        while True:
+            self.changed.clear()
+            now = time.time()
+            while self.heap and self.heap[0][0] <= now:
+                _, _, group = heapq.heappop(self.heap)
+                for pending in group:
+                    self.orders.pop(pending.id, None)
+                try:
+                    self.on_wake(list(group))
+                except Exception:
+                    logger.exception(f"waking up {len(group)} orders failed")
+
+            timeout = self.heap[0][0] - now if self.heap else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
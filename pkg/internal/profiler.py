@@ -0,0 +1,279 @@
+import asyncio
+import collections
+import inspect
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from types import CodeType, FrameType
+from typing import Any, Counter, Dict, Iterator, List, Literal, Optional, Sequence, Tuple
+
+# threads: the Python stack of every thread, what each one is executing or blocked in
+# tasks: the await chain of every asyncio task, down into the synchronous calls of the running one
+ProfileView = Literal['threads', 'tasks']
+
+# Default task and executor names carry a counter, flame graphs would get one root per task
+_NUMBERED = re.compile(r'-\d+(_\d+)?$')
+
+
+def _label(code: CodeType, module: str) -> str:
+    return f"{module}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def _thread_stack(frame: Optional[FrameType]) -> List[FrameType]:
+    """ Outermost frame first """
+    frames = []
+    while frame is not None:
+        frames.append(frame)
+        frame = frame.f_back
+    frames.reverse()
+    return frames
+
+
+def _await_chain(coro: Any) -> List[FrameType]:
+    """ Frames of a coroutine and of everything it awaits, the task's outermost first """
+    frames = []
+    while coro is not None:
+        frame = getattr(coro, 'cr_frame', None) or getattr(coro, 'gi_frame', None)
+        if frame is None:
+            break
+        frames.append(frame)
+        coro = getattr(coro, 'cr_await', None) or getattr(coro, 'gi_yieldfrom', None)
+    return frames
+
+
+def _codes(code: CodeType) -> Iterator[CodeType]:
+    """ code and the code of the functions, lambdas and comprehensions defined in it """
+    yield code
+    for const in code.co_consts:
+        if isinstance(const, CodeType):
+            yield from _codes(const)
+
+
+def _subclasses(cls: type) -> Iterator[type]:
+    yield cls
+    for subclass in cls.__subclasses__():
+        yield from _subclasses(subclass)
+
+
+class SamplingProfiler:
+    """ Samples the event loop process from a thread every `interval` seconds, no tracing hooks.
+
+    Each sample takes the stack of every thread and the await chain of every task of the loop,
+    so time a coroutine spends waiting on the broker counts as well as time it spends computing.
+    Both come out as collapsed stacks ("outer;inner count" lines) for flamegraph.pl or speedscope.
+
+    Sampling backs off while a sample costs more than a tenth of the interval, so with many tasks
+    there are fewer samples, each weighing the time since the previous one in the summary.
+
+    Frames of the methods of `components` and their subclasses are attributed to them, inclusive
+    of what they call. A component's wall time sums every task inside it, so it can exceed the
+    elapsed time, its cpu time only counts the loop thread executing inside it.
+    """
+
+    def __init__(self, interval: float = .01, components: Sequence[type] = ()) -> None:
+        self.interval = interval
+        self.components = components
+        self.code_components: Dict[CodeType, str] = {}
+        self.labels: Dict[CodeType, str] = {}
+        self.lock = threading.Lock()
+        # Stacks as (root, code, ...), labelled only when read
+        self.stacks: Dict[ProfileView, Counter[Tuple[Any, ...]]] = {
+            'threads': collections.Counter(),
+            'tasks': collections.Counter(),
+        }
+        self.wall: Counter[str] = collections.Counter()
+        self.cpu: Counter[str] = collections.Counter()
+        self.samples = 0
+        self.duration = 0.0
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread: Optional[int] = None
+        self.thread: Optional[threading.Thread] = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self):
+        """ Call it from the loop to profile, keeps what earlier runs collected """
+        if self.thread is not None:
+            return
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        for component in self.components:
+            self.__index(component)
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.__run, name='sampling-profiler', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+
+    def reset(self):
+        with self.lock:
+            for stacks in self.stacks.values():
+                stacks.clear()
+            self.wall.clear()
+            self.cpu.clear()
+            self.samples = 0
+            self.duration = 0.0
+
+    def collapsed(self, view: ProfileView = 'tasks') -> str:
+        with self.lock:
+            stacks = self.stacks[view].most_common()
+            labels = dict(self.labels)
+        lines: Counter[str] = collections.Counter()
+        for (root, *codes), count in stacks:
+            lines[';'.join([_NUMBERED.sub('', root), *(labels[code] for code in codes)])] += count
+        return ''.join(f'{stack} {count}\n' for stack, count in lines.most_common())
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'samples': self.samples,
+                'seconds': round(self.duration, 3),
+                'components': {
+                    component.__name__: {
+                        'wall_seconds': round(self.wall[component.__name__], 3),
+                        'cpu_seconds': round(self.cpu[component.__name__], 3),
+                    }
+                    for component in self.components
+                },
+            }
+
+    def __index(self, component: type):
+        for cls in _subclasses(component):
+            for attribute in vars(cls).values():
+                function = getattr(attribute, '__func__', attribute)
+                if isinstance(attribute, property):
+                    function = attribute.fget
+                # Past metric timers and other decorators, their wrapper is shared by many methods
+                function = inspect.unwrap(function) if callable(function) else None
+                code = getattr(function, '__code__', None)
+                if code is None:
+                    continue
+                for nested in _codes(code):
+                    self.code_components.setdefault(nested, component.__name__)
+
+    def __stack(self, root: str, frames: List[FrameType]) -> Tuple[Any, ...]:
+        codes = tuple(frame.f_code for frame in frames)
+        for frame in frames:
+            if frame.f_code not in self.labels:
+                self.labels[frame.f_code] = _label(frame.f_code, frame.f_globals.get('__name__', '?'))
+        return (root, *codes)
+
+    def __attributed(self, stack: Tuple[Any, ...]) -> set:
+        return {self.code_components[code] for code in stack[1:] if code in self.code_components}
+
+    def __run(self):
+        last = time.perf_counter()
+        wait = self.interval
+        while not self.stopping.wait(wait):
+            now = time.perf_counter()
+            self.__sample(now - last)
+            last = now
+            # A sample holds the GIL, with many tasks back off to keep the loop's share above 90%
+            wait = max(self.interval, (time.perf_counter() - now) * 9)
+
+    def __sample(self, elapsed: float):
+        frames = sys._current_frames()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        current = threading.get_ident()
+
+        thread_stacks = []
+        loop_stack: List[FrameType] = []
+        for ident, frame in frames.items():
+            if ident == current:
+                continue
+            stack = _thread_stack(frame)
+            if ident == self.loop_thread:
+                loop_stack = stack
+            thread_stacks.append(self.__stack(names.get(ident, str(ident)), stack))
+
+        try:
+            tasks = asyncio.all_tasks(self.loop)
+            running = asyncio.current_task(self.loop)
+        except RuntimeError:
+            # The loop closed under us
+            tasks, running = set(), None
+        loop_frames = {id(frame): index for index, frame in enumerate(loop_stack)}
+
+        task_stacks: Counter[Tuple[Any, ...]] = collections.Counter()
+        for task in tasks:
+            chain = _await_chain(task.get_coro())
+            if task is running and chain and id(chain[0]) in loop_frames:
+                # What it awaits is unknown while it runs, what it calls is on the loop thread
+                chain = loop_stack[loop_frames[id(chain[0])]:]
+            task_stacks[self.__stack(task.get_name(), chain)] += 1
+        wall: Counter[str] = collections.Counter()
+        for stack, count in task_stacks.items():
+            for component in self.__attributed(stack):
+                wall[component] += count
+
+        with self.lock:
+            self.stacks['threads'].update(thread_stacks)
+            self.stacks['tasks'].update(task_stacks)
+            for component in wall:
+                self.wall[component] += elapsed * wall[component]
+            for component in self.__attributed(self.__stack('', loop_stack)):
+                self.cpu[component] += elapsed
+            self.samples += 1
+            self.duration += elapsed
+
+
+class MemoryProfiler:
+    """ tracemalloc snapshots as collapsed stacks of allocated bytes, or top lines """
+
+    def __init__(self, frames: int = 16) -> None:
+        self.frames = frames
+        self.previous: Optional[tracemalloc.Snapshot] = None
+
+    @property
+    def running(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self):
+        tracemalloc.stop()
+        self.previous = None
+
+    def snapshot(self) -> tracemalloc.Snapshot:
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+            tracemalloc.Filter(False, '<unknown>'),
+        ])
+
+    def collapsed(self, snapshot: tracemalloc.Snapshot) -> str:
+        lines = []
+        for statistic in snapshot.statistics('traceback'):
+            stack = ';'.join(f'{frame.filename}:{frame.lineno}' for frame in statistic.traceback)
+            lines.append(f'{stack} {statistic.size}\n')
+        return ''.join(lines)
+
+    def top(self, snapshot: tracemalloc.Snapshot, limit: int = 25) -> List[Dict[str, Any]]:
+        """ Lines allocating the most, with their growth since the previous call """
+        if self.previous is None:
+            statistics = [
+                (statistic.traceback[0], statistic.size, statistic.count, None)
+                for statistic in snapshot.statistics('lineno')
+            ]
+        else:
+            statistics = [
+                (statistic.traceback[0], statistic.size, statistic.count, statistic.size_diff)
+                for statistic in snapshot.compare_to(self.previous, 'lineno')
+            ]
+        self.previous = snapshot
+        return [
+            {'line': f'{frame.filename}:{frame.lineno}', 'bytes': size, 'blocks': count, 'bytes_diff': diff}
+            for frame, size, count, diff in statistics[:limit]
+        ]
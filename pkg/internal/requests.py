@@ -1,14 +1,27 @@
 from aiohttp.connector import Connection
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import dataclass
 import abc
 import asyncio
+import collections
 import datetime
+import json
 import logging
+import ssl
 import time
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, AsyncContextManager, Callable, Deque, Dict, List, Optional, Sequence, Tuple, Union
 
-from aiohttp import ClientRequest, ClientTimeout, TCPConnector
+from aiohttp import ClientRequest, ClientResponse, ClientTimeout, TCPConnector, hdrs
+from aiohttp.abc import AbstractResolver
+from aiohttp.client_proto import ResponseHandler
+from aiohttp.streams import StreamReader
+from aiohttp.tcp_helpers import tcp_nodelay
 from aiohttp.typedefs import LooseCookies
+from multidict import CIMultiDictProxy
+
+from pkg.internal.metrics import (
+    HistogramChild, ORDER_ARRIVAL_ERROR_SECONDS, ORDER_FIRE_DELAY_SECONDS, TLS_HANDSHAKES, WARM_RECONNECTS)
+from pkg.internal.tracing import OrderTrace
 from yarl import URL
 
 logger = logging.getLogger('myapp')
@@ -20,7 +33,7 @@ class AbstractRequest(abc.ABC):
         raise NotImplementedError
 
     @abc.abstractmethod
-    async def send(self, conn: Connection):
+    async def send(self, conn: Connection, trace: Optional[OrderTrace] = None):
         raise NotImplementedError
 
 
@@ -32,10 +45,15 @@ class Request(AbstractRequest):
             headers: Optional[Dict[str, str]] = None,
             cookies: Optional[LooseCookies] = None,
             data: Optional[bytes] = None,
+            ssl_context: Optional[ssl.SSLContext] = None,
+            resolver: Optional[AbstractResolver] = None,
     ) -> None:
+        """ resolver: picks the address to connect to, aiohttp's default one without it """
 
         if isinstance(url, str):
             url = URL(url)
+        self.ssl_context = ssl_context
+        self.resolver = resolver
         self.request = ClientRequest(
             method=method,
             url=url,
@@ -45,9 +63,14 @@ class Request(AbstractRequest):
         )
 
     @asynccontextmanager
-    async def make_connection(self):
-        async with TCPConnector() as connector:
+    async def make_connection(self, connector: Optional[TCPConnector] = None):
+        """ connector: shared by requests connecting together, they reuse its DNS cache """
+        async with AsyncExitStack() as stack:
+            if connector is None:
+                connector = await stack.enter_async_context(
+                    TCPConnector(ssl=self.ssl_context, resolver=self.resolver))
             conn = await connector.connect(self.request, [], ClientTimeout(total=30))
+            stack.callback(conn.close)
             conn.protocol.set_response_params(  # type: ignore
                 read_until_eof=True,
                 auto_decompress=True,
@@ -57,20 +80,430 @@ class Request(AbstractRequest):
             yield conn
 
     @asynccontextmanager
-    async def send(self, conn: Connection):
+    async def send(self, conn: Connection, trace: Optional[OrderTrace] = None):
         async with await self.request.send(conn) as response:
+            if trace:
+                trace.mark("first_byte_written")
             await response.start(conn)
+            if trace:
+                trace.mark("response_headers")
             yield response
 
 
+class ArmedRequest(Request):
+    """ Request with its whole HTTP/1.1 message encoded ahead of time.
+    Request line, headers, cookies and body are serialized once in the constructor,
+    so firing it is a single write to an already opened connection.
+    """
+
+    def __init__(
+            self,
+            method: str,
+            url: Union[URL, str],
+            headers: Optional[Dict[str, str]] = None,
+            cookies: Optional[LooseCookies] = None,
+            data: Optional[bytes] = None,
+            ssl_context: Optional[ssl.SSLContext] = None,
+            resolver: Optional[AbstractResolver] = None,
+    ) -> None:
+
+        super().__init__(
+            method, url, headers=headers, cookies=cookies, data=data, ssl_context=ssl_context, resolver=resolver)
+        self.payload = self.__encode(data or b'')
+
+    def __encode(self, body: bytes) -> bytes:
+        req = self.request
+        headers = req.headers
+        if req.method in req.POST_METHODS and hdrs.CONTENT_TYPE not in headers:
+            headers[hdrs.CONTENT_TYPE] = 'application/octet-stream'
+        # Body is always written in one piece, never chunked
+        headers.popall(hdrs.TRANSFER_ENCODING, None)
+        if body or req.method in req.POST_METHODS:
+            headers[hdrs.CONTENT_LENGTH] = str(len(body))
+
+        path = req.url.raw_path
+        if req.url.raw_query_string:
+            path += '?' + req.url.raw_query_string
+
+        lines = [f'{req.method} {path} HTTP/1.1']
+        lines.extend(f'{key}: {value}' for key, value in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + body
+
+    @asynccontextmanager
+    async def send(self, conn: Connection, trace: Optional[OrderTrace] = None):
+        conn.transport.write(self.payload)  # type: ignore
+        if trace:
+            trace.mark("first_byte_written")
+        response = ClientResponse(
+            self.request.method,
+            self.request.url,
+            writer=None,  # type: ignore
+            continue100=None,
+            timer=None,  # type: ignore
+            request_info=self.request.request_info,
+            traces=[],
+            loop=asyncio.get_running_loop(),
+            session=None,  # type: ignore
+        )
+        async with response:
+            await response.start(conn)
+            if trace:
+                trace.mark("response_headers")
+            yield response
+
+
+class FlushingResponseHandler(ResponseHandler):
+    """ ResponseHandler with an event set while the transport's write buffer is empty.
+    The transport pauses the protocol whenever its buffer goes over the high-water mark
+    and resumes it once the buffer was flushed to the socket.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop) -> None:
+        super().__init__(loop)
+        self.flushed = asyncio.Event()
+        self.flushed.set()
+
+    def pause_writing(self) -> None:
+        super().pause_writing()
+        self.flushed.clear()
+
+    def resume_writing(self) -> None:
+        super().resume_writing()
+        self.flushed.set()
+
+    def connection_lost(self, exc: Optional[BaseException]) -> None:
+        super().connection_lost(exc)
+        # Nothing more gets flushed, reading the response raises instead
+        self.flushed.set()
+
+
+@dataclass
+class RawConnection:
+    transport: asyncio.Transport
+    protocol: FlushingResponseHandler
+
+
+@dataclass
+class RawResponse:
+    status: int
+    reason: str
+    headers: 'CIMultiDictProxy[str]'
+    content: StreamReader
+
+    # time.perf_counter_ns() right before the write and once the write buffer was flushed
+    fired_at: int
+    written_at: int
+
+    @property
+    def write_time(self) -> float:
+        """ Seconds from fire to write complete """
+        return (self.written_at - self.fired_at) / 1e9
+
+    async def read(self) -> bytes:
+        return await self.content.read()
+
+    async def text(self, encoding: str = 'utf-8') -> str:
+        return (await self.read()).decode(encoding)
+
+    async def json(self) -> Any:
+        return json.loads(await self.read())
+
+
+class RawRequest(ArmedRequest):
+    """ Armed request fired over a bare asyncio (TLS) transport.
+    Skips aiohttp's connector and Connection: the pre-encoded bytes are written straight
+    to a TCP_NODELAY socket and aiohttp's response parser is attached only after the write completed.
+    """
+
+    @asynccontextmanager
+    async def make_connection(self, connector: Optional[TCPConnector] = None):
+        """ connector is ignored, there's none on this path """
+        loop = asyncio.get_running_loop()
+        url = self.request.url
+        ssl_context = None
+        if url.scheme == 'https':
+            ssl_context = self.ssl_context or ssl.create_default_context()
+
+        # The resolver's addresses in order, the first one that connects wins
+        addresses: List[Tuple[str, int]] = [(url.raw_host, url.port)]  # type: ignore
+        if self.resolver:
+            hosts = await self.resolver.resolve(url.raw_host, url.port)  # type: ignore
+            addresses = [(host['host'], host['port']) for host in hosts]
+
+        transport: Optional[asyncio.Transport] = None
+        error: Optional[OSError] = None
+        for address, port in addresses:
+            try:
+                transport, protocol = await loop.create_connection(  # type: ignore
+                    lambda: FlushingResponseHandler(loop),
+                    address,
+                    port,
+                    ssl=ssl_context,
+                    server_hostname=url.raw_host if ssl_context else None,
+                )
+                break
+            except OSError as exc:
+                error = exc
+                logger.warning(f"connecting to {address}:{port} failed", exc_info=True)
+        if transport is None:
+            raise ConnectionError(
+                f"can't connect to {url.raw_host}:{url.port}, {len(addresses)} addresses tried") from error
+        tcp_nodelay(transport, True)
+        # Anything left in the buffer pauses the protocol, send waits for it to be flushed
+        transport.set_write_buffer_limits(high=0)
+        try:
+            yield RawConnection(transport, protocol)  # type: ignore
+        finally:
+            transport.close()
+
+    @asynccontextmanager
+    async def send(self, conn: RawConnection, trace: Optional[OrderTrace] = None):  # type: ignore[override]
+        fired_at = time.perf_counter_ns()
+        conn.transport.write(self.payload)
+        # Flushed to the socket, without polling the buffer
+        await conn.protocol.flushed.wait()
+        written_at = time.perf_counter_ns()
+        if trace:
+            trace.mark("first_byte_written")
+
+        conn.protocol.set_response_params(
+            read_until_eof=True,
+            auto_decompress=True,
+            read_timeout=10,
+        )
+        message, payload = await conn.protocol.read()
+        if trace:
+            trace.mark("response_headers")
+        yield RawResponse(
+            status=message.code,
+            reason=message.reason,
+            headers=message.headers,
+            content=payload,
+            fired_at=fired_at,
+            written_at=written_at,
+        )
+
+
+async def _open_counted(request: Request, connector: Optional[TCPConnector] = None) -> Tuple[AsyncExitStack, Any]:
+    """ Open a connection for request, closed along with the returned stack """
+    stack = AsyncExitStack()
+    try:
+        conn = await stack.enter_async_context(request.make_connection(connector))
+    except BaseException:
+        await stack.aclose()
+        raise
+    ssl_object = conn.transport.get_extra_info('ssl_object') if conn.transport else None
+    if ssl_object is not None:
+        TLS_HANDSHAKES.labels('resumed' if ssl_object.session_reused else 'full').inc()
+    return stack, conn
+
+
+class WarmConnection:
+    """ Connection of an armed request, held open until it's fired.
+    A socket that dies before that is noticed within `check_interval` and reopened in the
+    background, so firing doesn't pay for the handshake. With a ResumingSSLContext the
+    reconnect resumes the TLS session.
+    """
+
+    def __init__(
+            self,
+            request: Request,
+            connector: Optional[TCPConnector] = None,
+            check_interval: float = .1,
+            reconnect_timeout: float = 10,
+    ) -> None:
+        self.request = request
+        self.connector = connector
+        self.check_interval = check_interval
+        self.reconnect_timeout = reconnect_timeout
+        self.conn: Any = None
+        self.stack: Optional[AsyncExitStack] = None
+        self.connected = asyncio.Event()
+        self.error: Optional[BaseException] = None
+        self.watchdog: Optional[asyncio.Task] = None
+
+    async def __aenter__(self) -> "WarmConnection":
+        await self.__open()
+        self.watchdog = asyncio.create_task(self.__watch())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.__stop_watching()
+        if self.stack:
+            await self.stack.aclose()
+
+    async def take(self) -> Any:
+        """ The connection to fire on, only waits if a reconnect is in progress.
+        Stops watching it, a response may well close it.
+        """
+        if not self.connected.is_set():
+            try:
+                await asyncio.wait_for(self.connected.wait(), self.reconnect_timeout)
+            except asyncio.TimeoutError:
+                raise self.error or ConnectionError('warm connection could not be reopened')
+        # Connected, so the watchdog is between checks, cancelling it is all it takes
+        if self.watchdog:
+            self.watchdog.cancel()
+        return self.conn
+
+    @staticmethod
+    def is_alive(conn: Any) -> bool:
+        protocol = conn.protocol
+        return protocol is not None and protocol.is_connected()
+
+    async def __open(self):
+        self.stack, self.conn = await _open_counted(self.request, self.connector)
+        self.connected.set()
+
+    async def __stop_watching(self):
+        if self.watchdog:
+            self.watchdog.cancel()
+            try:
+                await self.watchdog
+            except asyncio.CancelledError:
+                pass
+            self.watchdog = None
+
+    async def __watch(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            if self.is_alive(self.conn):
+                continue
+
+            logger.warning("armed connection dropped, reconnecting")
+            WARM_RECONNECTS.inc()
+            self.connected.clear()
+            if self.stack:
+                await self.stack.aclose()
+                self.stack = None
+            backoff = self.check_interval
+            while not self.connected.is_set():
+                try:
+                    await self.__open()
+                except (OSError, asyncio.TimeoutError) as exc:
+                    self.error = exc
+                    logger.warning(f"reconnecting failed: {exc!r}, retrying in {backoff}s")
+                    await asyncio.sleep(backoff)
+                    backoff = min(backoff * 2, 1)
+
+
+class WarmPool:
+    """ Warm connections to one endpoint, shared by every armed request waiting to fire on it.
+    A single watchdog keeps up to `size` of them open while anyone is watching, replacing the
+    dropped ones and those older than `max_age`. Requests fire on whichever is open, or on a
+    fresh connection if they all got taken.
+    """
+
+    def __init__(self, size: int = 8, max_age: float = 60, check_interval: float = .1) -> None:
+        self.size = size
+        self.max_age = max_age
+        self.check_interval = check_interval
+        # (opened at loop time, stack closing it, connection), oldest first
+        self.idle: Deque[Tuple[float, AsyncExitStack, Any]] = collections.deque()
+        # Any of the watching requests, they all connect the same way
+        self.template: Optional[Request] = None
+        self.watchers = 0
+        self.watchdog: Optional[asyncio.Task] = None
+        self.wake: Optional[asyncio.Event] = None
+
+    @asynccontextmanager
+    async def watching(self, request: Request):
+        """ Keep connections for request open until the block exits """
+        self.template = request
+        self.watchers += 1
+        if self.watchdog is None:
+            self.wake = asyncio.Event()
+            self.watchdog = asyncio.create_task(self.__watch())
+        self.wake.set()  # type: ignore
+        try:
+            yield self
+        finally:
+            self.watchers -= 1
+            if not self.watchers:
+                await self.close()
+
+    @asynccontextmanager
+    async def take(self, request: Request):
+        """ An open connection to fire request on, it's closed once the block exits """
+        stack: Optional[AsyncExitStack] = None
+        conn: Any = None
+        while self.idle:
+            _, stack, conn = self.idle.pop()
+            if WarmConnection.is_alive(conn):
+                break
+            await stack.aclose()
+            stack = None
+        if self.wake:
+            self.wake.set()
+        if stack is None:
+            stack, conn = await _open_counted(request)
+        async with stack:
+            yield conn
+
+    async def close(self):
+        watchdog, self.watchdog = self.watchdog, None
+        if watchdog:
+            watchdog.cancel()
+            try:
+                await watchdog
+            except asyncio.CancelledError:
+                pass
+        while self.idle:
+            _, stack, _ = self.idle.popleft()
+            await stack.aclose()
+
+    async def __refill(self):
+        stack, conn = await _open_counted(self.template)  # type: ignore
+        self.idle.append((asyncio.get_running_loop().time(), stack, conn))
+
+    async def __prune(self):
+        now = asyncio.get_running_loop().time()
+        dead = [entry for entry in self.idle if not WarmConnection.is_alive(entry[2])]
+        stale = [entry for entry in self.idle if entry not in dead and now - entry[0] >= self.max_age]
+        for entry in dead + stale:
+            self.idle.remove(entry)
+        if dead:
+            logger.warning(f"{len(dead)} warm connections dropped, reconnecting")
+            WARM_RECONNECTS.inc(len(dead))
+        for _, stack, _ in dead + stale:
+            await stack.aclose()
+
+    async def __watch(self):
+        backoff = self.check_interval
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), self.check_interval)  # type: ignore
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()  # type: ignore
+            await self.__prune()
+
+            missing = min(self.watchers, self.size) - len(self.idle)
+            if missing <= 0:
+                continue
+            # Opened connections join the pool as they come, even if the watchdog gets cancelled meanwhile
+            results = await asyncio.gather(*(self.__refill() for _ in range(missing)), return_exceptions=True)
+            errors = [result for result in results if isinstance(result, BaseException)]
+            for error in errors:
+                if not isinstance(error, (OSError, asyncio.TimeoutError)):
+                    raise error
+            if errors:
+                logger.warning(f"opening warm connections failed: {errors[0]!r}, retrying in {backoff}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 1)
+            else:
+                backoff = self.check_interval
+
+
 async def calc_latency(
         method: str,
         url: Union[URL, str],
         cookies: Optional[LooseCookies] = None,
-        headers: Optional[Dict[str, str]] = None
+        headers: Optional[Dict[str, str]] = None,
+        ssl_context: Optional[ssl.SSLContext] = None,
 ) -> float:
     """ Calculate latency for a specific url. """
-    request = Request(method=method, url=url, headers=headers, cookies=cookies)
+    request = Request(method=method, url=url, headers=headers, cookies=cookies, ssl_context=ssl_context)
     async with request.make_connection() as conn:
         t1 = time.time()
         async with request.send(conn) as _:
@@ -79,9 +512,19 @@ async def calc_latency(
 
 
 @asynccontextmanager
-async def schedule_request(request: Request, deadline: datetime.datetime, latency: float = 0):
+async def schedule_request(
+        request: AbstractRequest,
+        deadline: datetime.datetime,
+        latency: float = 0,
+        response_metric: Optional[HistogramChild] = None,
+        trace: Optional[OrderTrace] = None,
+        guard: Optional[Callable[[], AsyncContextManager[None]]] = None,
+):
     """ Schedule request for the deadline 
     latency: send request at deadline - latency time 
+    response_metric: observes the time from fire to response headers
+    trace: order timeline to record connection and fire events in
+    guard: entered right before the write and held until the response, not while waiting for the deadline
     NODE: latency should be calculated by calc_latency function
     """
 
@@ -89,19 +532,103 @@ async def schedule_request(request: Request, deadline: datetime.datetime, latenc
     await _go_to_deep_sleep(deadline)
 
     logger.info("making tcp connection")
-    async with request.make_connection() as conn:
+    async with WarmConnection(request) as warm:  # type: ignore
+        if trace:
+            trace.mark("connection_established")
         logger.info("connection is ready. waiting for deadline")
         time_to_send = deadline - datetime.timedelta(seconds=latency)
         logger.info(f"request will send at {time_to_send}")
+        planned_at = time_to_send.replace(tzinfo=datetime.timezone.utc).timestamp()
+        deadline_at = planned_at + latency
+        await _go_to_shallow_sleep(time_to_send)
+        conn = await warm.take()
+
+        async with AsyncExitStack() as sending:
+            if guard:
+                await sending.enter_async_context(guard())
+            t1 = time.time()
+            if trace:
+                trace.mark("fire")
+            async with request.send(conn, trace) as response:
+                t2 = time.time()
+                ORDER_FIRE_DELAY_SECONDS.observe(t1 - planned_at)
+                ORDER_ARRIVAL_ERROR_SECONDS.observe(t1 + (t2 - t1) * .5 - deadline_at)
+                if response_metric:
+                    response_metric.observe(t2 - t1)
+                logger.info(f"request sended at {datetime.datetime.utcfromtimestamp(t1)}")
+                logger.info(
+                    f"latency: {t2 - t1}s")
+                yield response
+
+
+async def schedule_requests(
+        requests: Sequence[AbstractRequest],
+        deadline: datetime.datetime,
+        latency: float = 0,
+        response_metric: Optional[HistogramChild] = None,
+        traces: Optional[Sequence[Optional[OrderTrace]]] = None,
+        guard: Optional[Callable[[], AsyncContextManager[None]]] = None,
+) -> List[Union[Tuple[int, str], BaseException]]:
+    """ schedule_request for several requests sharing a deadline.
+    One deep sleep, one busy wait and connections opened concurrently through one connector,
+    then every request is written in the same loop iteration, guard held around the writes.
+    Returns status and body, or the exception raised, of each request in order.
+    """
+
+    if not requests:
+        return []
+    logger.info(f"{len(requests)} requests scheduled for deadline: {deadline}")
+    traces = traces or [None] * len(requests)
+    await _go_to_deep_sleep(deadline)
+
+    logger.info("making tcp connections")
+    ssl_context = getattr(requests[0], 'ssl_context', None)
+    resolver = getattr(requests[0], 'resolver', None)
+    async with AsyncExitStack() as stack:
+        connector = await stack.enter_async_context(TCPConnector(ssl=ssl_context, limit=0, resolver=resolver))
+        warms = await asyncio.gather(
+            *(stack.enter_async_context(WarmConnection(request, connector)) for request in requests),  # type: ignore
+            return_exceptions=True,
+        )
+        for warm, trace in zip(warms, traces):
+            if trace and not isinstance(warm, BaseException):
+                trace.mark("connection_established")
+
+        time_to_send = deadline - datetime.timedelta(seconds=latency)
+        logger.info(f"connections are ready. requests will send at {time_to_send}")
+        planned_at = time_to_send.replace(tzinfo=datetime.timezone.utc).timestamp()
+        deadline_at = planned_at + latency
         await _go_to_shallow_sleep(time_to_send)
+        conns: List[Any] = []
+        for warm in warms:
+            try:
+                conns.append(warm if isinstance(warm, BaseException) else await warm.take())
+            except Exception as exc:
+                conns.append(exc)
 
-        logger.info(f"request sended at {datetime.datetime.utcnow()}")
         t1 = time.time()
-        async with request.send(conn) as response:
-            t2 = time.time()
-            logger.info(
-                f"latency: {t2 - t1}s")
-            yield response
+        ORDER_FIRE_DELAY_SECONDS.observe(t1 - planned_at)
+
+        async def fire(request: AbstractRequest, conn, trace: Optional[OrderTrace]) -> Tuple[int, str]:
+            if isinstance(conn, BaseException):
+                raise conn
+            if trace:
+                trace.mark("fire")
+            async with request.send(conn, trace) as response:
+                t2 = time.time()
+                ORDER_ARRIVAL_ERROR_SECONDS.observe(t1 + (t2 - t1) * .5 - deadline_at)
+                if response_metric:
+                    response_metric.observe(t2 - t1)
+                return response.status, await response.text()
+
+        if guard:
+            await stack.enter_async_context(guard())
+        results = await asyncio.gather(
+            *(fire(request, conn, trace) for request, conn, trace in zip(requests, conns, traces)),
+            return_exceptions=True,
+        )
+        logger.info(f"{len(requests)} requests sended at {datetime.datetime.utcfromtimestamp(t1)}")
+        return results
 
 
 async def _go_to_deep_sleep(deadline: datetime.datetime):
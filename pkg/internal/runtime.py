@@ -0,0 +1,74 @@
+import asyncio
+import concurrent.futures
+import ctypes
+import ctypes.util
+import logging
+import sys
+from typing import Any, Dict, Optional
+
+from pkg.config import RuntimeConfig
+
+logger = logging.getLogger('myapp')
+
+PR_SET_TIMERSLACK = 29
+
+
+def _base_policy(config: RuntimeConfig) -> type:
+    if config.loop == 'uvloop':
+        try:
+            import uvloop
+        except ImportError:
+            raise RuntimeError("runtime.loop is uvloop but uvloop isn't installed, pip install uvloop")
+        return uvloop.EventLoopPolicy
+    return asyncio.DefaultEventLoopPolicy
+
+
+def configure_loop(loop: asyncio.AbstractEventLoop, config: RuntimeConfig):
+    if config.executor_workers:
+        loop.set_default_executor(
+            concurrent.futures.ThreadPoolExecutor(max_workers=config.executor_workers))
+    # Timers due within the resolution run in the current iteration instead of the next one,
+    # only the stdlib loops have it
+    if config.clock_resolution is not None and hasattr(loop, '_clock_resolution'):
+        loop._clock_resolution = config.clock_resolution  # type: ignore
+
+
+def set_timer_slack(nanoseconds: int):
+    """ How late the kernel may wake up this process' timers, 50us by default on linux """
+    if not sys.platform.startswith('linux'):
+        logger.warning("runtime.timer_slack_ns is only supported on linux")
+        return
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.prctl(PR_SET_TIMERSLACK, ctypes.c_ulong(nanoseconds), 0, 0, 0) != 0:
+        logger.warning(f"setting timer slack failed with errno {ctypes.get_errno()}")
+
+
+def install_runtime(config: RuntimeConfig):
+    """ Make every loop created from now on, by asyncio.run, web.run_app or forked
+    processes, use the configured implementation and settings.
+    """
+
+    class TunedEventLoopPolicy(_base_policy(config)):  # type: ignore
+        def new_event_loop(self):
+            loop = super().new_event_loop()
+            configure_loop(loop, config)
+            return loop
+
+    asyncio.set_event_loop_policy(TunedEventLoopPolicy())
+    if config.timer_slack_ns is not None:
+        set_timer_slack(config.timer_slack_ns)
+
+
+def describe_runtime(loop: Optional[asyncio.AbstractEventLoop] = None) -> Dict[str, Any]:
+    """ The loop a fresh asyncio.run would get, for benchmark reports """
+    owned = loop is None
+    loop = loop or asyncio.new_event_loop()
+    try:
+        return {
+            'loop': f'{type(loop).__module__}.{type(loop).__qualname__}',
+            'clock_resolution': getattr(loop, '_clock_resolution', None),
+            'executor_workers': getattr(getattr(loop, '_default_executor', None), '_max_workers', None),
+        }
+    finally:
+        if owned:
+            loop.close()
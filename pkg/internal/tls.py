@@ -0,0 +1,47 @@
+import ssl
+from typing import Dict, Optional
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """ Client context offering the last TLS session of a host on the next handshake with it.
+
+    asyncio (and uvloop) never pass a session to the connections they wrap, so wrap_bio fills it in.
+    Sessions only resume on the context that created them, keep one per broker host for the life of
+    the process and share it between the prober, the endpoint probes and the order connections.
+    """
+
+    def __init__(self, protocol: int = ssl.PROTOCOL_TLS_CLIENT) -> None:
+        super().__init__()
+        self.sessions: Dict[str, ssl.SSLSession] = {}
+        # Latest connection per host, its session is only complete once the handshake (and for
+        # TLS 1.3 the ticket that follows it) went through
+        self.latest: Dict[str, ssl.SSLObject] = {}
+
+    def session_for(self, hostname: str) -> Optional[ssl.SSLSession]:
+        latest = self.latest.get(hostname)
+        if latest is not None:
+            try:
+                session = latest.session
+            except ValueError:
+                session = None
+            if session is not None and (session.has_ticket or session.id):
+                self.sessions[hostname] = session
+        return self.sessions.get(hostname)
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):  # type: ignore
+        if server_side or not server_hostname:
+            return super().wrap_bio(incoming, outgoing, server_side, server_hostname, session)
+        ssl_object = super().wrap_bio(
+            incoming, outgoing, server_side, server_hostname, session or self.session_for(server_hostname))
+        self.latest[server_hostname] = ssl_object
+        return ssl_object
+
+
+def create_client_context(cafile: Optional[str] = None) -> ResumingSSLContext:
+    """ ssl.create_default_context() for clients, resuming sessions """
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile:
+        context.load_verify_locations(cafile)
+    else:
+        context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+    return context
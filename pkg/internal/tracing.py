@@ -0,0 +1,52 @@
+import datetime
+import time
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Literal, Tuple
+
+TraceEvent = Literal[
+    "scheduled",
+    "deep_sleep_wake",
+    "relogin_start",
+    "relogin_end",
+    "armed",
+    "connection_established",
+    "triggered",
+    "fire",
+    "first_byte_written",
+    "response_headers",
+    "committed",
+    "rejected",
+    "failed",
+]
+
+
+@dataclass
+class OrderTrace:
+    """ Timeline of an order as time.monotonic_ns() timestamps.
+    The anchors taken together at creation map them back to wall clock time.
+    """
+    wall_anchor_ns: int = field(default_factory=time.time_ns)
+    monotonic_anchor_ns: int = field(default_factory=time.monotonic_ns)
+    events: List[Tuple[TraceEvent, int]] = field(default_factory=list)
+
+    def mark(self, event: TraceEvent):
+        self.events.append((event, time.monotonic_ns()))
+
+    def wall_time(self, monotonic_ns: int) -> datetime.datetime:
+        wall_ns = self.wall_anchor_ns + monotonic_ns - self.monotonic_anchor_ns
+        return datetime.datetime.utcfromtimestamp(wall_ns / 1e9)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'wall_anchor_ns': self.wall_anchor_ns,
+            'monotonic_anchor_ns': self.monotonic_anchor_ns,
+            'events': [[event, timestamp] for event, timestamp in self.events],
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "OrderTrace":
+        return cls(
+            wall_anchor_ns=data['wall_anchor_ns'],
+            monotonic_anchor_ns=data['monotonic_anchor_ns'],
+            events=[(event, timestamp) for event, timestamp in data['events']],
+        )
@@ -0,0 +1,509 @@
+""" In-memory storage made durable by an append-only journal.
+
+Every write is applied to plain dicts and appended to the journal as a record:
+a 4 byte big-endian payload length, the payload's 4 byte CRC32 and the pickled payload.
+A writer thread commits whatever accumulated every `commit_interval` seconds with a single
+write and fsync (group commit), so a crash loses at most that much. Once the journal grows
+past `compact_bytes` or gets older than `snapshot_interval` the whole state is written to a
+new snapshot and a fresh journal is started.
+
+Directory layout, N being the generation:
+    snapshot.N   state when journal.N was started, missing for generation 0
+    journal.N    records written since
+Recovery loads the newest snapshot, replays its journal and cuts off a torn last record.
+"""
+import dataclasses
+import datetime
+import logging
+import os
+import pickle
+import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from typing import Any, Callable, Dict, Iterable, List, Sequence, Tuple
+
+import aiohttp
+
+from pkg.internal.latencyprofile import LatencyBucket
+from pkg.internal.metrics import JOURNAL_COMMIT_SECONDS, STORAGE_QUERY_SECONDS
+from pkg.internal.tracing import OrderTrace
+from pkg.models import Account, Order, OrderStatus, PriceCondition
+from pkg.storage import AbstractStorage, DuplicateRecordError, RecordNotFoundError
+
+logger = logging.getLogger('myapp')
+
+_HEADER = struct.Struct('>II')
+_FILE_PATTERN = re.compile(r'^(journal|snapshot)\.(\d+)$')
+
+
+def encode_record(payload: Any) -> bytes:
+    data = pickle.dumps(payload, pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(len(data), zlib.crc32(data)) + data
+
+
+def decode_records(data: bytes) -> Tuple[List[Any], int]:
+    """ Records of a journal and the length of its intact prefix """
+    records = []
+    offset = 0
+    while offset + _HEADER.size <= len(data):
+        length, checksum = _HEADER.unpack_from(data, offset)
+        payload = data[offset + _HEADER.size:offset + _HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            break
+        records.append(pickle.loads(payload))
+        offset += _HEADER.size + length
+    return records, offset
+
+
+def path_from_url(url: str) -> str:
+    """ journal:///data/journal is relative like sqlite urls, journal:////data/journal absolute """
+    if not url.startswith('journal:///'):
+        raise ValueError(f'invalid journal url {url}')
+    return url[len('journal:///'):]
+
+
+class JournalStorage(AbstractStorage):
+    def __init__(
+            self,
+            path: str,
+            commit_interval: float = .005,
+            compact_bytes: int = 64 * 1024 * 1024,
+            snapshot_interval: float = 3600,
+            fsync: bool = True,
+    ) -> None:
+        self.path = path
+        self.commit_interval = commit_interval
+        self.compact_bytes = compact_bytes
+        self.snapshot_interval = snapshot_interval
+        self.fsync = fsync
+
+        # Rows are plain picklable data, the same in memory, in records and in snapshots
+        self.accounts: Dict[str, Dict[str, Any]] = {}
+        self.orders: Dict[uuid.UUID, Dict[str, Any]] = {}
+        self.scheduled: Dict[uuid.UUID, Dict[str, Any]] = {}
+        self.brokers: Dict[str, Dict[str, float]] = {}
+        self.latency_buckets: Dict[Tuple[str, datetime.date, int], LatencyBucket] = {}
+
+        self.appliers: Dict[str, Callable[..., None]] = {
+            'add_orders': self.__apply_add_orders,
+            'update_order_status': self.__apply_update_order_status,
+            'update_order_trace': self.__apply_update_order_trace,
+            'add_account': self.__apply_add_account,
+            'refresh_account': self.__apply_refresh_account,
+            'save_accounts': self.__apply_save_accounts,
+            'update_broker_latencies': self.__apply_update_broker_latencies,
+            'add_broker': self.__apply_add_broker,
+            'add_latency_buckets': self.__apply_add_latency_buckets,
+            'delete_latency_buckets': self.__apply_delete_latency_buckets,
+        }
+
+        # Held while the state changes, a snapshot sees every applied record and only those
+        self.state_lock = threading.Lock()
+        self.commit = threading.Condition()
+        self.pending: List[bytes] = []
+        self.enqueued = 0
+        self.durable = 0
+        self.closing = False
+
+        os.makedirs(path, exist_ok=True)
+        self.generation = self.__recover()
+        self.journal = open(self.__file('journal', self.generation), 'ab')
+        self.journal_size = self.journal.tell()
+        self.snapshot_at = time.monotonic()
+        self.writer = threading.Thread(target=self.__write_loop, name='journal-writer', daemon=True)
+        self.writer.start()
+
+    def migrate(self):
+        """ Nothing to migrate, rows are created as they're written """
+
+    def sync(self):
+        """ Wait until everything written so far is on disk """
+        with self.commit:
+            target = self.enqueued
+            self.commit.notify_all()
+            self.commit.wait_for(lambda: self.durable >= target or self.closing)
+
+    def close(self):
+        self.sync()
+        with self.commit:
+            self.closing = True
+            self.commit.notify_all()
+        self.writer.join()
+        self.journal.close()
+
+    def __file(self, kind: str, generation: int) -> str:
+        return os.path.join(self.path, f'{kind}.{generation}')
+
+    def __recover(self) -> int:
+        generations: Dict[str, List[int]] = {'journal': [], 'snapshot': []}
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                # A snapshot that was never completed
+                os.remove(os.path.join(self.path, name))
+                continue
+            match = _FILE_PATTERN.match(name)
+            if match:
+                generations[match.group(1)].append(int(match.group(2)))
+
+        generation = max(generations['snapshot'], default=0)
+        if generations['snapshot']:
+            with open(self.__file('snapshot', generation), 'rb') as fd:
+                (state,), _ = decode_records(fd.read())
+            self.accounts = state['accounts']
+            self.orders = state['orders']
+            self.brokers = state['brokers']
+            self.latency_buckets = state['latency_buckets']
+            self.scheduled = {
+                order_id: row for order_id, row in self.orders.items() if row['status'] == 'SCHEDULED'}
+
+        journal_path = self.__file('journal', generation)
+        if os.path.exists(journal_path):
+            with open(journal_path, 'rb') as fd:
+                data = fd.read()
+            records, intact = decode_records(data)
+            for operation, args in records:
+                self.appliers[operation](*args)
+            if intact < len(data):
+                logger.warning(f"journal {journal_path} has a torn tail, dropping its last {len(data) - intact} bytes")
+                with open(journal_path, 'r+b') as fd:
+                    fd.truncate(intact)
+            logger.info(f"replayed {len(records)} journal records of generation {generation}")
+
+        # Leftovers of a compaction that crashed before it was done
+        for kind, numbers in generations.items():
+            for number in numbers:
+                if number != generation:
+                    os.remove(self.__file(kind, number))
+        return generation
+
+    def __write(self, operation: str, *args: Any):
+        """ Apply a change and queue its record, raising before anything changed if it's invalid """
+        record = encode_record((operation, args))
+        with self.state_lock:
+            self.appliers[operation](*args)
+            with self.commit:
+                self.pending.append(record)
+                self.enqueued += 1
+                self.commit.notify_all()
+
+    def __write_loop(self):
+        while True:
+            with self.commit:
+                self.commit.wait_for(lambda: self.pending or self.closing)
+                if self.closing and not self.pending:
+                    return
+            # Let the writes of the next few milliseconds join this commit
+            time.sleep(self.commit_interval)
+            try:
+                self.__commit()
+                if self.journal_size > self.compact_bytes or (
+                        time.monotonic() - self.snapshot_at > self.snapshot_interval):
+                    self.__compact()
+            except Exception:
+                logger.exception("journal commit failed")
+                with self.commit:
+                    self.commit.wait(1)
+
+    def __flush(self, batch: List[bytes], enqueued: int):
+        if batch:
+            started = time.perf_counter()
+            data = b''.join(batch)
+            self.journal.write(data)
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            self.journal_size += len(data)
+            JOURNAL_COMMIT_SECONDS.observe(time.perf_counter() - started)
+        with self.commit:
+            self.durable = enqueued
+            self.commit.notify_all()
+
+    def __commit(self):
+        with self.commit:
+            batch, self.pending = self.pending, []
+            enqueued = self.enqueued
+        self.__flush(batch, enqueued)
+
+    def __compact(self):
+        with self.state_lock:
+            with self.commit:
+                batch, self.pending = self.pending, []
+                enqueued = self.enqueued
+            # Appliers only ever reassign a row's keys or replace values whole, copying the rows
+            # is enough to keep the state as of now
+            state = {
+                'accounts': {username: dict(row) for username, row in self.accounts.items()},
+                'orders': {order_id: dict(row) for order_id, row in self.orders.items()},
+                'brokers': dict(self.brokers),
+                'latency_buckets': dict(self.latency_buckets),
+            }
+        # Pickled outside the lock, writes go on meanwhile
+        snapshot = encode_record(state)
+        # Records already applied to the snapshot still go to the old journal, it's what recovery
+        # uses until the new snapshot is complete
+        self.__flush(batch, enqueued)
+
+        generation = self.generation + 1
+        snapshot_path = self.__file('snapshot', generation)
+        with open(snapshot_path + '.tmp', 'wb') as fd:
+            fd.write(snapshot)
+            fd.flush()
+            if self.fsync:
+                os.fsync(fd.fileno())
+        os.replace(snapshot_path + '.tmp', snapshot_path)
+
+        self.journal.close()
+        os.remove(self.__file('journal', self.generation))
+        if self.generation:
+            os.remove(self.__file('snapshot', self.generation))
+        self.generation = generation
+        self.journal = open(self.__file('journal', generation), 'ab')
+        self.journal_size = 0
+        self.snapshot_at = time.monotonic()
+        logger.info(f"journal compacted into a {len(snapshot)} bytes snapshot, generation {generation}")
+
+    # Appliers, shared by the writes and the recovery
+
+    def __apply_add_orders(self, rows: List[Dict[str, Any]]):
+        ids = [row['id'] for row in rows]
+        if len(set(ids)) != len(ids) or any(order_id in self.orders for order_id in ids):
+            raise DuplicateRecordError('order already exists')
+        for row in rows:
+            self.orders[row['id']] = row
+            if row['status'] == 'SCHEDULED':
+                self.scheduled[row['id']] = row
+
+    def __apply_update_order_status(self, order_id: uuid.UUID, status: OrderStatus):
+        row = self.orders.get(order_id)
+        if row is None:
+            return
+        row['status'] = status
+        if status == 'SCHEDULED':
+            self.scheduled[order_id] = row
+        else:
+            self.scheduled.pop(order_id, None)
+
+    def __apply_update_order_trace(self, order_id: uuid.UUID, trace: Dict[str, Any]):
+        row = self.orders.get(order_id)
+        if row is not None:
+            row['trace'] = trace
+
+    def __apply_add_account(self, row: Dict[str, Any]):
+        if row['username'] in self.accounts:
+            raise DuplicateRecordError(f"account {row['username']} already exists")
+        self.accounts[row['username']] = row
+
+    def __apply_refresh_account(
+            self, username: str, last_login: datetime.datetime, cookies: bytes, headers: Dict[str, str]):
+        row = self.accounts.get(username)
+        if row is not None:
+            row.update(last_login=last_login, cookies=cookies, headers=headers)
+
+    def __apply_save_accounts(self, rows: List[Dict[str, Any]]):
+        for row in rows:
+            known = self.accounts.get(row['username'])
+            if known is None:
+                self.accounts[row['username']] = row
+            else:
+                known.update(last_login=row['last_login'], cookies=row['cookies'], headers=row['headers'])
+
+    def __apply_update_broker_latencies(self, name: str, min_latency: float, max_latency: float, avg_latency: float):
+        if name in self.brokers:
+            self.brokers[name] = {'min_latency': min_latency, 'max_latency': max_latency, 'avg_latency': avg_latency}
+
+    def __apply_add_broker(self, name: str):
+        self.brokers[name] = {'min_latency': 0, 'max_latency': 0, 'avg_latency': 0}
+
+    def __apply_add_latency_buckets(self, buckets: List[LatencyBucket]):
+        for bucket in buckets:
+            key = (bucket.broker, bucket.day, bucket.minute)
+            stored = self.latency_buckets.get(key)
+            if stored:
+                count = stored.count + bucket.count
+                bucket = dataclasses.replace(
+                    bucket,
+                    count=count,
+                    min=min(stored.min, bucket.min),
+                    p50=(stored.p50 * stored.count + bucket.p50 * bucket.count) / count,
+                    p90=max(stored.p90, bucket.p90),
+                )
+            self.latency_buckets[key] = dataclasses.replace(bucket)
+
+    def __apply_delete_latency_buckets(self, broker_name: str, before: datetime.date):
+        for key in [key for key in self.latency_buckets if key[0] == broker_name and key[1] < before]:
+            del self.latency_buckets[key]
+
+    # Mapping between rows and models, rows are never handed out
+
+    def _order_row(self, order: Order) -> Dict[str, Any]:
+        return {
+            'id': order.id,
+            'broker': order.broker,
+            'isin': order.isin,
+            'count': order.count,
+            'price': order.price,
+            'status': order.status,
+            'username': order.username,
+            'deadline': order.deadline,
+            'group_id': order.group_id,
+            'condition': dataclasses.asdict(order.condition) if order.condition else None,
+            'trace': order.trace.to_dict(),
+        }
+
+    def _map_order(self, row: Dict[str, Any]) -> Order:
+        return Order(
+            id=row['id'],
+            broker=row['broker'],
+            isin=row['isin'],
+            count=row['count'],
+            price=row['price'],
+            status=row['status'],
+            username=row['username'],
+            deadline=row['deadline'],
+            group_id=row['group_id'],
+            condition=PriceCondition(**row['condition']) if row['condition'] else None,
+            trace=OrderTrace.from_dict(row['trace']),
+        )
+
+    def serialize_cookies(self, cookies: aiohttp.CookieJar) -> bytes:
+        return pickle.dumps(cookies._cookies, pickle.HIGHEST_PROTOCOL)
+
+    def deserialize_cookies(self, data: bytes) -> aiohttp.CookieJar:
+        cookies = aiohttp.CookieJar()
+        cookies._cookies = pickle.loads(data)
+        return cookies
+
+    def _map_account(self, row: Dict[str, Any]) -> Account:
+        return Account(
+            id=row['id'],
+            broker=row['broker'],
+            username=row['username'],
+            password=row['password'],
+            last_login=row['last_login'],
+            headers=dict(row['headers']),
+            cookies=self.deserialize_cookies(row['cookies']),
+        )
+
+    # AbstractStorage
+
+    @STORAGE_QUERY_SECONDS.labels('add_order').time()
+    def add_order(self, order: Order):
+        self.__write('add_orders', [self._order_row(order)])
+
+    @STORAGE_QUERY_SECONDS.labels('add_orders').time()
+    def add_orders(self, orders: Sequence[Order]):
+        self.__write('add_orders', [self._order_row(order) for order in orders])
+
+    @STORAGE_QUERY_SECONDS.labels('get_order_by_id').time()
+    def get_order_by_id(self, order_id: uuid.UUID) -> Order:
+        row = self.orders.get(order_id)
+        if row is None:
+            raise RecordNotFoundError(f'order by id {order_id} not found')
+        return self._map_order(row)
+
+    @STORAGE_QUERY_SECONDS.labels('get_scheduled_orders').time()
+    def get_scheduled_orders(self) -> Iterable[Order]:
+        now = datetime.datetime.utcnow()
+        rows = [row for row in self.scheduled.values() if row['deadline'] and row['deadline'] > now]
+        rows.sort(key=lambda row: row['deadline'])
+        return list(map(self._map_order, rows))
+
+    @STORAGE_QUERY_SECONDS.labels('update_order_status').time()
+    def update_order_status(self, order_id: uuid.UUID, new_status: OrderStatus):
+        self.__write('update_order_status', order_id, new_status)
+
+    @STORAGE_QUERY_SECONDS.labels('update_order_trace').time()
+    def update_order_trace(self, order_id: uuid.UUID, trace: OrderTrace):
+        self.__write('update_order_trace', order_id, trace.to_dict())
+
+    @STORAGE_QUERY_SECONDS.labels('add_account').time()
+    def add_account(self, account: Account):
+        """
+        Will raise DuplicateRecordError
+        """
+        self.__write('add_account', {
+            'id': account.id,
+            'broker': account.broker,
+            'username': account.username,
+            'password': account.password,
+            'last_login': datetime.datetime.utcnow(),
+            'headers': dict(account.headers),
+            'cookies': self.serialize_cookies(account.cookies),
+        })
+
+    @STORAGE_QUERY_SECONDS.labels('get_accounts').time()
+    def get_accounts(self) -> Iterable[Account]:
+        return list(map(self._map_account, list(self.accounts.values())))
+
+    @STORAGE_QUERY_SECONDS.labels('get_account_listing').time()
+    def get_account_listing(self) -> List[Tuple[str, str]]:
+        return [(row['username'], row['broker']) for row in list(self.accounts.values())]
+
+    @STORAGE_QUERY_SECONDS.labels('refresh_account').time()
+    def refresh_account(self, username: str, last_login: datetime.datetime, cookies: aiohttp.CookieJar, headers: Dict[str, str]):
+        self.__write('refresh_account', username, last_login, self.serialize_cookies(cookies), dict(headers))
+
+    @STORAGE_QUERY_SECONDS.labels('save_accounts').time()
+    def save_accounts(self, accounts: Sequence[Account]):
+        self.__write('save_accounts', [
+            {
+                'id': account.id,
+                'broker': account.broker,
+                'username': account.username,
+                'password': account.password,
+                'last_login': account.last_login,
+                'headers': dict(account.headers),
+                'cookies': self.serialize_cookies(account.cookies),
+            }
+            for account in accounts
+        ])
+
+    @STORAGE_QUERY_SECONDS.labels('get_account_by_username').time()
+    def get_account_by_username(self, username: str) -> Account:
+        row = self.accounts.get(username)
+        if row is None:
+            raise RecordNotFoundError("user not found")
+        return self._map_account(row)
+
+    @STORAGE_QUERY_SECONDS.labels('get_accounts_by_usernames').time()
+    def get_accounts_by_usernames(self, usernames: Sequence[str]) -> Dict[str, Account]:
+        return {
+            username: self._map_account(self.accounts[username])
+            for username in usernames if username in self.accounts
+        }
+
+    @STORAGE_QUERY_SECONDS.labels('get_broker_latency').time()
+    def get_broker_latency(self, broker_name: str) -> float:
+        broker = self.brokers.get(broker_name)
+        if broker is None:
+            raise RecordNotFoundError(f"broker with name {broker_name} not found")
+        return broker['min_latency']
+
+    @STORAGE_QUERY_SECONDS.labels('update_broker_latencies').time()
+    def update_broker_latencies(self, broker_name: str, min_latency: float, max_latency: float, avg_latency: float):
+        self.__write('update_broker_latencies', broker_name, min_latency, max_latency, avg_latency)
+
+    @STORAGE_QUERY_SECONDS.labels('add_broker').time()
+    def add_broker(self, broker_name: str):
+        self.__write('add_broker', broker_name)
+
+    @STORAGE_QUERY_SECONDS.labels('add_latency_buckets').time()
+    def add_latency_buckets(self, buckets: Sequence[LatencyBucket]):
+        self.__write('add_latency_buckets', list(buckets))
+
+    @STORAGE_QUERY_SECONDS.labels('get_latency_buckets').time()
+    def get_latency_buckets(
+            self, broker_name: str, minutes: Sequence[int], since: datetime.date) -> List[LatencyBucket]:
+        wanted = set(minutes)
+        return [
+            dataclasses.replace(bucket) for (broker, day, minute), bucket in list(self.latency_buckets.items())
+            if broker == broker_name and day >= since and minute in wanted
+        ]
+
+    @STORAGE_QUERY_SECONDS.labels('delete_latency_buckets').time()
+    def delete_latency_buckets(self, broker_name: str, before: datetime.date):
+        self.__write('delete_latency_buckets', broker_name, before)
+
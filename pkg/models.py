@@ -1,13 +1,15 @@
 import uuid
-from dataclasses import dataclass
-from typing import Dict, Literal
+from dataclasses import dataclass, field
+from typing import Dict, Literal, Optional
 import datetime
 
 import aiohttp
 
 from pkg.internal.brokers.abc import BrokerName
+from pkg.internal.tracing import OrderTrace
 
-OrderStatus = Literal["SCHEDULED", "DONE"]
+OrderStatus = Literal["SCHEDULED", "DONE", "FAILED", "EXPIRED", "REJECTED"]
+Direction = Literal["above", "below"]
 
 
 @dataclass
@@ -22,6 +24,13 @@ class Account:
     headers: Dict[str, str]
 
 
+@dataclass
+class PriceCondition:
+    """ Met once the last traded price reaches price from the given direction """
+    direction: Direction
+    price: int
+
+
 @dataclass
 class Order:
     id: uuid.UUID
@@ -30,3 +39,31 @@ class Order:
     count: int
     price: int
     status: OrderStatus
+    # Needed by the scheduler process to pick the order up from storage
+    username: Optional[str] = None
+    deadline: Optional[datetime.datetime] = None
+    # Orders placed together across accounts share it
+    group_id: Optional[uuid.UUID] = None
+    # Fire once it's met instead of at deadline, deadline is when the order expires then
+    condition: Optional[PriceCondition] = None
+    trace: OrderTrace = field(default_factory=OrderTrace)
+
+
+@dataclass
+class FanOutResult:
+    """ Outcome of scheduling one account's share of a multi account order """
+    username: str
+    order: Optional[Order] = None
+    error: Optional[str] = None
+
+
+@dataclass
+class LoginResult:
+    """ Outcome of logging in one account of a bulk login """
+    username: str
+    broker: BrokerName
+    attempts: int = 0
+    # From taking a slot to the last answer of the broker
+    seconds: float = 0
+    account: Optional[Account] = None
+    error: Optional[str] = None
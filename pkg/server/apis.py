@@ -1,10 +1,13 @@
 from aiohttp import web
 import json
 import datetime
+import uuid
+from typing import List
 from pkg.internal.brokers import BrokerName, BrokerError
-from pkg.storage import StorageError
+from pkg.models import Direction, PriceCondition
+from pkg.storage import RecordNotFoundError, StorageError
 import pydantic
-from pkg.server.utils import get_service
+from pkg.server.utils import get_service, json_response, read_json
 
 
 router = web.RouteTableDef()
@@ -15,24 +18,20 @@ async def get_account_balance_handler(request: web.Request):
     service = get_service(request)
     username = request.query.get('username')
     if not username:
-        return web.json_response({'message': 'username not found'})
+        return json_response({'message': 'username not found'})
 
-    return web.json_response(
+    return json_response(
         {'balance': await service.get_account_balance(username)})
 
 
-class AccountOut(pydantic.BaseModel):
-    username: str
-    broker: BrokerName
-
-
 @router.get('/api/accounts')
 async def get_accounts_handler(request: web.Request):
     service = get_service(request)
-    accounts = list(map(lambda account: AccountOut(username=account.username, broker=account.broker).dict(),
-                        await service.get_accounts()))
-
-    return web.json_response(accounts)
+    # Straight from the rows, no model per account
+    return json_response([
+        {'username': username, 'broker': broker}
+        for username, broker in await service.get_account_listing()
+    ])
 
 
 @router.get('/api/stocks')
@@ -40,9 +39,12 @@ async def get_stocks_handler(request: web.Request):
     service = get_service(request)
     stock_name = request.query.get('label')
     if not stock_name:
-        return web.json_response([])
+        return json_response([])
 
-    return web.json_response(await service.get_stock(stock_name))
+    broker = request.query.get('broker', 'TAVANA')
+    if broker not in service.brokers:
+        raise web.HTTPBadRequest(reason=f'unknown broker {broker}')
+    return json_response(await service.get_stock(stock_name, broker))  # type: ignore
 
 
 class OrderIn(pydantic.BaseModel):
@@ -64,16 +66,126 @@ class OrderIn(pydantic.BaseModel):
 @router.post('/api/order')
 async def order_api_handler(request: web.Request):
     service = get_service(request)
-    data = OrderIn(**(await request.json()))
+    data = OrderIn(**(await read_json(request)))
+
+    order = await service.schedule_order(
+        username=data.username,
+        deadline=data.deadline,
+        stock_count=data.count,
+        stock_price=data.price,
+        stock_isin=data.isin,
+    )
+    return json_response({'message': f'order scheduled for {data.deadline}', 'order_id': str(order.id)})
+
+
+class ConditionalOrderIn(pydantic.BaseModel):
+    username: str
+    # The order is dropped if the condition isn't met by then
+    expires_at: datetime.datetime
+    direction: Direction
+    trigger_price: int
+
+    count: int
+    price: int
+    isin: str
+
+    @pydantic.validator('expires_at')
+    def check_if_exceeded(cls, value):
+        expires_at = value.replace(tzinfo=None)
+        if expires_at < datetime.datetime.utcnow():
+            raise ValueError('already expired')
+        return expires_at
+
+
+@router.post('/api/orders/conditional')
+async def conditional_order_api_handler(request: web.Request):
+    service = get_service(request)
+    data = ConditionalOrderIn(**(await read_json(request)))
 
-    await service.schedule_order(
+    order = await service.schedule_conditional_order(
         username=data.username,
+        stock_isin=data.isin,
+        stock_count=data.count,
+        stock_price=data.price,
+        condition=PriceCondition(data.direction, data.trigger_price),
+        expires_at=data.expires_at,
+    )
+    return json_response({
+        'message': f'order fires once the price goes {data.direction} {data.trigger_price}',
+        'order_id': str(order.id),
+    })
+
+
+class GroupOrderIn(pydantic.BaseModel):
+    usernames: List[str]
+    deadline: datetime.datetime
+
+    count: int
+    price: int
+    isin: str
+
+    @pydantic.validator('deadline')
+    def check_if_exceeded(cls, value):
+        deadline = value.replace(tzinfo=None)
+        if deadline < datetime.datetime.utcnow():
+            raise ValueError('deadline exceeded')
+        return deadline
+
+    @pydantic.validator('usernames')
+    def check_not_empty(cls, value):
+        if not value:
+            raise ValueError('at least one username is required')
+        return value
+
+
+@router.post('/api/orders/group')
+async def group_order_api_handler(request: web.Request):
+    service = get_service(request)
+    data = GroupOrderIn(**(await read_json(request)))
+
+    results = await service.schedule_group_order(
+        usernames=data.usernames,
         deadline=data.deadline,
         stock_count=data.count,
         stock_price=data.price,
         stock_isin=data.isin,
     )
-    return web.json_response({'message': f'order scheduled for {data.deadline}'})
+    group_id = next((result.order.group_id for result in results if result.order), None)
+    return json_response({
+        'message': f'{sum(1 for result in results if result.order)} orders scheduled for {data.deadline}',
+        'group_id': str(group_id) if group_id else None,
+        'results': [
+            {
+                'username': result.username,
+                'order_id': str(result.order.id) if result.order else None,
+                'error': result.error,
+            }
+            for result in results
+        ],
+    })
+
+
+@router.get('/api/orders/{order_id}/trace')
+async def order_trace_handler(request: web.Request):
+    service = get_service(request)
+    try:
+        order_id = uuid.UUID(request.match_info['order_id'])
+    except ValueError:
+        raise web.HTTPBadRequest(reason='invalid order id')
+
+    try:
+        trace = await service.get_order_trace(order_id)
+    except RecordNotFoundError:
+        raise web.HTTPNotFound(reason='order not found')
+    events = []
+    for event, timestamp in trace.events:
+        events.append({
+            'event': event,
+            'monotonic_ns': timestamp,
+            'at': trace.wall_time(timestamp).isoformat(),
+            'elapsed_ms': (timestamp - trace.events[0][1]) / 1e6,
+        })
+    return json_response({'order_id': str(order_id), 'events': events})
 
 
 class BrokerLoginIn(pydantic.BaseModel):
@@ -86,9 +198,9 @@ class BrokerLoginIn(pydantic.BaseModel):
 async def login_api_handler(request: web.Request):
     service = get_service(request)
 
-    data = BrokerLoginIn(**(await request.json()))
+    data = BrokerLoginIn(**(await read_json(request)))
 
     await service.login(
         data.broker, data.username, data.password)
 
-    return web.json_response({'message': 'login successful'})
+    return json_response({'message': 'login successful'})
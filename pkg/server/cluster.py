@@ -0,0 +1,76 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+from typing import Callable, List
+
+from aiohttp import web
+
+from pkg.config import MainConfig
+from pkg.internal import jsoncodec
+from pkg.server.factory import create_scheduler_server, create_server
+from pkg.service import Service, ServiceRole
+
+logger = logging.getLogger('myapp')
+
+ServiceFactory = Callable[[MainConfig, ServiceRole], Service]
+
+
+def run_api_worker(config: MainConfig, service_factory: ServiceFactory):
+    logging.basicConfig(format=config.logging.format, level=config.logging.level)
+    jsoncodec.use(config.server.json_backend)
+    web.run_app(
+        create_server(service_factory(config, 'api'), admin_token=config.server.admin_token, profiling=config.profiling),
+        host=config.server.host,
+        port=config.server.port,
+        print=lambda _: None,
+        reuse_address=True,
+        reuse_port=True,
+    )
+
+
+def run_scheduler(config: MainConfig, service_factory: ServiceFactory):
+    logging.basicConfig(format=config.logging.format, level=config.logging.level)
+    web.run_app(
+        create_scheduler_server(
+            service_factory(config, 'scheduler'), admin_token=config.server.admin_token, profiling=config.profiling),
+        host=config.server.host,
+        port=config.server.scheduler_port,
+        print=lambda _: None,
+        reuse_address=True,
+    )
+
+
+def run_cluster(config: MainConfig, service_factory: ServiceFactory):
+    """ Run config.server.workers api processes on a shared port plus one scheduler process.
+    The api processes persist new orders and the scheduler picks them up from storage, so
+    request handling and captcha inference never compete with the loop that fires orders.
+    Returns once any of the processes exits, after stopping the rest.
+    """
+    processes: List[multiprocessing.Process] = [
+        multiprocessing.Process(target=run_scheduler, args=(config, service_factory), name='scheduler'),
+    ]
+    for n in range(config.server.workers):
+        processes.append(multiprocessing.Process(
+            target=run_api_worker, args=(config, service_factory), name=f'api-{n}'))
+
+    for process in processes:
+        process.start()
+    logger.info(f"started {config.server.workers} api processes and a scheduler, "
+                f"scheduler metrics on http://{config.server.host}:{config.server.scheduler_port}/metrics")
+
+    # Stopping the parent stops the whole cluster
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        multiprocessing.connection.wait([process.sentinel for process in processes])
+    except KeyboardInterrupt:
+        pass
+
+    for process in processes:
+        if process.exitcode is not None:
+            logger.warning(f"{process.name} process exited with {process.exitcode}")
+        else:
+            # web.run_app turns SIGTERM into a graceful shutdown
+            process.terminate()
+    for process in processes:
+        process.join()
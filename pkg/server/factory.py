@@ -1,18 +1,78 @@
 import logging
+from typing import Optional
 from aiohttp import web
 
+from pkg.config import ProfilingConfig
 from pkg.service import Service
 from pkg.server.apis import router as api_router
-from pkg.server.middleware import error_middleware
+from pkg.server.metrics import router as metrics_router
+from pkg.server.ws import router as ws_router
+from pkg.server.middleware import ResponseCache, critical_window_middleware, error_middleware
+from pkg.server.profiling import setup_profiling
 
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
-def create_server(service: Service) -> web.Application:
-    app = web.Application(middlewares=[error_middleware])
+def _bind_service(app: web.Application, service: Service):
     app['service'] = service
+
+    async def start_service(app: web.Application):
+        await service.start()
+
+    async def stop_service(app: web.Application):
+        await service.stop()
+
+    async def close_service(app: web.Application):
+        service.close()
+
+    app.on_startup.append(start_service)
+    # run_app waits for the tasks left running after on_shutdown, the service's never end by themselves
+    app.on_shutdown.append(stop_service)
+    app.on_cleanup.append(close_service)
+
+
+def _setup_profiling(app: web.Application, admin_token: Optional[str], profiling: Optional[ProfilingConfig]):
+    profiling = profiling or ProfilingConfig()
+    setup_profiling(
+        app,
+        admin_token=admin_token,
+        output_dir=profiling.output_dir,
+        interval=profiling.interval,
+        memory_frames=profiling.memory_frames,
+        trace_memory=profiling.trace_memory,
+    )
+
+
+def create_server(
+        service: Service,
+        statics_dir: Optional[str] = './statics',
+        admin_token: Optional[str] = None,
+        profiling: Optional[ProfilingConfig] = None,
+) -> web.Application:
+    app = web.Application(middlewares=[error_middleware, critical_window_middleware])
+    _bind_service(app, service)
+    app['response_cache'] = ResponseCache()
+
     app.add_routes(api_router)
-    app.add_routes([web.static('/', './statics')])
+    app.add_routes(metrics_router)
+    app.add_routes(ws_router)
+    _setup_profiling(app, admin_token, profiling)
+    if statics_dir:
+        # Catches every path, has to be the last route
+        app.add_routes([web.static('/', statics_dir)])
+    return app
+
+
+def create_scheduler_server(
+        service: Service,
+        admin_token: Optional[str] = None,
+        profiling: Optional[ProfilingConfig] = None,
+) -> web.Application:
+    """ The scheduler process serves no APIs, only its own metrics and profiles """
+    app = web.Application()
+    _bind_service(app, service)
+    app.add_routes(metrics_router)
+    _setup_profiling(app, admin_token, profiling)
     return app
@@ -0,0 +1,13 @@
+from aiohttp import web
+
+from pkg.internal.metrics import REGISTRY
+
+router = web.RouteTableDef()
+
+
+@router.get('/metrics')
+async def metrics_handler(request: web.Request):
+    return web.Response(
+        body=REGISTRY.render().encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'},
+    )
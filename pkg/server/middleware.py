@@ -1,9 +1,13 @@
 import json
+import math
+from collections import OrderedDict
 from typing import Any, Dict, List, Literal, Union
 import pydantic
 from aiohttp import web
 from pkg.storage import StorageError
-from pkg.internal.brokers import BrokerError
+from pkg.internal.brokers import BrokerError, RateLimitedError
+from pkg.internal.metrics import DEFERRED_REQUESTS
+from pkg.server.utils import get_service, json_response
 from dataclasses import dataclass, asdict
 
 ErrorLevel = Literal["STORAGE", "BROKER", "SERVICE", "JSON", "VALIDATION", "HTTP"]
@@ -26,29 +30,93 @@ async def error_middleware(request: web.Request, handler) -> web.Response:
     try:
         return await handler(request)
     except web.HTTPException as exc:
-        return web.json_response(
-            data=asdict(ErrorResponse(level="HTTP", message=exc.reason)),
+        return json_response(
+            ErrorResponse(level="HTTP", message=exc.reason),
             status=exc.status
         )
     except json.JSONDecodeError as exc:
-        return web.json_response(
-            data=asdict(ErrorResponse(level="JSON", message=str(exc))),
+        return json_response(
+            ErrorResponse(level="JSON", message=str(exc)),
             status=400
         )
     except pydantic.ValidationError as exc:
-        return web.json_response(
-            asdict(ErrorResponse(level="VALIDATION", message=exc.errors())),
+        return json_response(
+            ErrorResponse(level="VALIDATION", message=exc.errors()),
             status=422
         )
     except StorageError as exc:
-        return web.json_response(
-            asdict(ErrorResponse(level="STORAGE", message=str(exc))),
+        return json_response(
+            ErrorResponse(level="STORAGE", message=str(exc)),
             status=400
         )
+    except RateLimitedError as exc:
+        return json_response(
+            ErrorResponse(level="BROKER", message=str(exc)),
+            status=503
+        )
     except BrokerError as exc:
-        return web.json_response(
-            asdict(ErrorResponse(level="BROKER", message=str(exc))),
+        return json_response(
+            ErrorResponse(level="BROKER", message=str(exc)),
             status=400
         )
     except Exception as exc:
         raise exc
+
+
+# Calls that can wait until an order deadline has passed
+DEFERRABLE_PATHS = {'/api/balance', '/api/stocks', '/api/accounts', '/api/login'}
+# Deferrable calls answered with their last response meanwhile
+CACHEABLE_PATHS = {'/api/balance', '/api/stocks', '/api/accounts'}
+
+
+class ResponseCache:
+    """ Last successful response body per path and query string, least recently used evicted """
+
+    def __init__(self, maxsize: int = 1024) -> None:
+        self.maxsize = maxsize
+        self.bodies: OrderedDict[str, bytes] = OrderedDict()
+
+    def get(self, key: str) -> Union[bytes, None]:
+        body = self.bodies.get(key)
+        if body is not None:
+            self.bodies.move_to_end(key)
+        return body
+
+    def put(self, key: str, body: bytes):
+        self.bodies[key] = body
+        self.bodies.move_to_end(key)
+        if len(self.bodies) > self.maxsize:
+            self.bodies.popitem(last=False)
+
+
+@web.middleware
+async def critical_window_middleware(request: web.Request, handler) -> web.StreamResponse:
+    """ Keep non-essential API calls off the loop while an armed deadline is near """
+    if request.path not in DEFERRABLE_PATHS:
+        return await handler(request)
+
+    cache: ResponseCache = request.app['response_cache']
+    critical_window = get_service(request).critical_window
+    if critical_window.is_active():
+        body = cache.get(request.path_qs) if request.method == 'GET' else None
+        if body is not None:
+            DEFERRED_REQUESTS.labels(request.path, 'cache').inc()
+            return web.Response(body=body, content_type='application/json', headers={'X-From-Cache': '1'})
+
+        DEFERRED_REQUESTS.labels(request.path, 'unavailable').inc()
+        return json_response(
+            ErrorResponse(level="SERVICE", message='an order deadline is near, retry later'),
+            status=503,
+            headers={'Retry-After': str(math.ceil(critical_window.remaining()))},
+        )
+
+    response = await handler(request)
+    if (
+        request.method == 'GET'
+        and request.path in CACHEABLE_PATHS
+        and response.status == 200
+        and isinstance(response, web.Response)
+        and isinstance(response.body, bytes)
+    ):
+        cache.put(request.path_qs, response.body)
+    return response
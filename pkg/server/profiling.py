@@ -0,0 +1,142 @@
+import hmac
+import json
+import logging
+import os
+from typing import Optional
+
+from aiohttp import web
+
+from pkg.internal.captcha import CaptchaSolver
+from pkg.internal.brokers import TavanaBroker
+from pkg.internal.profiler import MemoryProfiler, SamplingProfiler
+from pkg.journal import JournalStorage
+from pkg.service import Service
+from pkg.storage import SqliteStorage
+from pkg.server.utils import json_response
+
+logger = logging.getLogger('myapp')
+
+router = web.RouteTableDef()
+
+# Where the wall time of a slow open goes
+COMPONENTS = (Service, TavanaBroker, CaptchaSolver, SqliteStorage, JournalStorage)
+
+
+def setup_profiling(
+        app: web.Application,
+        admin_token: Optional[str] = None,
+        output_dir: Optional[str] = None,
+        interval: float = .01,
+        memory_frames: int = 16,
+        trace_memory: bool = False,
+):
+    """ Serve the /admin/profile endpoints to holders of admin_token, none without one.
+    With output_dir the profilers run from startup and write what they collected there on cleanup.
+    """
+    app['admin_token'] = admin_token
+    app['profiler'] = SamplingProfiler(interval, COMPONENTS)
+    app['memory_profiler'] = MemoryProfiler(memory_frames)
+    app.add_routes(router)
+    if not output_dir:
+        return
+
+    async def start_profiling(app: web.Application):
+        app['profiler'].start()
+        if trace_memory:
+            app['memory_profiler'].start()
+
+    async def write_profiles(app: web.Application):
+        profiler: SamplingProfiler = app['profiler']
+        memory_profiler: MemoryProfiler = app['memory_profiler']
+        profiler.stop()
+        os.makedirs(output_dir, exist_ok=True)
+        prefix = os.path.join(output_dir, f"{app['service'].role}-{os.getpid()}")
+        for view in ('tasks', 'threads'):
+            with open(f'{prefix}.{view}.collapsed', 'w') as fd:
+                fd.write(profiler.collapsed(view))  # type: ignore
+        with open(f'{prefix}.summary.json', 'w') as fd:
+            json.dump(profiler.summary(), fd, indent=2)
+        if memory_profiler.running:
+            with open(f'{prefix}.memory.collapsed', 'w') as fd:
+                fd.write(memory_profiler.collapsed(memory_profiler.snapshot()))
+            memory_profiler.stop()
+        logger.info(f"profiles written to {prefix}.*")
+
+    # Before the service starts, so a slow start shows up too
+    app.on_startup.insert(0, start_profiling)
+    app.on_cleanup.append(write_profiles)
+
+
+def require_admin(request: web.Request):
+    token = request.app['admin_token']
+    if not token:
+        raise web.HTTPNotFound()
+    given = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(given.encode(), f'Bearer {token}'.encode()):
+        raise web.HTTPUnauthorized()
+
+
+@router.post('/admin/profile/start')
+async def start_profile_handler(request: web.Request):
+    """ Start sampling, ?reset=1 drops what earlier runs collected """
+    require_admin(request)
+    profiler: SamplingProfiler = request.app['profiler']
+    if request.query.get('reset'):
+        profiler.reset()
+    if 'interval' in request.query:
+        profiler.interval = float(request.query['interval'])
+    profiler.start()
+    return json_response({'running': True, 'interval': profiler.interval})
+
+
+@router.post('/admin/profile/stop')
+async def stop_profile_handler(request: web.Request):
+    require_admin(request)
+    profiler: SamplingProfiler = request.app['profiler']
+    profiler.stop()
+    return json_response({'running': False, **profiler.summary()})
+
+
+@router.get('/admin/profile')
+async def get_profile_handler(request: web.Request):
+    """ Collapsed stacks of ?view=tasks (default) or threads, for flamegraph.pl """
+    require_admin(request)
+    view = request.query.get('view', 'tasks')
+    if view not in ('tasks', 'threads'):
+        raise web.HTTPBadRequest(reason='view is tasks or threads')
+    return web.Response(text=request.app['profiler'].collapsed(view))
+
+
+@router.get('/admin/profile/summary')
+async def get_profile_summary_handler(request: web.Request):
+    """ Wall and cpu seconds per component """
+    require_admin(request)
+    profiler: SamplingProfiler = request.app['profiler']
+    return json_response({'running': profiler.running, **profiler.summary()})
+
+
+@router.post('/admin/memory/start')
+async def start_memory_handler(request: web.Request):
+    require_admin(request)
+    request.app['memory_profiler'].start()
+    return json_response({'running': True})
+
+
+@router.post('/admin/memory/stop')
+async def stop_memory_handler(request: web.Request):
+    require_admin(request)
+    request.app['memory_profiler'].stop()
+    return json_response({'running': False})
+
+
+@router.get('/admin/memory')
+async def get_memory_handler(request: web.Request):
+    """ A tracemalloc snapshot, ?format=collapsed (default) bytes per stack or top lines as JSON """
+    require_admin(request)
+    memory_profiler: MemoryProfiler = request.app['memory_profiler']
+    if not memory_profiler.running:
+        raise web.HTTPConflict(reason='memory tracing is not running')
+    snapshot = memory_profiler.snapshot()
+    if request.query.get('format') == 'top':
+        return json_response(memory_profiler.top(snapshot, int(request.query.get('limit', 25))))
+    return web.Response(text=memory_profiler.collapsed(snapshot))
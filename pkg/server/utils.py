@@ -1,5 +1,8 @@
+from typing import Any, Mapping, Optional
+
 from aiohttp import web
 import jinja2
+from pkg.internal import jsoncodec
 from pkg.service import Service
 
 
@@ -9,3 +12,12 @@ def get_service(request: web.Request) -> Service:
 
 def get_jinja(request: web.Request) -> jinja2.Environment:
     return request.app['template_engine']
+
+
+def json_response(data: Any, status: int = 200, headers: Optional[Mapping[str, str]] = None) -> web.Response:
+    """ web.json_response through the configured JSON codec """
+    return web.Response(body=jsoncodec.dumps(data), status=status, headers=headers, content_type='application/json')
+
+
+async def read_json(request: web.Request) -> Any:
+    return jsoncodec.loads(await request.read())
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+
+from aiohttp import WSMsgType, web
+
+from pkg.internal import jsoncodec
+from pkg.internal.events import TOPICS, Subscription
+from pkg.internal.metrics import WS_CONNECTIONS
+from pkg.server.utils import get_service
+
+logger = logging.getLogger('myapp')
+
+router = web.RouteTableDef()
+
+
+async def _forward(ws: web.WebSocketResponse, subscription: Subscription):
+    while True:
+        events, dropped = await subscription.get()
+        if dropped:
+            await ws.send_str(jsoncodec.dumps({'topic': 'dropped', 'data': {'count': dropped}}).decode())
+        for event in events:
+            await ws.send_str(jsoncodec.dumps({'topic': event.topic, 'data': event.data}).decode())
+
+
+@router.get('/ws')
+async def websocket_handler(request: web.Request):
+    """ Pushes events instead of being polled.
+    ?topic= orders, balances or stats, repeatable, all of them by default
+    ?username= accounts to follow, repeatable, every account by default. Balances are only
+    fetched for the accounts some client follows explicitly.
+    """
+    service = get_service(request)
+    topics = request.query.getall('topic', list(TOPICS))
+    unknown = set(topics) - set(TOPICS)
+    if unknown:
+        raise web.HTTPBadRequest(reason=f'unknown topics {sorted(unknown)}')
+
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    WS_CONNECTIONS.inc()
+
+    subscription = service.events.subscribe(topics, request.query.getall('username', []))  # type: ignore
+    forwarder = asyncio.create_task(_forward(ws, subscription))
+    try:
+        # Clients only ever close, reading is what notices it
+        async for message in ws:
+            if message.type == WSMsgType.ERROR:
+                logger.warning(f"websocket closed with {ws.exception()}")
+    finally:
+        service.events.unsubscribe(subscription)
+        forwarder.cancel()
+        try:
+            await forwarder
+        except (asyncio.CancelledError, ConnectionResetError):
+            pass
+    return ws
@@ -1,21 +1,98 @@
 import asyncio
 import datetime
+import itertools
 import logging
+import time
 import uuid
-from typing import Dict, Iterable
+from typing import Any, Dict, Iterable, List, Literal, Optional, Sequence, Tuple, Union
 
 from pkg.internal.brokers import AbstractBroker, BrokerName
-from pkg.internal.brokers.exceptions import AuthenticationError
-from pkg.models import Account, Order
+from pkg.internal.brokers.exceptions import AuthenticationError, RateLimitedError
+from pkg.internal.critical import CriticalWindow
+from pkg.internal.events import EventHub
+from pkg.internal.looplag import LoopLagMonitor
+from pkg.internal.marketdata import MarketDataEngine
+from pkg.internal.metrics import LOGIN_ATTEMPTS, ORDERS, TRIGGER_FIRE_DELAY_SECONDS
+from pkg.internal.pending import PendingOrder, PendingOrders
+from pkg.internal.tracing import OrderTrace
+from pkg.models import Account, FanOutResult, LoginResult, Order, PriceCondition
 from pkg.storage import AbstractStorage, RecordNotFoundError
 
 logger = logging.getLogger('myapp')
 
+# standalone: serves the APIs and fires the orders it schedules, the single process mode
+# api: only persists new orders, a scheduler process picks them up from storage
+# scheduler: fires every scheduled order found in storage
+ServiceRole = Literal['standalone', 'api', 'scheduler']
+
 
 class Service:
-    def __init__(self, storage: AbstractStorage, brokers: Dict[BrokerName, AbstractBroker]) -> None:
+    def __init__(
+            self,
+            storage: AbstractStorage,
+            brokers: Dict[BrokerName, AbstractBroker],
+            critical_window: Optional[CriticalWindow] = None,
+            role: ServiceRole = 'standalone',
+            poll_interval: float = .5,
+            market_data: Optional[Dict[BrokerName, MarketDataEngine]] = None,
+            events: Optional[EventHub] = None,
+            balance_interval: float = 30,
+            stats_interval: float = 5,
+    ) -> None:
         self.storage = storage
         self.brokers = brokers
+        self.role = role
+        self.poll_interval = poll_interval
+        self.poll_task: Optional[asyncio.Task] = None
+        # Orders whose worker is still running, their trace is only persisted once it's done
+        self.pending_orders: Dict[uuid.UUID, Order] = {}
+        # Orders with a deadline, compact until they wake up and get a worker
+        self.scheduled_orders = PendingOrders(self.__wake_orders)
+        self.critical_window = critical_window or CriticalWindow(LoopLagMonitor())
+        # Price pollers of the brokers, created with defaults for the ones missing
+        self.market_data = market_data or {}
+        # Pushes to the /ws clients of this process
+        self.events = events or EventHub()
+        self.balance_interval = balance_interval
+        self.stats_interval = stats_interval
+        self.push_tasks: List[asyncio.Task] = []
+
+    async def start(self):
+        """ Start the background monitors, call it from inside the running loop """
+        self.critical_window.monitor.start()
+        self.critical_window.start()
+        if self.role == 'scheduler' and self.poll_task is None:
+            self.poll_task = asyncio.create_task(self.__poll_scheduled_orders())
+        if self.role != 'scheduler' and not self.push_tasks:
+            self.push_tasks = [
+                asyncio.create_task(self.__push_balances()),
+                asyncio.create_task(self.__push_stats()),
+            ]
+
+    async def stop(self):
+        """ Stop the background work, the storage stays open for the requests still being handled """
+        await self.scheduled_orders.stop()
+        for engine in self.market_data.values():
+            await engine.stop()
+        for broker in self.brokers.values():
+            await broker.close()
+        if self.poll_task:
+            self.poll_task.cancel()
+            try:
+                await self.poll_task
+            except asyncio.CancelledError:
+                pass
+            self.poll_task = None
+        for task in self.push_tasks:
+            task.cancel()
+        await asyncio.gather(*self.push_tasks, return_exceptions=True)
+        self.push_tasks = []
+        await self.critical_window.stop()
+        await self.critical_window.monitor.stop()
+
+    def close(self):
+        """ After stop(), the brokers flush their latency profiles to the storage """
+        self.storage.close()
 
     def get_broker(self, name: BrokerName) -> AbstractBroker:
         self.storage
@@ -24,19 +101,29 @@ class Service:
             raise KeyError('invalid broker name')
         return broker
 
+    def get_market_data(self, broker: AbstractBroker) -> MarketDataEngine:
+        if broker.name not in self.market_data:
+            self.market_data[broker.name] = MarketDataEngine(broker)
+        return self.market_data[broker.name]
+
     async def get_random_user_agent(self) -> str:
         return 'Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:109.0) Gecko/20100101 Firefox/111.0'
 
     async def get_accounts(self) -> Iterable[Account]:
         return self.storage.get_accounts()
 
+    async def get_account_listing(self) -> List[Tuple[str, str]]:
+        return self.storage.get_account_listing()
+
     async def get_account_balance(self, username: str) -> int:
         account = self.storage.get_account_by_username(username)
         broker = self.get_broker(account.broker)
-        return await broker.get_account_balance(account.headers, account.cookies)
+        balance = await broker.get_account_balance(account.headers, account.cookies)
+        self.events.publish('balances', {'username': username, 'balance': balance}, username)
+        return balance
 
-    async def get_stock(self, stock_name: str) -> Dict[str, str]:
-        broker = self.get_broker('TAVANA')
+    async def get_stock(self, stock_name: str, broker_name: BrokerName = 'TAVANA') -> Dict[str, str]:
+        broker = self.get_broker(broker_name)
         return await broker.get_stock(stock_name)
 
     async def login(self, broker_name: BrokerName, username: str, password: str) -> Account:
@@ -52,23 +139,93 @@ class Service:
         )
 
         try:
-            account = self.storage.get_account_by_username(username)
-            self.storage.refresh_account(username, datetime.datetime.utcnow(), cookies, headers)
+            known: Optional[Account] = self.storage.get_account_by_username(username)
         except RecordNotFoundError:
-            account = Account(
-                id=uuid.uuid4(),
-                broker=broker_name,
-                username=username,
-                password=password,
-                last_login=datetime.datetime.utcnow(),
-                cookies=cookies,
-                headers=headers,
-            )
+            known = None
 
+        # The new session, callers fire with it right away
+        account = Account(
+            id=known.id if known else uuid.uuid4(),
+            broker=broker_name,
+            username=username,
+            password=password,
+            last_login=datetime.datetime.utcnow(),
+            cookies=cookies,
+            headers=headers,
+        )
+        if known:
+            self.storage.refresh_account(username, account.last_login, cookies, headers)
+        else:
             self.storage.add_account(account)
 
         return account
 
+    async def login_all(
+            self,
+            credentials: Sequence[Tuple[BrokerName, str, str]],
+            concurrency: int = 20,
+            attempts: int = 3,
+            retry_delay: float = .5,
+    ) -> List[LoginResult]:
+        """ Log in every (broker, username, password) at most concurrency at a time.
+        A misread captcha is retried after retry_delay, up to attempts times. The sessions of the
+        accounts that got in are written together once all are done, failures get an error instead.
+        """
+
+        semaphore = asyncio.Semaphore(concurrency)
+        user_agent = await self.get_random_user_agent()
+
+        async def login_one(broker_name: BrokerName, username: str, password: str) -> LoginResult:
+            result = LoginResult(username, broker_name)
+            if broker_name not in self.brokers:
+                result.error = f'broker {broker_name} is not available'
+                return result
+            broker = self.get_broker(broker_name)
+
+            async with semaphore:
+                started = time.perf_counter()
+                while result.attempts < attempts:
+                    result.attempts += 1
+                    try:
+                        headers, cookies = await broker.login(username, password, user_agent)
+                    except AuthenticationError:
+                        if result.attempts < attempts:
+                            await asyncio.sleep(retry_delay)
+                        continue
+                    except Exception as exc:
+                        logger.warning(f"logging {username} in failed", exc_info=True)
+                        result.error = repr(exc)
+                        break
+                    result.account = Account(
+                        id=uuid.uuid4(),
+                        broker=broker_name,
+                        username=username,
+                        password=password,
+                        last_login=datetime.datetime.utcnow(),
+                        cookies=cookies,
+                        headers=headers,
+                    )
+                    break
+                else:
+                    result.error = f"can't authenticate after {attempts} attempts"
+                result.seconds = time.perf_counter() - started
+
+            # Lands in the +Inf bucket when every attempt failed
+            LOGIN_ATTEMPTS.labels(broker_name).observe(result.attempts if result.account else attempts + 1)
+            return result
+
+        results = await asyncio.gather(*(login_one(*credential) for credential in credentials))
+
+        accounts = [result.account for result in results if result.account]
+        # Known accounts keep their id, only their session is refreshed
+        known = self.storage.get_accounts_by_usernames([account.username for account in accounts])
+        for account in accounts:
+            if account.username in known:
+                account.id = known[account.username].id
+        if accounts:
+            self.storage.save_accounts(accounts)
+        return list(results)
+
     async def schedule_order(
             self,
             username: str,
@@ -76,7 +233,7 @@ class Service:
             stock_count: int,
             stock_price: int,
             deadline: datetime.datetime
-    ):
+    ) -> Order:
         """ 
         raises: AccountNotFound
         """
@@ -91,13 +248,186 @@ class Service:
             count=stock_count,
             price=stock_price,
             status='SCHEDULED',
+            username=username,
+            deadline=deadline,
+        )
+        order.trace.mark("scheduled")
+
+        self.storage.add_order(order)
+        self.__publish_order(order, "scheduled")
+        if self.role == 'api':
+            logger.info(f"order {order.id} for {deadline} handed over to the scheduler")
+            return order
+
+        self.__dispatch(broker, [account], [order], deadline)
+        return order
+
+    async def schedule_conditional_order(
+            self,
+            username: str,
+            stock_isin: str,
+            stock_count: int,
+            stock_price: int,
+            condition: PriceCondition,
+            expires_at: datetime.datetime,
+    ) -> Order:
+        """ Fire the order as soon as the price meets condition, give up at expires_at
+        raises: AccountNotFound
+        """
+
+        account = self.storage.get_account_by_username(username)
+        broker = self.get_broker(account.broker)
+
+        order = Order(
+            id=uuid.uuid4(),
+            broker=account.broker,
+            isin=stock_isin,
+            count=stock_count,
+            price=stock_price,
+            status='SCHEDULED',
+            username=username,
+            deadline=expires_at,
+            condition=condition,
         )
+        order.trace.mark("scheduled")
 
         self.storage.add_order(order)
+        self.__publish_order(order, "scheduled")
+        if self.role == 'api':
+            logger.info(f"conditional order {order.id} handed over to the scheduler")
+            return order
 
-        asyncio.create_task(
-            self.__schedule_order_worker(broker, account, order, deadline))
-        logger.info(f"task scheduled for {deadline}")
+        self.__dispatch(broker, [account], [order], expires_at)
+        return order
+
+    async def schedule_group_order(
+            self,
+            usernames: List[str],
+            stock_isin: str,
+            stock_count: int,
+            stock_price: int,
+            deadline: datetime.datetime
+    ) -> List[FanOutResult]:
+        """ The same order for every account, armed and fired together per broker.
+        Accounts that can't place it get an error in their result instead of failing the rest.
+        """
+
+        usernames = list(dict.fromkeys(usernames))
+        accounts = self.storage.get_accounts_by_usernames(usernames)
+        group_id = uuid.uuid4()
+
+        results: List[FanOutResult] = []
+        groups: Dict[BrokerName, Tuple[List[Account], List[Order]]] = {}
+        for username in usernames:
+            account = accounts.get(username)
+            if not account:
+                results.append(FanOutResult(username, error='account not found'))
+                continue
+            if account.broker not in self.brokers:
+                results.append(FanOutResult(username, error=f'broker {account.broker} is not available'))
+                continue
+
+            order = Order(
+                id=uuid.uuid4(),
+                broker=account.broker,
+                isin=stock_isin,
+                count=stock_count,
+                price=stock_price,
+                status='SCHEDULED',
+                username=username,
+                deadline=deadline,
+                group_id=group_id,
+            )
+            order.trace.mark("scheduled")
+            group_accounts, group_orders = groups.setdefault(account.broker, ([], []))
+            group_accounts.append(account)
+            group_orders.append(order)
+            results.append(FanOutResult(username, order=order))
+
+        self.storage.add_orders([order for _, orders in groups.values() for order in orders])
+        for _, group_orders in groups.values():
+            for order in group_orders:
+                self.__publish_order(order, "scheduled")
+        if self.role == 'api':
+            logger.info(f"order group {group_id} for {deadline} handed over to the scheduler")
+            return results
+
+        for broker_name, (group_accounts, group_orders) in groups.items():
+            self.__dispatch(self.get_broker(broker_name), group_accounts, group_orders, deadline)
+        return results
+
+    def __dispatch(
+        self,
+        broker: AbstractBroker,
+        accounts: List[Account],
+        orders: List[Order],
+        deadline: datetime.datetime,
+    ):
+        if orders[0].condition:
+            # Conditional orders are never grouped, they have no deadline to arm either
+            order, = orders
+            self.pending_orders[order.id] = order
+            asyncio.create_task(self.__conditional_order_worker(broker, accounts[0], order))
+            logger.info(f"order {order.id} waits for price {order.condition.direction} {order.condition.price}")
+            return
+
+        for order in orders:
+            self.critical_window.arm(deadline)
+        self.scheduled_orders.add(orders)
+        logger.info(f"{len(orders)} orders scheduled for {deadline}")
+
+    def __wake_orders(self, pending: List[PendingOrder]):
+        """ Where a scheduled order becomes an Order with a running worker """
+        orders = [order.to_order() for order in pending]
+        for order in orders:
+            self.pending_orders[order.id] = order
+        asyncio.create_task(self.__schedule_order_worker(
+            self.get_broker(pending[0].broker), orders, pending[0].deadline))
+
+    async def __poll_scheduled_orders(self):
+        """ Pick up the orders persisted by the api processes """
+        while True:
+            try:
+                orders = [
+                    order for order in self.storage.get_scheduled_orders()
+                    if order.id not in self.pending_orders and order.id not in self.scheduled_orders
+                    and order.username and order.deadline
+                ]
+                accounts = self.storage.get_accounts_by_usernames(
+                    [order.username for order in orders])  # type: ignore
+            except Exception:
+                logger.exception("polling scheduled orders failed")
+                orders, accounts = [], {}
+
+            # Orders of a group are only picked up together, they're inserted in one transaction
+            groups: Dict[Tuple[uuid.UUID, BrokerName], Tuple[List[Account], List[Order]]] = {}
+            for order in orders:
+                account = accounts.get(order.username)  # type: ignore
+                if not account or account.broker not in self.brokers:
+                    logger.error(f"order {order.id} can't be scheduled, account or broker not found")
+                    self.storage.update_order_status(order.id, 'FAILED')
+                    continue
+                group_accounts, group_orders = groups.setdefault(
+                    (order.group_id or order.id, account.broker), ([], []))
+                group_accounts.append(account)
+                group_orders.append(order)
+
+            for (_, broker_name), (group_accounts, group_orders) in groups.items():
+                self.__dispatch(
+                    self.get_broker(broker_name), group_accounts, group_orders, group_orders[0].deadline)  # type: ignore
+            await asyncio.sleep(self.poll_interval)
+
+    async def get_order_trace(self, order_id: uuid.UUID) -> OrderTrace:
+        """ 
+        raises: RecordNotFoundError
+        """
+        order = self.pending_orders.get(order_id)
+        if order:
+            return order.trace
+        scheduled = self.scheduled_orders.get(order_id)
+        if scheduled:
+            return scheduled.trace()
+        return self.storage.get_order_by_id(order_id).trace
 
     async def __attempt_for_login(self, broker_name: BrokerName, username: str, password: str) -> Account:
         """ Try to login the account. but since captcha solver might not work every time.
@@ -106,38 +436,215 @@ class Service:
 
         for n_attempts in range(3):
             try:
-                return await self.login(broker_name, username, password)
+                account = await self.login(broker_name, username, password)
+                LOGIN_ATTEMPTS.labels(broker_name).observe(n_attempts + 1)
+                return account
             except AuthenticationError:
                 logger.warning(f"{n_attempts} attempt for logging the {username} failed")
                 await asyncio.sleep(5)
+        # Lands in the +Inf bucket, past the last possible attempt
+        LOGIN_ATTEMPTS.labels(broker_name).observe(4)
         raise AuthenticationError
 
     async def __schedule_order_worker(
         self,
         broker: AbstractBroker,
-        account: Account,
-        order: Order,
+        orders: List[Order],
         deadline: datetime.datetime
     ):
-        logger.debug("going to deep sleep...")
-        await asyncio.sleep((deadline - datetime.datetime.utcnow() - datetime.timedelta(minutes=15)).total_seconds())
+        """ Fires orders sharing isin, price, count and deadline, one per account.
+        Started by scheduled_orders once the orders wake up.
+        """
         logger.debug(f"I'm awake. it's {(deadline - datetime.datetime.utcnow()).seconds//60}minutes before deadline")
+        for order in orders:
+            order.trace.mark("deep_sleep_wake")
+            self.__publish_order(order, "waking")
+
+        failures: Dict[int, BaseException] = {}
+        # Loaded now rather than kept since scheduling, the session may have been refreshed meanwhile
+        try:
+            by_username = self.storage.get_accounts_by_usernames([order.username for order in orders])  # type: ignore
+        except Exception as exc:
+            by_username = {}
+            failures = dict.fromkeys(range(len(orders)), exc)
+        accounts: List[Account] = []
+        for index, order in enumerate(orders):
+            account = by_username.get(order.username)  # type: ignore
+            if account is None:
+                failures.setdefault(index, RecordNotFoundError(f"account {order.username} not found"))
+            accounts.append(account)  # type: ignore
 
         logger.debug("let's see if last_login was for more than 15 minutes ago")
-        if (account.last_login + datetime.timedelta(minutes=15)) < datetime.datetime.utcnow():
-            logger.debug("yes it was. refreshing token")
-            account = await self.__attempt_for_login(broker.name, account.username, account.password)
+        stale = [
+            index for index, account in enumerate(accounts)
+            if index not in failures
+            and (account.last_login + datetime.timedelta(minutes=15)) < datetime.datetime.utcnow()
+        ]
+        if stale:
+            logger.debug(f"yes it was for {len(stale)} accounts. refreshing tokens")
+            # Captcha inference blocks the loop, stay out of other orders' windows if we can afford it
+            await self.critical_window.wait_until_clear(until=deadline - datetime.timedelta(minutes=1))
+            for index in stale:
+                orders[index].trace.mark("relogin_start")
+            logins = await asyncio.gather(*(
+                self.__attempt_for_login(broker.name, accounts[index].username, accounts[index].password)
+                for index in stale
+            ), return_exceptions=True)
+            for index, login in zip(stale, logins):
+                orders[index].trace.mark("relogin_end")
+                if isinstance(login, BaseException):
+                    failures[index] = login
+                else:
+                    accounts[index] = login
         else:
             logger.debug("nope. we're ready to go")
 
-        status, data = await broker.schedule_order(
-            cookies=account.cookies,
-            headers=account.headers,
-            deadline=deadline,
-            isin=order.isin,
-            price=order.price,
-            count=order.count,
-        )
-        logger.info(f"broker sends {status}, {data}")
-        if status == 200:
-            logger.info(f"order {order.id} committed ")
+        ready = [index for index in range(len(orders)) if index not in failures]
+        if ready:
+            order = orders[ready[0]]
+            try:
+                results = await broker.schedule_orders(
+                    sessions=[(accounts[index].cookies, accounts[index].headers) for index in ready],
+                    deadline=deadline,
+                    isin=order.isin,
+                    price=order.price,
+                    count=order.count,
+                    traces=[orders[index].trace for index in ready],
+                )
+            except Exception as exc:
+                results = [exc] * len(ready)
+            for index, result in zip(ready, results):
+                self.__settle(broker, orders[index], result, deadline)
+
+        for index, exc in failures.items():
+            self.__settle(broker, orders[index], exc, deadline)
+
+    async def __conditional_order_worker(self, broker: AbstractBroker, account: Account, order: Order):
+        """ Waits on a warm connection until the price meets order.condition or order.deadline passes """
+        condition: PriceCondition = order.condition  # type: ignore
+        expires_at: datetime.datetime = order.deadline  # type: ignore
+        trigger = self.get_market_data(broker).watch(order.isin, condition.direction, condition.price)
+
+        try:
+            while True:
+                remaining = (expires_at - datetime.datetime.utcnow()).total_seconds()
+                if remaining <= 0:
+                    logger.info(f"order {order.id} expired before price went {condition.direction} {condition.price}")
+                    order.status = 'EXPIRED'
+                    ORDERS.labels(broker.name, 'expired').inc()
+                    self.__publish_order(order, "expired")
+                    self.__finish_order(order)
+                    return
+
+                # The armed order carries the session, refresh it before it goes stale
+                if (account.last_login + datetime.timedelta(minutes=15)) < datetime.datetime.utcnow():
+                    order.trace.mark("relogin_start")
+                    account = await self.__attempt_for_login(broker.name, account.username, account.password)
+                    order.trace.mark("relogin_end")
+
+                result = await broker.fire_on(
+                    trigger.fired,
+                    cookies=account.cookies,
+                    headers=account.headers,
+                    isin=order.isin,
+                    price=order.price,
+                    count=order.count,
+                    trace=order.trace,
+                    hold=min(remaining, 10 * 60),
+                )
+                if result is not None:
+                    break
+        except Exception as exc:
+            self.__settle(broker, order, exc)
+            return
+        finally:
+            self.get_market_data(broker).unwatch(trigger)
+
+        fired_at = next((timestamp for event, timestamp in reversed(order.trace.events) if event == "fire"), None)
+        if fired_at and trigger.detected_at:
+            TRIGGER_FIRE_DELAY_SECONDS.observe((fired_at - trigger.detected_at) / 1e9)
+        self.__settle(broker, order, result)
+
+    def __settle(
+        self,
+        broker: AbstractBroker,
+        order: Order,
+        result: Union[Tuple[int, Any], BaseException],
+        deadline: Optional[datetime.datetime] = None,
+    ):
+        """ Record what the broker answered to the order, or why it never got there """
+        if isinstance(result, BaseException):
+            order.trace.mark("failed")
+            order.status = 'FAILED'
+            ORDERS.labels(broker.name, 'failed').inc()
+            logger.error(f"order {order.id} failed", exc_info=result)
+            self.__publish_order(order, "failed", {'error': str(result) or type(result).__name__})
+        else:
+            status, data = result
+            logger.info(f"broker sends {status}, {data}")
+            if status == 200:
+                order.trace.mark("committed")
+                order.status = 'DONE'
+                ORDERS.labels(broker.name, 'committed').inc()
+                logger.info(f"order {order.id} committed ")
+                self.__publish_order(order, "committed")
+            else:
+                # Final like the others, or the scheduler would pick it up and send it again
+                order.trace.mark("rejected")
+                order.status = 'REJECTED'
+                ORDERS.labels(broker.name, 'rejected').inc()
+                self.__publish_order(order, "rejected", {'broker_status': status})
+        self.__finish_order(order, deadline)
+
+    def __publish_order(self, order: Order, event: str, extra: Optional[Dict[str, Any]] = None):
+        self.events.publish('orders', {
+            'event': event,
+            'order_id': str(order.id),
+            'group_id': str(order.group_id) if order.group_id else None,
+            'username': order.username,
+            'status': order.status,
+            'isin': order.isin,
+            'count': order.count,
+            'price': order.price,
+            'deadline': order.deadline.isoformat() if order.deadline else None,
+            **(extra or {}),
+        }, order.username)
+
+    async def __push_balances(self):
+        """ One balance call per followed account however many clients follow it """
+        while True:
+            await asyncio.sleep(self.balance_interval)
+            if self.critical_window.is_active():
+                continue
+            for username in self.events.followed('balances'):
+                try:
+                    await self.get_account_balance(username)
+                except RateLimitedError:
+                    break
+                except Exception:
+                    logger.warning(f"pushing balance of {username} failed", exc_info=True)
+
+    async def __push_stats(self):
+        samples_per_push = max(int(self.stats_interval / self.critical_window.monitor.interval), 1)
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if not self.events.has_subscribers('stats'):
+                continue
+            lags = sorted(itertools.islice(reversed(self.critical_window.monitor.samples), samples_per_push))
+            self.events.publish('stats', {
+                'loop_lag_p50_ms': lags[len(lags) // 2] * 1e3 if lags else None,
+                'loop_lag_p99_ms': lags[int(len(lags) * .99)] * 1e3 if lags else None,
+                'loop_lag_max_ms': lags[-1] * 1e3 if lags else None,
+                'pending_orders': len(self.pending_orders) + len(self.scheduled_orders),
+                'critical_window': self.critical_window.is_active(),
+            })
+
+    def __finish_order(self, order: Order, deadline: Optional[datetime.datetime] = None):
+        """ deadline: the one armed on the critical window for this order """
+        if deadline:
+            self.critical_window.disarm(deadline)
+        try:
+            self.storage.update_order_trace(order.id, order.trace)
+            self.storage.update_order_status(order.id, order.status)
+        finally:
+            self.pending_orders.pop(order.id, None)
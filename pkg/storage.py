@@ -1,15 +1,19 @@
 import abc
+import dataclasses
 import datetime
 import json
 import pickle
 import uuid
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Sequence, Tuple
 
 import aiohttp
 import sqlalchemy
 from sqlalchemy.exc import IntegrityError
 
-from pkg.models import Account, Order, OrderStatus
+from pkg.internal.latencyprofile import LatencyBucket
+from pkg.internal.metrics import STORAGE_QUERY_SECONDS
+from pkg.internal.tracing import OrderTrace
+from pkg.models import Account, Order, OrderStatus, PriceCondition
 
 
 class StorageError(Exception):
@@ -25,10 +29,35 @@ class RecordNotFoundError(StorageError):
 
 
 class AbstractStorage(abc.ABC):
+    def close(self):
+        """ Called once the service stopped, storages that buffer writes flush them here """
+
     @abc.abstractmethod
     def add_order(self, order: Order):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def add_orders(self, orders: Sequence[Order]):
+        """ All or nothing """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_order_by_id(self, order_id: uuid.UUID) -> Order:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_scheduled_orders(self) -> Iterable[Order]:
+        """ Orders still waiting for their deadline """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_order_status(self, order_id: uuid.UUID, new_status: OrderStatus):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def update_order_trace(self, order_id: uuid.UUID, trace: OrderTrace):
+        raise NotImplementedError
+
     @abc.abstractmethod
     def add_account(self, account: Account):
         raise NotImplementedError
@@ -37,14 +66,29 @@ class AbstractStorage(abc.ABC):
     def get_accounts(self) -> Iterable[Account]:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def get_account_listing(self) -> List[Tuple[str, str]]:
+        """ (username, broker) of every account, without loading their sessions """
+        raise NotImplementedError
+
     @abc.abstractmethod
     def refresh_account(self, username: str, last_login: datetime.datetime, cookies: aiohttp.CookieJar, headers: Dict[str, str]):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def save_accounts(self, accounts: Sequence[Account]):
+        """ Add the new accounts and refresh the session of the known ones, all or nothing """
+        raise NotImplementedError
+
     @abc.abstractmethod
     def get_account_by_username(self, username: str) -> Account:
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def get_accounts_by_usernames(self, usernames: Sequence[str]) -> Dict[str, Account]:
+        """ Accounts found, by username. Unknown usernames are left out """
+        raise NotImplementedError
+
     @abc.abstractmethod
     def get_broker_latency(self, broker_name: str) -> float:
         raise NotImplementedError
@@ -57,6 +101,21 @@ class AbstractStorage(abc.ABC):
     def add_broker(self, broker_name: str):
         raise NotImplementedError
 
+    @abc.abstractmethod
+    def add_latency_buckets(self, buckets: Sequence[LatencyBucket]):
+        """ Buckets of a minute already stored are merged into it """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_latency_buckets(
+            self, broker_name: str, minutes: Sequence[int], since: datetime.date) -> List[LatencyBucket]:
+        """ Buckets of the given minutes of the day, from since on """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def delete_latency_buckets(self, broker_name: str, before: datetime.date):
+        raise NotImplementedError
+
 
 class SqliteStorage(AbstractStorage):
     def __init__(self, url) -> None:
@@ -84,6 +143,11 @@ class SqliteStorage(AbstractStorage):
             sqlalchemy.Column("count", sqlalchemy.Integer),
             sqlalchemy.Column("price", sqlalchemy.Integer),
             sqlalchemy.Column("status", sqlalchemy.String(30)),
+            sqlalchemy.Column("username", sqlalchemy.String(100)),
+            sqlalchemy.Column("deadline", sqlalchemy.DateTime()),
+            sqlalchemy.Column("group_id", sqlalchemy.Uuid),
+            sqlalchemy.Column("condition", sqlalchemy.JSON),
+            sqlalchemy.Column("trace", sqlalchemy.JSON),
         )
 
         self.broker_schema = sqlalchemy.Table(
@@ -95,9 +159,33 @@ class SqliteStorage(AbstractStorage):
             sqlalchemy.Column("avg_latency", sqlalchemy.Float()),
         )
 
+        # Probe samples downsampled to one row per broker and minute
+        self.latency_bucket_schema = sqlalchemy.Table(
+            "latency_buckets",
+            self.metadata_obj,
+            sqlalchemy.Column("broker", sqlalchemy.String(30), primary_key=True),
+            sqlalchemy.Column("day", sqlalchemy.Date(), primary_key=True),
+            sqlalchemy.Column("minute", sqlalchemy.Integer, primary_key=True),
+            sqlalchemy.Column("count", sqlalchemy.Integer),
+            sqlalchemy.Column("minimum", sqlalchemy.Float()),
+            sqlalchemy.Column("p50", sqlalchemy.Float()),
+            sqlalchemy.Column("p90", sqlalchemy.Float()),
+        )
+
     def migrate(self):
         self.metadata_obj.create_all(self.engine)
 
+        # create_all doesn't touch existing tables, add the columns introduced since they were created
+        inspector = sqlalchemy.inspect(self.engine)
+        with self.engine.begin() as conn:
+            for table in self.metadata_obj.sorted_tables:
+                existing = {column['name'] for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing:
+                        column_type = column.type.compile(self.engine.dialect)
+                        conn.execute(sqlalchemy.text(
+                            f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+
     def serialize_cookies(self, cookies: aiohttp.CookieJar) -> bytes:
         return pickle.dumps(cookies._cookies, pickle.HIGHEST_PROTOCOL)
 
@@ -117,6 +205,7 @@ class SqliteStorage(AbstractStorage):
             cookies=self.deserialize_cookies(row[6]),
         )
 
+    @STORAGE_QUERY_SECONDS.labels('get_broker_latency').time()
     def get_broker_latency(self, broker_name: str) -> float:
         query = '''
             SELECT min_latency
@@ -131,6 +220,7 @@ class SqliteStorage(AbstractStorage):
 
             return row[0]
 
+    @STORAGE_QUERY_SECONDS.labels('update_broker_latencies').time()
     def update_broker_latencies(self, broker_name: str, min_latency: float, max_latency: float, avg_latency: float):
         query = '''
             UPDATE brokers
@@ -149,6 +239,7 @@ class SqliteStorage(AbstractStorage):
                 "avg_latency": avg_latency,
             }])
 
+    @STORAGE_QUERY_SECONDS.labels('add_broker').time()
     def add_broker(self, broker_name: str):
         query = '''
             INSERT INTO 
@@ -166,30 +257,123 @@ class SqliteStorage(AbstractStorage):
                 "avg_latency": 0,
             }])
 
-    def add_order(self, order: Order):
+    @STORAGE_QUERY_SECONDS.labels('add_latency_buckets').time()
+    def add_latency_buckets(self, buckets: Sequence[LatencyBucket]):
+        # The merged median is approximated by the count weighted mean of both
         query = '''
-            INSERT INTO 
-                orders(id, broker, isin, count, price, status) 
+            INSERT INTO
+                latency_buckets(broker, day, minute, count, minimum, p50, p90)
             VALUES (
-                :id, :broker, :isin, :count, :price, :status
+                :broker, :day, :minute, :count, :minimum, :p50, :p90
             )
+            ON CONFLICT(broker, day, minute) DO UPDATE SET
+                count=count + excluded.count,
+                minimum=MIN(minimum, excluded.minimum),
+                p50=(p50 * count + excluded.p50 * excluded.count) / (count + excluded.count),
+                p90=MAX(p90, excluded.p90)
         '''
 
         with self.engine.begin() as conn:
-            conn.execute(sqlalchemy.text(query), [{
-                'id': order.id.bytes,
-                'broker': order.broker,
-                'isin': order.isin,
-                'count': order.count,
-                'price': order.price,
-                'status': order.status,
-            }]
-            )
+            conn.execute(sqlalchemy.text(query), [
+                {
+                    'broker': bucket.broker,
+                    'day': bucket.day.isoformat(),
+                    'minute': bucket.minute,
+                    'count': bucket.count,
+                    'minimum': bucket.min,
+                    'p50': bucket.p50,
+                    'p90': bucket.p90,
+                }
+                for bucket in buckets
+            ])
+
+    @STORAGE_QUERY_SECONDS.labels('get_latency_buckets').time()
+    def get_latency_buckets(
+            self, broker_name: str, minutes: Sequence[int], since: datetime.date) -> List[LatencyBucket]:
+        query = sqlalchemy.text('''
+            SELECT broker, day, minute, count, minimum, p50, p90
+            FROM latency_buckets
+            WHERE broker=:broker AND day>=:since AND minute IN :minutes
+        ''').bindparams(sqlalchemy.bindparam('minutes', expanding=True))
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(query, {'broker': broker_name, 'since': since.isoformat(), 'minutes': list(minutes)})
+            return [
+                LatencyBucket(
+                    broker=row[0],
+                    day=datetime.date.fromisoformat(row[1]),
+                    minute=row[2],
+                    count=row[3],
+                    min=row[4],
+                    p50=row[5],
+                    p90=row[6],
+                )
+                for row in rows
+            ]
+
+    @STORAGE_QUERY_SECONDS.labels('delete_latency_buckets').time()
+    def delete_latency_buckets(self, broker_name: str, before: datetime.date):
+        query = '''
+            DELETE FROM latency_buckets
+            WHERE broker=:broker AND day<:before
+        '''
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(query), [{'broker': broker_name, 'before': before.isoformat()}])
 
+    _insert_order_query = '''
+        INSERT INTO 
+            orders(id, broker, isin, count, price, status, username, deadline, group_id, condition, trace) 
+        VALUES (
+            :id, :broker, :isin, :count, :price, :status, :username, :deadline, :group_id, :condition, :trace
+        )
+    '''
+
+    def _order_params(self, order: Order) -> Dict:
+        return {
+            'id': order.id.bytes,
+            'broker': order.broker,
+            'isin': order.isin,
+            'count': order.count,
+            'price': order.price,
+            'status': order.status,
+            'username': order.username,
+            'deadline': order.deadline,
+            'group_id': order.group_id.bytes if order.group_id else None,
+            'condition': json.dumps(dataclasses.asdict(order.condition)) if order.condition else None,
+            'trace': json.dumps(order.trace.to_dict()),
+        }
+
+    @STORAGE_QUERY_SECONDS.labels('add_order').time()
+    def add_order(self, order: Order):
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(self._insert_order_query), [self._order_params(order)])
+
+    @STORAGE_QUERY_SECONDS.labels('add_orders').time()
+    def add_orders(self, orders: Sequence[Order]):
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(self._insert_order_query), list(map(self._order_params, orders)))
+
+    def _map_order(self, row) -> Order:
+        return Order(
+            id=uuid.UUID(bytes=row[0]),
+            broker=row[1],
+            isin=row[2],
+            count=row[3],
+            price=row[4],
+            status=row[5],
+            username=row[6],
+            deadline=datetime.datetime.fromisoformat(row[7]) if row[7] else None,
+            group_id=uuid.UUID(bytes=row[8]) if row[8] else None,
+            condition=PriceCondition(**json.loads(row[9])) if row[9] else None,
+            trace=OrderTrace.from_dict(json.loads(row[10])) if row[10] else OrderTrace(),
+        )
+
+    @STORAGE_QUERY_SECONDS.labels('get_order_by_id').time()
     def get_order_by_id(self, order_id: uuid.UUID) -> Order:
         query = '''
             SELECT 
-                id, broker, isin, count, price, status 
+                id, broker, isin, count, price, status, username, deadline, group_id, condition, trace 
             FROM 
                 orders 
             WHERE id=:id
@@ -201,15 +385,24 @@ class SqliteStorage(AbstractStorage):
             if not row:
                 raise RecordNotFoundError(f'order by id {order_id} not found')
 
-            return Order(
-                id=uuid.UUID(bytes=row[0]),
-                broker=row[1],
-                isin=row[2],
-                count=row[3],
-                price=row[4],
-                status=row[5]
-            )
+            return self._map_order(row)
 
+    @STORAGE_QUERY_SECONDS.labels('get_scheduled_orders').time()
+    def get_scheduled_orders(self) -> Iterable[Order]:
+        query = '''
+            SELECT 
+                id, broker, isin, count, price, status, username, deadline, group_id, condition, trace 
+            FROM 
+                orders 
+            WHERE status='SCHEDULED' AND deadline > :now
+            ORDER BY deadline
+        '''
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(sqlalchemy.text(query), [{'now': datetime.datetime.utcnow()}])
+            return list(map(self._map_order, rows))
+
+    @STORAGE_QUERY_SECONDS.labels('update_order_status').time()
     def update_order_status(self, order_id: uuid.UUID, new_status: OrderStatus):
         query = '''
             UPDATE orders 
@@ -223,6 +416,21 @@ class SqliteStorage(AbstractStorage):
                 'status': new_status,
             }])
 
+    @STORAGE_QUERY_SECONDS.labels('update_order_trace').time()
+    def update_order_trace(self, order_id: uuid.UUID, trace: OrderTrace):
+        query = '''
+            UPDATE orders 
+            SET trace=:trace
+            WHERE id=:id
+        '''
+
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(query), [{
+                'id': order_id.bytes,
+                'trace': json.dumps(trace.to_dict()),
+            }])
+
+    @STORAGE_QUERY_SECONDS.labels('get_accounts').time()
     def get_accounts(self) -> Iterable[Account]:
         query = '''
             SELECT id, broker, username, password, last_login, headers, cookies
@@ -233,6 +441,17 @@ class SqliteStorage(AbstractStorage):
             rows = conn.execute(sqlalchemy.text(query))
             return map(self._map_account, rows)
 
+    @STORAGE_QUERY_SECONDS.labels('get_account_listing').time()
+    def get_account_listing(self) -> List[Tuple[str, str]]:
+        query = '''
+            SELECT username, broker
+            FROM accounts
+        '''
+
+        with self.engine.connect() as conn:
+            return [(row[0], row[1]) for row in conn.execute(sqlalchemy.text(query))]
+
+    @STORAGE_QUERY_SECONDS.labels('add_account').time()
     def add_account(self, account: Account):
         """ 
         Add account to database. 
@@ -262,6 +481,7 @@ class SqliteStorage(AbstractStorage):
             except IntegrityError as exc:
                 raise DuplicateRecordError(exc)
 
+    @STORAGE_QUERY_SECONDS.labels('refresh_account').time()
     def refresh_account(self, username: str, last_login: datetime.datetime, cookies: aiohttp.CookieJar, headers: Dict[str, str]):
         query = '''
             UPDATE accounts
@@ -279,6 +499,34 @@ class SqliteStorage(AbstractStorage):
                 'headers': json.dumps(headers),
             }])
 
+    @STORAGE_QUERY_SECONDS.labels('save_accounts').time()
+    def save_accounts(self, accounts: Sequence[Account]):
+        query = '''
+            INSERT INTO
+                accounts(id, broker, username, password, last_login, headers, cookies)
+            VALUES (
+                :id, :broker, :username, :password, :last_login, :headers, :cookies
+            )
+            ON CONFLICT(username) DO UPDATE SET
+                last_login=excluded.last_login,
+                cookies=excluded.cookies,
+                headers=excluded.headers
+        '''
+        with self.engine.begin() as conn:
+            conn.execute(sqlalchemy.text(query), [
+                {
+                    'id': account.id.bytes,
+                    'broker': account.broker,
+                    'username': account.username,
+                    'password': account.password,
+                    'last_login': account.last_login,
+                    'headers': json.dumps(account.headers),
+                    'cookies': self.serialize_cookies(account.cookies),
+                }
+                for account in accounts
+            ])
+
+    @STORAGE_QUERY_SECONDS.labels('get_account_by_username').time()
     def get_account_by_username(self, username: str) -> Account:
         query = '''
             SELECT 
@@ -294,3 +542,17 @@ class SqliteStorage(AbstractStorage):
                 raise RecordNotFoundError("user not found")
 
             return self._map_account(row)
+
+    @STORAGE_QUERY_SECONDS.labels('get_accounts_by_usernames').time()
+    def get_accounts_by_usernames(self, usernames: Sequence[str]) -> Dict[str, Account]:
+        query = sqlalchemy.text('''
+            SELECT 
+                id, broker, username, password, last_login, headers, cookies
+            FROM 
+                accounts
+            WHERE username IN :usernames
+        ''').bindparams(sqlalchemy.bindparam('usernames', expanding=True))
+
+        with self.engine.connect() as conn:
+            rows = conn.execute(query, [{'usernames': list(usernames)}])
+            return {account.username: account for account in map(self._map_account, rows)}
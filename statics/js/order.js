@@ -1,4 +1,22 @@
+// Order ids submitted from this page, their lifecycle is pushed over /ws
+const submittedOrders = new Set();
+
+function watchOrders() {
+    const protocol = location.protocol === "https:" ? "wss:" : "ws:";
+    const socket = new WebSocket(protocol + "//" + location.host + "/ws?topic=orders");
+    socket.onmessage = (message) => {
+        const event = JSON.parse(message.data);
+        if (event.topic !== "orders" || !submittedOrders.has(event.data.order_id)) {
+            return;
+        }
+        document.getElementById("message").innerText =
+            "order " + event.data.order_id + ": " + event.data.event + " (" + event.data.status + ")";
+    };
+    socket.onclose = () => setTimeout(watchOrders, 1000);
+}
+
 document.addEventListener("DOMContentLoaded", async function () {
+    watchOrders();
     const response = await fetch("/api/accounts")
     const accounts = await response.json()
     const accountsNode = document.getElementById("account")
@@ -50,6 +68,11 @@ async function submitOrder(event) {
             count: count,
         })
     })
+    const body = await response.json();
+    if (body.order_id) {
+        submittedOrders.add(body.order_id);
+    }
+    document.getElementById("message").innerText = body.message;
 }
 function calcTotalPrice(event) {
     const count = Number.parseFloat(document.getElementById("stock-count").value);
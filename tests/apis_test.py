@@ -0,0 +1,52 @@
+import asyncio
+import unittest
+import uuid
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from pkg.models import Order
+from pkg.server.factory import create_server
+from pkg.service import Service
+from pkg.storage import SqliteStorage
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class ApisTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.storage = SqliteStorage('sqlite+pysqlite:///:memory:')
+        self.storage.migrate()
+        self.client = TestClient(TestServer(create_server(Service(self.storage, {}), statics_dir=None)))
+        await self.client.start_server()
+
+    async def asyncTearDown(self) -> None:
+        await self.client.close()
+
+    async def test_order_trace(self):
+        order = Order(id=uuid.uuid4(), broker='FAKE', isin='IRFake', count=1, price=1, status='DONE')
+        for event in ('scheduled', 'fire', 'committed'):
+            order.trace.mark(event)  # type: ignore
+        self.storage.add_order(order)
+
+        response = await self.client.get(f'/api/orders/{order.id}/trace')
+
+        self.assertEqual(response.status, 200)
+        trace = await response.json()
+        self.assertEqual([event['event'] for event in trace['events']], ['scheduled', 'fire', 'committed'])
+        self.assertEqual(trace['events'][0]['elapsed_ms'], 0)
+
+    async def test_unknown_order_trace(self):
+        response = await self.client.get(f'/api/orders/{uuid.uuid4()}/trace')
+        self.assertEqual(response.status, 404)
+
+        response = await self.client.get('/api/orders/not-an-id/trace')
+        self.assertEqual(response.status, 400)
+
+    async def test_stocks_of_an_unknown_broker(self):
+        response = await self.client.get('/api/stocks', params={'label': 'fold', 'broker': 'NOPE'})
+
+        self.assertEqual(response.status, 400)
+        self.assertEqual(await response.json(), {'level': 'HTTP', 'message': 'unknown broker NOPE'})
@@ -0,0 +1,89 @@
+import asyncio
+import json
+import os
+import tempfile
+import unittest
+
+from aiohttp.test_utils import TestServer
+from typer.testing import CliRunner
+from yarl import URL
+
+from pkg.bench import (
+    BenchConfig, NetworkProfile, ReplayBenchConfig, compare_reports, run_benchmarks, run_replay_bench)
+from pkg.cli import cli
+from pkg.internal.brokers import FakeBroker, RateLimiter
+from pkg.internal.brokers.replay import ArchiveWriter, RecordingProxy
+from pkg.internal.brokers.simulator import API_PREFIX, Simulator, SimulatorConfig
+
+
+async def record_session(path: str):
+    """ A login, balance and stock lookup of FakeBroker against the simulator, recorded to path """
+    simulator = TestServer(Simulator(SimulatorConfig(seed=0)).create_app(), host='localhost')
+    await simulator.start_server()
+    upstream = URL(f'http://localhost:{simulator.port}/')
+    proxy = TestServer(
+        RecordingProxy(ArchiveWriter(path), upstream, upstream.with_path(API_PREFIX + '/')).create_app(),
+        host='localhost',
+    )
+    await proxy.start_server()
+    broker = FakeBroker(f'http://localhost:{proxy.port}/', limiter=RateLimiter('FAKE', rate=1000, burst=1000))
+    try:
+        headers, cookies = await broker.login('1234', 'secret', 'python3.11')
+        await broker.get_account_balance(headers, cookies)
+        await broker.get_stock('fold')
+    finally:
+        await broker.close()
+        await proxy.close()
+        await simulator.close()
+
+
+class BenchSmokeTestCase(unittest.TestCase):
+    """ Each benchmark once with the smallest workload, for the shape of its report """
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def test_harness(self):
+        config = BenchConfig(
+            rounds=1, lead=.5, concurrency=[2], transports=['plain'], profiles=[NetworkProfile()], fire_path_samples=5)
+
+        report = run_benchmarks(config)
+
+        self.assertEqual(report['meta']['config']['concurrency'], [2])
+        self.assertEqual(report['fire_path_us']['armed']['count'], 5)
+        scheduling, = report['scheduling']
+        self.assertEqual((scheduling['transport'], scheduling['concurrency']), ('plain', 2))
+
+    def test_replay_of_fake_broker_session(self):
+        archive = os.path.join(self.directory, 'session.zip')
+        asyncio.run(record_session(archive))
+
+        report = run_replay_bench(ReplayBenchConfig(archive=archive, time_scale=0, lead=.5))
+
+        self.assertEqual(report['meta']['config']['archive'], archive)
+        self.assertEqual({operation: stats['errors'] for operation, stats in report['operations'].items()}, {
+            'login': 0, 'stock': 0, 'balance': 0, 'order': 0})
+        self.assertEqual(report['operations']['login']['latency_ms']['count'], 1)
+        self.assertFalse(report['unrecorded_requests'])
+
+    def test_commands_write_the_report(self):
+        output = os.path.join(self.directory, 'report.json')
+
+        result = CliRunner().invoke(
+            cli, ['bench-storage', '--engine', 'sqlite', '--orders', '10', '--accounts', '2', '--output', output])
+
+        self.assertEqual(result.exit_code, 0, result.output)
+        with open(output) as fd:
+            report = json.load(fd)
+        self.assertEqual(report['meta']['config']['orders'], 10)
+        self.assertEqual(list(report['engines']), ['sqlite'])
+
+    def test_compare_reports(self):
+        one = {'meta': {'commit': 'a'}, 'value': 1}
+
+        self.assertIs(compare_reports({'asyncio': one}, 'runtimes'), one)
+        self.assertEqual(
+            compare_reports({'asyncio': one, 'uvloop': {'meta': {'commit': 'a'}, 'value': 2}}, 'runtimes'),
+            {'meta': {'commit': 'a'}, 'runtimes': {'asyncio': one, 'uvloop': {'meta': {'commit': 'a'}, 'value': 2}}})
@@ -0,0 +1,159 @@
+import importlib.util
+import os
+import tempfile
+import unittest
+from typing import List
+from unittest import mock
+
+import numpy as np
+
+from pkg.internal.brokers.simulator import Simulator, SimulatorConfig
+from pkg.internal.captcha import MODEL_VARIANTS, CaptchaSolver, DatasetConfig
+
+HAS_KERAS = importlib.util.find_spec('keras') is not None
+
+
+class StubModel:
+    """ Reads every digit off the image's mean brightness, one image at a time or many """
+
+    def __init__(self, length: int = 4) -> None:
+        self.length = length
+        self.inputs: List[np.ndarray] = []
+
+    def __call__(self, X: np.ndarray, training: bool = False) -> List[np.ndarray]:
+        self.inputs.append(X)
+        digits = (X.reshape(len(X), -1).mean(axis=1) * 1000).astype(int) % 10
+        return [np.eye(10)[(digits + i) % 10] for i in range(self.length)]
+
+
+def stub_solver(variant: str = 'baseline', model=None) -> CaptchaSolver:
+    with mock.patch.object(CaptchaSolver, '_CaptchaSolver__create_model', return_value=model or StubModel()):
+        return CaptchaSolver(DatasetConfig(variant=variant))
+
+
+class CaptchaDatasetTestCase(unittest.TestCase):
+    """ Captchas drawn the way the broker simulator draws them, named by their answer """
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        simulator = Simulator(SimulatorConfig(seed=0))
+        self.answers = ['1234', '5678', '9012', '3456', '1234_']
+        self.filenames = []
+        for answer in self.answers:
+            filename = f'{answer}.jpeg'
+            with open(os.path.join(self.directory, filename), 'wb') as fd:
+                fd.write(simulator.render_captcha(answer.rstrip('_')))
+            self.filenames.append(filename)
+
+    def images(self) -> List[bytes]:
+        images = []
+        for filename in self.filenames:
+            with open(os.path.join(self.directory, filename), 'rb') as fd:
+                images.append(fd.read())
+        return images
+
+
+class CaptchaSolverTestCase(CaptchaDatasetTestCase):
+    def test_variant_input_shapes(self):
+        self.assertEqual(DatasetConfig().input_shape, (60, 202, 1))
+        self.assertEqual(DatasetConfig(variant='small').input_shape, (30, 101, 1))
+        with self.assertRaises(ValueError):
+            CaptchaSolver(DatasetConfig(variant='unknown'))
+
+    def test_load_dataset(self):
+        solver = stub_solver()
+
+        X, y = solver.load_dataset(self.directory, self.filenames)
+
+        self.assertEqual(X.shape, (5, 60, 202, 1))
+        self.assertEqual(y.shape, (4, 5, 10))
+        labels = DatasetConfig.labels
+        self.assertEqual(
+            [''.join(labels[k] for k in digits) for digits in y.argmax(axis=-1).T],
+            [answer.rstrip('_') for answer in self.answers])
+        self.assertTrue(((X >= 0) & (X <= 1)).all())
+
+    def test_predict_and_predict_batch_agree(self):
+        solver = stub_solver()
+
+        batched = solver.predict_batch(self.images())
+        single = []
+        for filename in self.filenames:
+            with open(os.path.join(self.directory, filename), 'rb') as fd:
+                single.append(solver.predict(fd))  # type: ignore
+
+        self.assertEqual(single, batched)
+        self.assertEqual(len(set(batched)), 4)
+
+    def test_scaled_variant_sees_the_same_images_in_training_and_inference(self):
+        model = StubModel()
+        solver = stub_solver('small', model)
+
+        X, _ = solver.load_dataset(self.directory, self.filenames)
+        solver.predict_batch(self.images())
+
+        self.assertEqual(X.shape[1:], (30, 101, 1))
+        np.testing.assert_allclose(model.inputs[-1], X)
+
+    def test_evaluate(self):
+        solver = stub_solver()
+        _, y = solver.load_dataset(self.directory, self.filenames[:2])
+        scores = y.copy()
+        # One digit of the second captcha read wrong
+        scores[3, 1] = np.roll(scores[3, 1], 1)
+        solver.model = lambda X, training=False: list(scores)
+
+        accuracy = solver.evaluate(np.zeros((2, 60, 202, 1)), y)
+
+        self.assertEqual(accuracy, {'digit_accuracy': 7 / 8, 'captcha_accuracy': .5})
+
+
+@unittest.skipUnless(HAS_KERAS, 'keras is not installed')
+class CaptchaModelTestCase(CaptchaDatasetTestCase):
+    def test_variants_build(self):
+        for name in MODEL_VARIANTS:
+            with self.subTest(variant=name):
+                config = DatasetConfig(variant=name)
+                model = CaptchaSolver(config).model
+
+                self.assertEqual(tuple(model.input_shape[1:]), config.input_shape)
+                self.assertEqual(len(model.outputs), config.length)
+
+    def test_trained_model_predicts_the_same_single_and_batched(self):
+        solver = CaptchaSolver(DatasetConfig(variant='small'))
+        solver.fit(*solver.load_dataset(self.directory, self.filenames), epochs=1)
+
+        batched = solver.predict_batch(self.images())
+        single = []
+        for filename in self.filenames:
+            with open(os.path.join(self.directory, filename), 'rb') as fd:
+                single.append(solver.predict(fd))  # type: ignore
+
+        self.assertEqual(single, batched)
+
+    def test_baseline_loads_weights_of_the_original_model(self):
+        from keras.layers import BatchNormalization, Conv2D, Dense, Dropout, Flatten, Input, MaxPooling2D
+        from keras.models import Model
+
+        # The architecture before variants existed
+        img = Input(shape=DatasetConfig.shape)
+        layer = MaxPooling2D(padding='same')(Conv2D(16, (3, 3), padding='same', activation='relu')(img))
+        layer = MaxPooling2D(padding='same')(Conv2D(32, (3, 3), padding='same', activation='relu')(layer))
+        layer = Conv2D(32, (3, 3), padding='same', activation='relu')(layer)
+        flat = Flatten()(MaxPooling2D(padding='same')(BatchNormalization()(layer)))
+        outs = []
+        for _ in range(4):
+            dense = Dense(64, activation='relu')(flat)
+            outs.append(Dense(10, activation='sigmoid')(Dropout(0.5)(dense)))
+        original = Model(img, outs)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'captcha-clf')
+            original.save_weights(path)
+            solver = CaptchaSolver()
+            solver.load(path)
+
+        for loaded, saved in zip(solver.model.get_weights(), original.get_weights()):
+            np.testing.assert_array_equal(loaded, saved)
@@ -0,0 +1,101 @@
+import asyncio
+import datetime
+import multiprocessing
+import os
+import tempfile
+import time
+import unittest
+import uuid
+
+import aiohttp
+
+from pkg.bench.servers import free_port, start_process, wait_for_port
+from pkg.config import BrokerConfig, MainConfig, ServerConfig, StorageConfig
+from pkg.internal.brokers import FakeBroker
+from pkg.internal.brokers.simulator import SimulatorConfig, run_simulator
+from pkg.server.cluster import run_cluster
+from pkg.service import Service, ServiceRole
+from pkg.storage import SqliteStorage
+
+
+def create_service(config: MainConfig, role: ServiceRole) -> Service:
+    return Service(
+        SqliteStorage(config.storage.url),
+        {'FAKE': FakeBroker(config.broker.fake_url)},  # type: ignore
+        role=role,
+        poll_interval=config.server.scheduler_poll_interval,
+    )
+
+
+class ClusterTestCase(unittest.TestCase):
+    """ Two api processes and the scheduler against the broker simulator, the way `serve --workers 2` runs """
+
+    def setUp(self) -> None:
+        data_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(data_dir.cleanup)
+        simulator_port = free_port()
+        self.simulator_url = f'http://localhost:{simulator_port}/'
+        simulator = start_process(
+            run_simulator, 'localhost', simulator_port, SimulatorConfig(seed=0), port=simulator_port)
+        self.addCleanup(simulator.terminate)
+
+        self.config = MainConfig(
+            storage=StorageConfig(url=f"sqlite+pysqlite:///{os.path.join(data_dir.name, 'sqlite.db')}"),
+            server=ServerConfig(port=free_port(), scheduler_port=free_port(), workers=2, scheduler_poll_interval=.1),
+            broker=BrokerConfig(fake_url=self.simulator_url),
+        )
+        self.storage = SqliteStorage(self.config.storage.url)
+        self.storage.migrate()
+        self.api_url = f'http://localhost:{self.config.server.port}'
+
+        # Not a daemon, daemons can't start the cluster's processes
+        cluster = multiprocessing.Process(target=run_cluster, args=(self.config, create_service))
+        cluster.start()
+        self.addCleanup(cluster.join)
+        self.addCleanup(cluster.terminate)
+        wait_for_port(self.config.server.port)
+        wait_for_port(self.config.server.scheduler_port)
+
+    async def drive(self) -> uuid.UUID:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(self.api_url + '/api/login', json={
+                'username': '1234',
+                'password': '1234',
+                'broker': 'FAKE',
+            }) as response:
+                self.assertEqual(response.status, 200)
+
+            deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=2)
+            async with session.post(self.api_url + '/api/order', json={
+                'username': '1234',
+                'deadline': deadline.isoformat(),
+                'count': 1,
+                'price': 4242,
+                'isin': 'IRO1FAKE0001',
+            }) as response:
+                self.assertEqual(response.status, 200)
+                order_id = uuid.UUID((await response.json())['order_id'])
+
+            # Spread over both api processes meanwhile
+            for _ in range(20):
+                async with session.get(self.api_url + '/api/accounts') as response:
+                    self.assertEqual(await response.json(), [{'username': '1234', 'broker': 'FAKE'}])
+        return order_id
+
+    async def arrivals(self):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(self.simulator_url + '_sim/arrivals') as response:
+                return await response.json()
+
+    def test_scheduled_order_fires_once(self):
+        order_id = asyncio.run(self.drive())
+
+        give_up_at = time.monotonic() + 10
+        while self.storage.get_order_by_id(order_id).status == 'SCHEDULED' and time.monotonic() < give_up_at:
+            time.sleep(.1)
+        # More polls of the scheduler, a second pick up would fire again
+        time.sleep(1)
+        arrivals = asyncio.run(self.arrivals())
+
+        self.assertEqual(self.storage.get_order_by_id(order_id).status, 'DONE')
+        self.assertEqual([arrival['price'] for arrival in arrivals], [4242])
@@ -0,0 +1,51 @@
+import datetime
+import time
+import unittest
+
+from pkg.internal.critical import CriticalWindow
+from pkg.internal.looplag import LoopLagMonitor
+
+
+class CriticalWindowTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.window = CriticalWindow(LoopLagMonitor(), before=10, after=2)
+
+    def in_seconds(self, seconds: float) -> datetime.datetime:
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+    def test_inactive_without_deadlines(self):
+        self.assertFalse(self.window.is_active())
+        self.assertEqual(self.window.remaining(), 0)
+
+    def test_active_before_deadline(self):
+        self.window.arm(self.in_seconds(5))
+
+        self.assertTrue(self.window.is_active())
+
+    def test_inactive_long_before_deadline(self):
+        self.window.arm(self.in_seconds(60))
+
+        self.assertFalse(self.window.is_active())
+
+    def test_active_shortly_after_deadline(self):
+        self.window.arm(self.in_seconds(-1))
+
+        self.assertTrue(self.window.is_active())
+        self.assertFalse(self.window.is_active(time.time() + 2))
+
+    def test_overlapping_windows_are_merged(self):
+        self.window.arm(self.in_seconds(5))
+        self.window.arm(self.in_seconds(15))
+
+        self.assertAlmostEqual(self.window.remaining(), 17, delta=.5)
+
+    def test_disarm(self):
+        deadline = self.in_seconds(5)
+        self.window.arm(deadline)
+        self.window.arm(deadline)
+
+        self.window.disarm(deadline)
+        self.assertTrue(self.window.is_active())
+
+        self.window.disarm(deadline)
+        self.assertFalse(self.window.is_active())
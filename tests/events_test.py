@@ -0,0 +1,48 @@
+import asyncio
+import unittest
+
+from pkg.internal.events import EventHub
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class EventHubTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_filters_by_topic_and_username(self):
+        hub = EventHub()
+        orders = hub.subscribe(['orders'])
+        alice = hub.subscribe(['orders', 'balances'], ['alice'])
+
+        hub.publish('orders', {'order_id': '1'}, 'alice')
+        hub.publish('orders', {'order_id': '2'}, 'bob')
+        hub.publish('balances', {'balance': 10}, 'alice')
+        hub.publish('stats', {'pending_orders': 0})
+
+        events, _ = await orders.get()
+        self.assertEqual([event.data for event in events], [{'order_id': '1'}, {'order_id': '2'}])
+        events, _ = await alice.get()
+        self.assertEqual([event.data for event in events], [{'order_id': '1'}, {'balance': 10}])
+        self.assertEqual(hub.followed('balances'), {'alice'})
+
+    async def test_slow_client_drops_oldest(self):
+        hub = EventHub(maxsize=3)
+        subscription = hub.subscribe()
+
+        for index in range(5):
+            hub.publish('stats', {'index': index})
+
+        events, dropped = await subscription.get()
+        self.assertEqual([event.data['index'] for event in events], [2, 3, 4])
+        self.assertEqual(dropped, 2)
+
+    async def test_unsubscribe(self):
+        hub = EventHub()
+        subscription = hub.subscribe()
+        hub.unsubscribe(subscription)
+
+        hub.publish('stats', {})
+
+        self.assertFalse(subscription.queue)
+        self.assertFalse(hub.has_subscribers('stats'))
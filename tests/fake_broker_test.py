@@ -0,0 +1,191 @@
+import asyncio
+import datetime
+import unittest
+
+from aiohttp.test_utils import TestServer
+
+from pkg.internal.brokers import AuthenticationError, FakeBroker, RateLimiter
+from pkg.internal.brokers.simulator import Simulator, SimulatorConfig
+from pkg.models import PriceCondition
+from pkg.service import Service
+from pkg.storage import SqliteStorage
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class FakeBrokerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.simulator = Simulator(SimulatorConfig(seed=0))
+        self.server = TestServer(self.simulator.create_app(), host='localhost')
+        await self.server.start_server()
+        self.broker = FakeBroker(f'http://localhost:{self.server.port}/')
+
+    async def asyncTearDown(self) -> None:
+        await self.broker.close()
+        await self.server.close()
+
+    async def test_login(self):
+        headers, cookies = await self.broker.login('1234', '1234', 'python3.11')
+
+        self.assertEqual(headers['User-Agent'], 'python3.11')
+        self.assertIsNotNone(self.broker.get_api_token(cookies))
+
+    async def test_failed_login(self):
+        self.simulator.config.login_failure_rate = 1
+
+        with self.assertRaises(AuthenticationError):
+            await self.broker.login('1234', '1234', 'python3.11')
+
+    async def test_get_account_balance(self):
+        headers, cookies = await self.broker.login('1234', '1234', 'python3.11')
+
+        balance = await self.broker.get_account_balance(headers, cookies)
+
+        self.assertEqual(balance, self.simulator.config.balance)
+
+    async def test_get_stock(self):
+        stocks = await self.broker.get_stock('fold')
+
+        self.assertEqual([stock['isin'] for stock in stocks], ['IRO1FOLD0001'])  # type: ignore
+
+    async def test_schedule_order(self):
+        headers, cookies = await self.broker.login('1234', '1234', 'python3.11')
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+
+        status, _ = await self.broker.schedule_order(cookies, headers, deadline, 'IRO1FAKE0001', 1000, 2)
+
+        self.assertEqual(status, 200)
+        arrival = self.simulator.arrivals[0]
+        self.assertEqual((arrival.isin, arrival.count, arrival.price), ('IRO1FAKE0001', 2, 1000))
+        self.assertGreaterEqual(arrival.arrived_at, deadline.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+    async def test_waiting_order_holds_no_limiter_slot(self):
+        headers, cookies = await self.broker.login('1234', '1234', 'python3.11')
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=2)
+
+        order = asyncio.create_task(self.broker.schedule_order(cookies, headers, deadline, 'IRO1FAKE0001', 1000, 2))
+        # Before the last second, which is busy waited
+        await asyncio.sleep(.5)
+        in_flight = self.broker.limiter.in_flight
+        status, _ = await order
+
+        self.assertEqual(in_flight, 0)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.broker.limiter.in_flight, 0)
+
+    async def test_conditional_orders_share_warm_connections(self):
+        headers, cookies = await self.broker.login('1234', '1234', 'python3.11')
+        pool = self.broker.warm_pool
+        pool.size = 2
+        condition = asyncio.get_running_loop().create_future()
+
+        orders = [
+            asyncio.create_task(self.broker.fire_on(condition, cookies, headers, 'IRO1FAKE0001', 1000, 1, hold=5))
+            for _ in range(10)
+        ]
+        await asyncio.sleep(.5)
+        watchdogs = [task for task in asyncio.all_tasks() if task.get_coro().__qualname__ == 'WarmPool.__watch']
+        idle = len(pool.idle)
+        condition.set_result(1000)
+        results = await asyncio.gather(*orders)
+
+        self.assertEqual(len(watchdogs), 1)
+        self.assertEqual(idle, 2)
+        self.assertEqual([status for status, _ in results], [200] * 10)  # type: ignore
+        self.assertEqual(len(self.simulator.arrivals), 10)
+        # The last order out closes the pool
+        self.assertIsNone(pool.watchdog)
+        self.assertFalse(pool.idle)
+
+    async def test_schedule_orders(self):
+        sessions = []
+        for username in ('1234', '5678', '9012'):
+            headers, cookies = await self.broker.login(username, '1234', 'python3.11')
+            sessions.append((cookies, headers))
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=1)
+
+        results = await self.broker.schedule_orders(sessions, deadline, 'IRO1FAKE0001', 1000, 2)
+
+        self.assertEqual([status for status, _ in results], [200, 200, 200])  # type: ignore
+        self.assertEqual(len(self.simulator.arrivals), 3)
+
+    async def test_login_all(self):
+        storage = SqliteStorage('sqlite+pysqlite:///:memory:')
+        storage.migrate()
+        service = Service(storage, {'FAKE': self.broker})
+        self.broker.limiter = RateLimiter('FAKE', rate=1000, burst=1000)
+        # Every other login misreads the captcha
+        self.simulator.config.login_failure_rate = .5
+        credentials = [('FAKE', str(username), '1234') for username in range(1000, 1010)] + [('TAVANA', '9999', '1234')]
+
+        results = await service.login_all(credentials, concurrency=4, attempts=10, retry_delay=0)  # type: ignore
+
+        self.assertEqual([result.error for result in results], [None] * 10 + ['broker TAVANA is not available'])
+        self.assertGreater(sum(result.attempts for result in results), 10)
+        self.assertEqual(len(storage.get_account_listing()), 10)
+        account = storage.get_account_by_username('1000')
+        self.assertIsNotNone(self.broker.get_api_token(account.cookies))
+
+    async def test_rejected_order_is_not_rescheduled(self):
+        storage = SqliteStorage('sqlite+pysqlite:///:memory:')
+        storage.migrate()
+        service = Service(storage, {'FAKE': self.broker})
+        await service.login('FAKE', '1234', '1234')
+
+        async def reject(sessions, *args, **kwargs):
+            return [(400, 'invalid price')] * len(sessions)
+        self.broker.schedule_orders = reject  # type: ignore
+
+        # Answered long before its deadline, a still SCHEDULED order would be sent again
+        order = await service.schedule_order(
+            '1234', 'IRO1FAKE0001', 2, 1000, datetime.datetime.utcnow() + datetime.timedelta(minutes=1))
+        for _ in range(100):
+            if order.id not in service.pending_orders and order.id not in service.scheduled_orders:
+                break
+            await asyncio.sleep(.01)
+        await service.scheduled_orders.stop()
+
+        self.assertEqual(storage.get_order_by_id(order.id).status, 'REJECTED')
+        self.assertEqual(storage.get_scheduled_orders(), [])
+
+    async def test_conditional_order_fires_with_the_refreshed_session(self):
+        storage = SqliteStorage('sqlite+pysqlite:///:memory:')
+        storage.migrate()
+        service = Service(storage, {'FAKE': self.broker})
+        account = await service.login('FAKE', '1234', '1234')
+        # Stale, the worker logs in again before arming
+        storage.refresh_account('1234', account.last_login - datetime.timedelta(hours=1), account.cookies, account.headers)
+
+        logins = []
+        login = self.broker.login
+
+        async def counting_login(*args, **kwargs):
+            logins.append(await login(*args, **kwargs))
+            return logins[-1]
+
+        fired_with = []
+
+        async def fire_on(condition, cookies, headers, *args, **kwargs):
+            fired_with.append(cookies)
+            # The first hold runs out without the price moving
+            return None if len(fired_with) == 1 else (200, 'ok')
+
+        self.broker.login = counting_login  # type: ignore
+        self.broker.fire_on = fire_on  # type: ignore
+
+        order = await service.schedule_conditional_order(
+            '1234', 'IRO1FAKE0001', 1, 1000, PriceCondition('above', 1),
+            datetime.datetime.utcnow() + datetime.timedelta(hours=1))
+        for _ in range(100):
+            if order.id not in service.pending_orders:
+                break
+            await asyncio.sleep(.01)
+        await service.get_market_data(self.broker).stop()
+
+        self.assertEqual(len(logins), 1)
+        _, cookies = logins[0]
+        self.assertEqual(fired_with, [cookies, cookies])
+        self.assertEqual(storage.get_order_by_id(order.id).status, 'DONE')
@@ -0,0 +1,69 @@
+import dataclasses
+import datetime
+import decimal
+import enum
+import json
+import unittest
+import uuid
+
+from pkg.internal import jsoncodec
+
+
+@dataclasses.dataclass
+class Point:
+    x: int
+    y: int
+
+
+class Side(enum.Enum):
+    BUY = 'buy'
+
+
+class JsonCodecTestCase(unittest.TestCase):
+    def tearDown(self) -> None:
+        jsoncodec.use('auto')
+
+    def test_backends_agree(self):
+        data = {
+            'id': uuid.UUID(int=1),
+            'at': datetime.datetime(2024, 1, 2, 3, 4, 5, 6),
+            'point': Point(1, 2),
+            'price': decimal.Decimal('1000.10'),
+            'side': Side.BUY,
+            'text': 'سلام',
+            'items': [1, 2.5, None, True],
+        }
+
+        encoded = {}
+        for backend in ('stdlib', 'orjson'):
+            try:
+                name = jsoncodec.use(backend)  # type: ignore
+            except RuntimeError:
+                continue
+            encoded[name] = jsoncodec.dumps(data)
+
+        for body in encoded.values():
+            self.assertEqual(json.loads(body), {
+                'id': '00000000-0000-0000-0000-000000000001',
+                'at': '2024-01-02T03:04:05.000006',
+                'point': {'x': 1, 'y': 2},
+                'price': '1000.10',
+                'side': 'buy',
+                'text': 'سلام',
+                'items': [1, 2.5, None, True],
+            })
+        self.assertEqual(len(set(encoded.values())), 1)
+
+    def test_unknown_types_raise(self):
+        for backend in ('stdlib', 'orjson'):
+            try:
+                jsoncodec.use(backend)  # type: ignore
+            except RuntimeError:
+                continue
+            with self.subTest(backend=backend), self.assertRaises(TypeError):
+                jsoncodec.dumps({'value': object()})
+
+    def test_loads_bytes(self):
+        self.assertEqual(jsoncodec.loads(b'{"a": [1]}'), {'a': [1]})
+        with self.assertRaises(json.JSONDecodeError):
+            jsoncodec.loads(b'{')
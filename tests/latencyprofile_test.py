@@ -0,0 +1,41 @@
+import datetime
+import unittest
+
+from pkg.internal.latencyprofile import LatencyProfile
+from pkg.storage import SqliteStorage
+
+
+class LatencyProfileTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.storage = SqliteStorage('sqlite+pysqlite:///:memory:')
+        self.storage.migrate()
+        self.profile = LatencyProfile('FAKE', self.storage, days=5, window=1, min_days=3)
+
+    def test_minutes_are_market_time(self):
+        # 05:15 UTC is 08:45 in Tehran
+        day, minute = self.profile._market_minute(datetime.datetime(2024, 1, 6, 5, 15))
+
+        self.assertEqual((day, minute), (datetime.date(2024, 1, 6), 8 * 60 + 45))
+
+    def test_predicts_from_the_deadline_minute(self):
+        for days_ago in range(1, 5):
+            day = datetime.datetime(2024, 1, 10) - datetime.timedelta(days=days_ago)
+            # Quiet at 08:00, congested at the 08:45 open
+            for _ in range(3):
+                self.profile.record(.010, day.replace(hour=4, minute=30))
+            for _ in range(3):
+                self.profile.record(.050 + days_ago / 1000, day.replace(hour=5, minute=15, second=30))
+        self.profile.flush()
+
+        at_open = self.profile.predict(datetime.datetime(2024, 1, 10, 5, 16))
+        early = self.profile.predict(datetime.datetime(2024, 1, 10, 4, 30))
+
+        self.assertAlmostEqual(at_open, .052)  # type: ignore
+        self.assertAlmostEqual(early, .010)  # type: ignore
+        self.assertIsNone(self.profile.predict(datetime.datetime(2024, 1, 10, 12, 0)))
+
+    def test_needs_min_days(self):
+        self.profile.record(.01, datetime.datetime(2024, 1, 9, 5, 15))
+        self.profile.flush()
+
+        self.assertIsNone(self.profile.predict(datetime.datetime(2024, 1, 10, 5, 15)))
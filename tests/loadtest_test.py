@@ -0,0 +1,45 @@
+import asyncio
+import unittest
+
+from aiohttp.test_utils import TestServer
+
+from pkg.bench.loadtest import LoadGenerator, LoadTestConfig, _login_accounts
+from pkg.internal.brokers import FakeBroker, RateLimiter
+from pkg.internal.brokers.simulator import Simulator, SimulatorConfig
+from pkg.server.factory import create_server
+from pkg.service import Service
+from pkg.storage import SqliteStorage
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class LoadGeneratorTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.simulator = TestServer(Simulator(SimulatorConfig(seed=0)).create_app(), host='localhost')
+        await self.simulator.start_server()
+        storage = SqliteStorage('sqlite+pysqlite:///:memory:')
+        storage.migrate()
+        broker = FakeBroker(
+            f'http://localhost:{self.simulator.port}/', limiter=RateLimiter('FAKE', rate=1000, burst=1000))
+        self.api = TestServer(create_server(Service(storage, {'FAKE': broker}), statics_dir=None), host='localhost')
+        await self.api.start_server()
+        self.api_url = f'http://localhost:{self.api.port}'
+
+    async def asyncTearDown(self) -> None:
+        await self.api.close()
+        await self.simulator.close()
+
+    async def test_drives_the_api_mix(self):
+        usernames = await _login_accounts(self.api_url, 3)
+        # Orders would outlive the test, they'd fire after their lead
+        config = LoadTestConfig(duration=.3, concurrency=4, mix={'balance': 1, 'stocks': 1, 'accounts': 1})
+        generator = LoadGenerator(config, self.api_url, usernames)
+
+        elapsed = await generator.run()
+
+        self.assertGreaterEqual(elapsed, .3)
+        self.assertEqual(set(generator.latencies), {'balance', 'stocks', 'accounts'})
+        self.assertEqual(dict(generator.errors), {})
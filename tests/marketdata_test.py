@@ -0,0 +1,65 @@
+import asyncio
+import unittest
+
+from aiohttp.test_utils import TestServer
+
+from pkg.internal.brokers import FakeBroker
+from pkg.internal.brokers.simulator import Simulator, SimulatorConfig
+from pkg.internal.marketdata import MarketDataEngine
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class MarketDataEngineTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.simulator = Simulator(SimulatorConfig(prices={'IRO1FAKE0001': 1000}))
+        self.server = TestServer(self.simulator.create_app(), host='localhost')
+        await self.server.start_server()
+        self.broker = FakeBroker(f'http://localhost:{self.server.port}/')
+        self.engine = MarketDataEngine(self.broker, min_interval=.01, max_interval=.05)
+
+    async def asyncTearDown(self) -> None:
+        await self.engine.stop()
+        await self.broker.close()
+        await self.server.close()
+
+    async def test_get_quote(self):
+        self.assertEqual(await self.broker.get_quote('IRO1FAKE0001'), 1000)
+
+    async def test_triggers_by_direction(self):
+        above = self.engine.watch('IRO1FAKE0001', 'above', 1100)
+        below = self.engine.watch('IRO1FAKE0001', 'below', 900)
+        await asyncio.sleep(.1)
+        self.assertFalse(above.fired.done() or below.fired.done())
+
+        self.simulator.prices['IRO1FAKE0001'] = 1150
+        self.assertEqual(await asyncio.wait_for(above.fired, 1), 1150)
+        self.assertFalse(below.fired.done())
+
+        self.simulator.prices['IRO1FAKE0001'] = 900
+        self.assertEqual(await asyncio.wait_for(below.fired, 1), 900)
+
+    async def test_one_poll_loop_per_symbol(self):
+        triggers = [self.engine.watch('IRO1FAKE0001', 'above', 2000 + i) for i in range(1000)]
+
+        self.assertEqual(list(self.engine.tasks), ['IRO1FAKE0001'])
+
+        for trigger in triggers:
+            self.engine.unwatch(trigger)
+        await asyncio.sleep(.1)
+        self.assertEqual(self.engine.tasks, {})
+        self.assertTrue(all(trigger.fired.cancelled() for trigger in triggers))
+
+    async def test_polls_faster_near_threshold(self):
+        self.engine.watch('IRO1FAKE0001', 'above', 2000)
+        await asyncio.sleep(.02)
+        far = self.engine.interval('IRO1FAKE0001')
+
+        self.engine.watch('IRO1FAKE0001', 'above', 1001)
+        near = self.engine.interval('IRO1FAKE0001')
+
+        self.assertEqual(far, self.engine.max_interval)
+        self.assertLess(near, far)
@@ -0,0 +1,52 @@
+import unittest
+
+from pkg.internal.metrics import Registry, counter, histogram
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = Registry()
+
+    def test_histogram_buckets_are_cumulative(self):
+        metric = histogram('latency_seconds', 'Latency', ['endpoint'], buckets=(.1, 1), registry=self.registry)
+
+        for value in (.05, .5, .5, 5):
+            metric.labels(endpoint='order').observe(value)
+
+        rendered = self.registry.render()
+        self.assertIn('latency_seconds_bucket{endpoint="order",le="0.1"} 1', rendered)
+        self.assertIn('latency_seconds_bucket{endpoint="order",le="1.0"} 3', rendered)
+        self.assertIn('latency_seconds_bucket{endpoint="order",le="+Inf"} 4', rendered)
+        self.assertIn('latency_seconds_count{endpoint="order"} 4', rendered)
+        self.assertIn('latency_seconds_sum{endpoint="order"} 6.05', rendered)
+
+    def test_histogram_timer_decorator(self):
+        metric = histogram('call_seconds', 'Call time', registry=self.registry)
+
+        @metric.time()
+        def call():
+            return 42
+
+        self.assertEqual(call(), 42)
+        self.assertEqual(call(), 42)
+        self.assertEqual(metric.labels().count, 2)
+
+    def test_counter(self):
+        metric = counter('orders', 'Orders', ['outcome'], registry=self.registry)
+
+        metric.labels('committed').inc()
+        metric.labels(outcome='committed').inc(2)
+
+        self.assertIn('orders_total{outcome="committed"} 3.0', self.registry.render())
+
+    def test_wrong_labels(self):
+        metric = counter('orders', 'Orders', ['outcome'], registry=self.registry)
+
+        with self.assertRaises(ValueError):
+            metric.labels()
+
+    def test_duplicate_metric(self):
+        counter('orders', 'Orders', registry=self.registry)
+
+        with self.assertRaises(ValueError):
+            counter('orders', 'Orders', registry=self.registry)
@@ -0,0 +1,68 @@
+import asyncio
+import datetime
+import unittest
+import uuid
+from typing import List
+
+from pkg.internal.pending import PendingOrder, PendingOrders
+from pkg.models import Order
+
+
+def make_order(deadline: datetime.datetime, group_id=None) -> Order:
+    order = Order(
+        id=uuid.uuid4(),
+        broker='FAKE',
+        isin='IRO1FAKE0001',
+        count=1,
+        price=1000,
+        status='SCHEDULED',
+        username='user',
+        deadline=deadline,
+        group_id=group_id,
+    )
+    order.trace.mark("scheduled")
+    return order
+
+
+class PendingOrdersTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.woken: List[List[PendingOrder]] = []
+        self.pending = PendingOrders(self.woken.append, wake_before=datetime.timedelta(seconds=1))
+
+    async def asyncTearDown(self) -> None:
+        await self.pending.stop()
+
+    def in_seconds(self, seconds: float) -> datetime.datetime:
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=seconds)
+
+    def test_round_trip(self):
+        order = make_order(self.in_seconds(60), group_id=uuid.uuid4())
+
+        self.assertEqual(PendingOrder(order).to_order(), order)
+
+    async def test_wakes_in_deadline_order(self):
+        late = make_order(self.in_seconds(1.2))
+        self.pending.add([late])
+        # Added later but due first, has to cut the timer short
+        early = make_order(self.in_seconds(1.05))
+        self.pending.add([early])
+        self.assertEqual(len(self.pending), 2)
+
+        await asyncio.sleep(.1)
+        self.assertEqual([[order.id for order in group] for group in self.woken], [[early.id]])
+        self.assertNotIn(early.id, self.pending)
+        self.assertIn(late.id, self.pending)
+
+        await asyncio.sleep(.2)
+        self.assertEqual(len(self.woken), 2)
+        self.assertEqual(len(self.pending), 0)
+
+    async def test_group_wakes_together(self):
+        deadline = self.in_seconds(.5)
+        group_id = uuid.uuid4()
+        orders = [make_order(deadline, group_id) for _ in range(3)]
+        self.pending.add(orders)
+
+        await asyncio.sleep(0)
+
+        self.assertEqual([order.to_order() for order in self.woken[0]], orders)
@@ -0,0 +1,100 @@
+import asyncio
+import datetime
+import time
+import unittest
+
+from aiohttp.test_utils import TestServer
+from yarl import URL
+
+from pkg.internal.brokers import LatencyProber, RateLimiter
+from pkg.internal.brokers.simulator import Simulator, SimulatorConfig
+from pkg.internal.metrics import LATENCY_PROBES
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class LatencyProberTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.server = TestServer(Simulator(SimulatorConfig(seed=0)).create_app(), host='localhost')
+        await self.server.start_server()
+        self.prober = LatencyProber(
+            'PROBER',
+            URL(f'http://localhost:{self.server.port}/'),
+            RateLimiter('PROBER', rate=1000, burst=1000),
+            min_interval=.01,
+            max_interval=.05,
+            stop_before=0,
+            tolerance=0,
+        )
+
+    async def asyncTearDown(self) -> None:
+        await self.prober.close()
+        await self.server.close()
+
+    async def test_samples_over_one_connection(self):
+        handshakes = LATENCY_PROBES.labels('PROBER', 'handshake').value
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=.5)
+
+        estimate = await self.prober.wait_for_estimate(deadline)
+
+        self.assertIsNotNone(estimate)
+        self.assertEqual(estimate, min(self.prober.samples))
+        self.assertEqual(LATENCY_PROBES.labels('PROBER', 'handshake').value - handshakes, 1)
+
+    async def test_settles_early_once_stable(self):
+        self.prober.tolerance = 10
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+
+        started = time.monotonic()
+        estimate = await asyncio.wait_for(self.prober.wait_for_estimate(deadline), 5)
+
+        self.assertIsNotNone(estimate)
+        self.assertLess(time.monotonic() - started, 5)
+
+    async def test_shared_between_orders(self):
+        now = datetime.datetime.utcnow()
+
+        estimates = await asyncio.gather(
+            self.prober.wait_for_estimate(now + datetime.timedelta(seconds=.3)),
+            self.prober.wait_for_estimate(now + datetime.timedelta(seconds=.4)),
+        )
+
+        self.assertTrue(all(estimate is not None for estimate in estimates))
+        self.assertFalse(self.prober.waiters)
+
+    async def test_releases_orders_when_sampling_fails(self):
+        async def sample():
+            raise RuntimeError('boom')
+        self.prober._LatencyProber__sample = sample  # type: ignore
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+
+        estimate = await asyncio.wait_for(self.prober.wait_for_estimate(deadline), 1)
+
+        self.assertIsNone(estimate)
+        self.assertFalse(self.prober.waiters)
+
+    async def test_gives_up_at_the_deadline_when_sampling_stalls(self):
+        async def sample():
+            await asyncio.sleep(60)
+        self.prober._LatencyProber__sample = sample  # type: ignore
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=.2)
+
+        estimate = await asyncio.wait_for(self.prober.wait_for_estimate(deadline), 1)
+
+        self.assertIsNone(estimate)
+        self.assertFalse(self.prober.waiters)
+
+    def test_interval_shrinks_near_deadline(self):
+        self.prober.min_interval, self.prober.max_interval = .25, 30
+        now = time.time()
+
+        self.prober.waiters = [(now + 600, 0, None)]  # type: ignore
+        far = self.prober.interval(now)
+        self.prober.waiters = [(now + 20, 0, None)]  # type: ignore
+        near = self.prober.interval(now)
+
+        self.assertEqual(far, 30)
+        self.assertEqual(near, 2)
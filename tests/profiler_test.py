@@ -0,0 +1,86 @@
+import asyncio
+import time
+import unittest
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from pkg.internal.profiler import SamplingProfiler
+from pkg.server.profiling import setup_profiling
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class Broker:
+    async def login(self):
+        await asyncio.sleep(.3)
+
+
+class Solver:
+    def predict(self):
+        # Blocks the loop like model inference
+        started = time.perf_counter()
+        while time.perf_counter() - started < .2:
+            pass
+
+
+class SamplingProfilerTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_attributes_waiting_and_running_time(self):
+        profiler = SamplingProfiler(.005, components=(Broker, Solver))
+        profiler.start()
+
+        async def solve():
+            await asyncio.sleep(.01)
+            Solver().predict()
+
+        await asyncio.gather(Broker().login(), Broker().login(), solve())
+        profiler.stop()
+
+        summary = profiler.summary()['components']
+        # Two logins waited concurrently
+        self.assertGreater(summary['Broker']['wall_seconds'], .4)
+        self.assertEqual(summary['Broker']['cpu_seconds'], 0)
+        self.assertGreater(summary['Solver']['cpu_seconds'], .1)
+        tasks = profiler.collapsed('tasks')
+        self.assertIn('Task;tests.profiler_test:Broker.login;asyncio.tasks:sleep ', tasks)
+        self.assertIn('tests.profiler_test:Solver.predict ', tasks)
+        self.assertIn('MainThread;', profiler.collapsed('threads'))
+
+
+class ProfilingEndpointsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        app = web.Application()
+        setup_profiling(app, admin_token='secret')
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+        self.headers = {'Authorization': 'Bearer secret'}
+
+    async def asyncTearDown(self) -> None:
+        self.client.app['profiler'].stop()  # type: ignore
+        await self.client.close()
+
+    async def test_requires_the_admin_token(self):
+        response = await self.client.post('/admin/profile/start', headers={'Authorization': 'Bearer guess'})
+
+        self.assertEqual(response.status, 401)
+        self.assertFalse(self.client.app['profiler'].running)  # type: ignore
+
+    async def test_toggles_the_profilers(self):
+        response = await self.client.post('/admin/profile/start?interval=.005', headers=self.headers)
+        self.assertEqual(response.status, 200)
+        await asyncio.sleep(.1)
+        response = await self.client.post('/admin/profile/stop', headers=self.headers)
+        self.assertGreater((await response.json())['samples'], 0)
+
+        response = await self.client.get('/admin/profile', headers=self.headers)
+        self.assertRegex(await response.text(), r'(?m)^\S+ \d+$')
+
+        await self.client.post('/admin/memory/start', headers=self.headers)
+        try:
+            response = await self.client.get('/admin/memory?format=top&limit=5', headers=self.headers)
+            self.assertEqual(len(await response.json()), 5)
+        finally:
+            await self.client.post('/admin/memory/stop', headers=self.headers)
@@ -0,0 +1,66 @@
+import asyncio
+import datetime
+import unittest
+
+from pkg.internal.brokers import RateLimitedError, RateLimiter
+from pkg.internal.critical import CriticalWindow
+from pkg.internal.looplag import LoopLagMonitor
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class RateLimiterTestCase(unittest.IsolatedAsyncioTestCase):
+    async def test_burst_then_rate(self):
+        limiter = RateLimiter(rate=100, burst=2)
+        started = asyncio.get_running_loop().time()
+
+        for _ in range(4):
+            async with limiter.acquire("dashboard"):
+                pass
+
+        # Two calls out of the bucket, the other two wait 10ms each for a token
+        self.assertGreaterEqual(asyncio.get_running_loop().time() - started, .015)
+
+    async def test_waiters_admitted_by_priority(self):
+        limiter = RateLimiter(rate=1000, burst=10, max_concurrency=1)
+        admitted = []
+
+        async def call(priority):
+            async with limiter.acquire(priority):
+                admitted.append(priority)
+                await asyncio.sleep(0)
+
+        async with limiter.acquire("dashboard"):
+            tasks = [asyncio.create_task(call(priority)) for priority in ("dashboard", "probe", "login")]
+            await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+
+        self.assertEqual(admitted, ["login", "probe", "dashboard"])
+
+    async def test_order_never_waits(self):
+        limiter = RateLimiter(rate=1, burst=1, max_concurrency=1)
+
+        async with limiter.acquire("dashboard"):
+            async with limiter.acquire("order"):
+                self.assertEqual(limiter.in_flight, 2)
+        self.assertLess(limiter.tokens, 0)
+
+    async def test_shed_near_deadline(self):
+        window = CriticalWindow(LoopLagMonitor(), before=10, after=2)
+        limiter = RateLimiter(window=window)
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=5)
+        window.arm(deadline)
+
+        for priority in ("probe", "dashboard"):
+            with self.assertRaises(RateLimitedError):
+                async with limiter.acquire(priority):  # type: ignore
+                    pass
+        async with limiter.acquire("login"):
+            pass
+
+        window.disarm(deadline)
+        async with limiter.acquire("dashboard"):
+            pass
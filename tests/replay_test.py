@@ -0,0 +1,79 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from aiohttp.test_utils import TestServer
+from yarl import URL
+
+from pkg.internal.brokers import FakeBroker, RateLimiter
+from pkg.internal.brokers.replay import Archive, ArchiveWriter, RecordingProxy, ReplayServer
+from pkg.internal.brokers.simulator import API_PREFIX, Simulator, SimulatorConfig
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class ReplayTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'session.zip')
+
+    async def asyncTearDown(self) -> None:
+        self.dir.cleanup()
+
+    async def session(self, url: str):
+        broker = FakeBroker(url, limiter=RateLimiter('FAKE', rate=1000, burst=1000))
+        try:
+            headers, cookies = await broker.login('1234', 'secret', 'python3.11')
+            balance = await broker.get_account_balance(headers, cookies)
+            stocks = await broker.get_stock('fold')
+            return broker.get_api_token(cookies), balance, stocks
+        finally:
+            await broker.close()
+
+    async def test_replays_a_recorded_session(self):
+        simulator = TestServer(Simulator(SimulatorConfig(seed=0)).create_app(), host='localhost')
+        await simulator.start_server()
+        upstream = URL(f'http://localhost:{simulator.port}/')
+        proxy = TestServer(
+            RecordingProxy(ArchiveWriter(self.path), upstream, upstream.with_path(API_PREFIX + '/')).create_app(),
+            host='localhost',
+        )
+        await proxy.start_server()
+        try:
+            recorded = await self.session(f'http://localhost:{proxy.port}/')
+        finally:
+            await proxy.close()
+            await simulator.close()
+
+        archive = Archive(self.path)
+        self.assertEqual(archive.meta['exchanges'], len(archive.exchanges))
+        login = next(exchange for exchange in archive.exchanges if exchange.path == '/login')
+        self.assertIsNone(login.request_body)
+        self.assertTrue(all('Cookie' not in exchange.request_headers for exchange in archive.exchanges))
+
+        server = ReplayServer(archive, time_scale=0)
+        replay = TestServer(server.create_app(), host='localhost')
+        await replay.start_server()
+        try:
+            replayed = await self.session(f'http://localhost:{replay.port}/')
+        finally:
+            await replay.close()
+
+        self.assertIsNotNone(recorded[0])
+        self.assertEqual(replayed, recorded)
+        self.assertFalse(server.misses)
+
+    def test_rewrites_cookies_and_redirects(self):
+        proxy = RecordingProxy(None, URL('https://site.test/'), URL('https://api.site.test/Web/V1/'))  # type: ignore
+
+        self.assertEqual(
+            proxy.rewrite('Set-Cookie', 'token=1; Domain=.site.test; Path=/; Secure; HttpOnly'),
+            'token=1; Path=/; HttpOnly',
+        )
+        self.assertEqual(proxy.rewrite('Location', 'https://site.test/account'), '/account')
+        self.assertEqual(proxy.rewrite('Location', 'https://api.site.test/Web/V1/x'), API_PREFIX + '/x')
+        self.assertEqual(proxy.upstream_url(API_PREFIX + '/Symbol?term=a'), URL('https://api.site.test/Web/V1/Symbol?term=a'))
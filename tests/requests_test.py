@@ -0,0 +1,136 @@
+import asyncio
+import datetime
+import json
+import unittest
+from unittest import mock
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from yarl import URL
+
+from pkg.internal.brokers import StaticResolver
+from pkg.internal.requests import ArmedRequest, FlushingResponseHandler, RawRequest, schedule_requests
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+async def echo(request: web.Request) -> web.Response:
+    """ What the server made of the request """
+    return web.json_response({
+        'method': request.method,
+        'path_qs': request.path_qs,
+        'query': dict(request.query),
+        'cookies': dict(request.cookies),
+        'headers': {
+            name: request.headers.get(name)
+            for name in ('Host', 'Content-Type', 'Content-Length', 'Transfer-Encoding', 'Authorization')
+        },
+        'body': await request.text(),
+    }, headers={'X-Echo': 'yes'})
+
+
+class RequestsTestCase(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_route('*', '/{tail:.*}', echo)
+        self.server = TestServer(app, host='localhost')
+        await self.server.start_server()
+        self.url = URL(f'http://localhost:{self.server.port}/Web/V1/Order/Post?symbol=IRO1FOLD0001&side=65')
+        self.headers = {'Authorization': 'BasicAuthentication token', 'Content-Type': 'application/json'}
+        self.cookies = {'session': 'abc', 'captcha_session': 'def'}
+        self.body = json.dumps({'isin': 'IRO1FOLD0001', 'orderPrice': 1000, 'orderCount': 2}).encode()
+
+    async def asyncTearDown(self) -> None:
+        await self.server.close()
+
+    async def expected(self, method: str = 'POST', data: bytes = b''):
+        async with aiohttp.ClientSession(cookies=self.cookies) as session:
+            async with session.request(method, self.url, headers=self.headers, data=data or None) as response:
+                return await response.json()
+
+    async def fire(self, request: ArmedRequest):
+        async with request.make_connection() as conn:
+            async with request.send(conn) as response:
+                return response.status, response.headers.get('X-Echo'), await response.json()
+
+    async def test_armed_post_is_parsed_like_a_session_request(self):
+        request = ArmedRequest('POST', self.url, headers=self.headers, cookies=self.cookies, data=self.body)
+
+        status, echoed, received = await self.fire(request)
+
+        self.assertEqual((status, echoed), (200, 'yes'))
+        self.assertEqual(received, await self.expected(data=self.body))
+        self.assertEqual(received['query'], {'symbol': 'IRO1FOLD0001', 'side': '65'})
+        self.assertEqual(received['cookies'], self.cookies)
+        self.assertEqual(json.loads(received['body']), json.loads(self.body))
+        self.assertIsNone(received['headers']['Transfer-Encoding'])
+
+    async def test_armed_get_without_body(self):
+        request = ArmedRequest('GET', self.url, headers=self.headers, cookies=self.cookies)
+
+        _, _, received = await self.fire(request)
+
+        self.assertEqual(received, await self.expected('GET'))
+        self.assertTrue(request.payload.endswith(b'\r\n\r\n'))
+
+    async def test_raw_request_is_parsed_like_a_session_request(self):
+        request = RawRequest('POST', self.url, headers=self.headers, cookies=self.cookies, data=self.body)
+
+        async with request.make_connection() as conn:
+            async with request.send(conn) as response:
+                received = await response.json()
+
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.headers['X-Echo'], 'yes')
+        self.assertGreaterEqual(response.write_time, 0)
+        self.assertEqual(received, await self.expected(data=self.body))
+
+    async def test_raw_request_waits_for_the_write_to_flush(self):
+        # More than the socket takes at once, the transport has to pause the protocol
+        body = b'x' * (8 * 1024 * 1024)
+        request = RawRequest('POST', self.url, headers=self.headers, data=body)
+        pause_writing = FlushingResponseHandler.pause_writing
+
+        with mock.patch.object(
+                FlushingResponseHandler, 'pause_writing', autospec=True, side_effect=pause_writing) as paused:
+            async with request.make_connection() as conn:
+                async with request.send(conn) as response:
+                    buffered = conn.transport.get_write_buffer_size()
+                    received = await response.json()
+
+        self.assertEqual(response.status, 200)
+        self.assertTrue(paused.called)
+        self.assertEqual(buffered, 0)
+        self.assertEqual(len(received['body']), len(body))
+
+    async def test_raw_request_tries_the_next_address(self):
+        closed = await asyncio.start_server(lambda reader, writer: None, '127.0.0.1', 0)
+        closed_port = closed.sockets[0].getsockname()[1]
+        closed.close()
+        await closed.wait_closed()
+        resolver = StaticResolver({'localhost': [('127.0.0.1', closed_port), ('127.0.0.1', self.server.port)]})
+        request = RawRequest('GET', self.url, resolver=resolver)
+
+        async with request.make_connection() as conn:
+            async with request.send(conn) as response:
+                await response.read()
+
+        self.assertEqual(response.status, 200)
+
+    async def test_raw_request_without_addresses(self):
+        request = RawRequest('GET', self.url, resolver=StaticResolver({'localhost': []}))
+
+        with self.assertRaisesRegex(ConnectionError, '0 addresses tried'):
+            async with request.make_connection():
+                pass
+
+    async def test_schedule_no_requests(self):
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+
+        results = await asyncio.wait_for(schedule_requests([], deadline), 1)
+
+        self.assertEqual(results, [])
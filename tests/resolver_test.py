@@ -0,0 +1,125 @@
+import asyncio
+import ssl
+import tempfile
+import unittest
+
+from aiohttp import web
+from yarl import URL
+
+from pkg.bench.proxy import DelayProxy, NetworkProfile
+from pkg.bench.servers import make_self_signed_cert, server_ssl_context
+from pkg.internal.brokers import EndpointResolver, RateLimiter, StaticResolver
+from pkg.internal.requests import ArmedRequest, RawRequest
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class EndpointResolverTestCase(unittest.IsolatedAsyncioTestCase):
+    """ One TLS server behind three loopback proxies, each adding its own delay """
+
+    async def asyncSetUp(self) -> None:
+        certdir = tempfile.TemporaryDirectory()
+        self.addCleanup(certdir.cleanup)
+        certfile, keyfile = make_self_signed_cert(certdir.name)
+        self.client_ssl = ssl.create_default_context(cafile=certfile)
+
+        app = web.Application()
+        app.router.add_get('/', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, 'localhost', 0, ssl_context=server_ssl_context(certfile, keyfile))
+        await site.start()
+        server_port = site._server.sockets[0].getsockname()[1]  # type: ignore
+
+        self.proxies = {}
+        self.servers = []
+        for address, latency in [('127.0.0.2', .03), ('127.0.0.3', 0), ('127.0.0.4', .015)]:
+            proxy = DelayProxy(server_port, NetworkProfile(latency=latency))
+            server = await asyncio.start_server(proxy.handle, address, 0)
+            self.servers.append(server)
+            self.proxies[(address, server.sockets[0].getsockname()[1])] = proxy
+
+        self.resolver = EndpointResolver(
+            'FAKE', resolver=StaticResolver({'localhost': list(self.proxies)}), probe_count=2)
+        self.url = URL('https://localhost/')
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text='ok')
+
+    async def asyncTearDown(self) -> None:
+        await self.resolver.close()
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+        await self.runner.cleanup()
+
+    def address_with_latency(self, latency: float) -> str:
+        (address, port), = [key for key, proxy in self.proxies.items() if proxy.profile.latency == latency]
+        return f'{address}:{port}'
+
+    async def test_fastest_address_first(self):
+        await self.resolver.warm(self.url, self.client_ssl)
+
+        hosts = await self.resolver.resolve('localhost', 443)
+
+        self.assertEqual([f"{host['host']}:{host['port']}" for host in hosts], [
+            self.address_with_latency(0), self.address_with_latency(.015), self.address_with_latency(.03)])
+
+    async def test_order_connections_use_the_fastest_address(self):
+        await self.resolver.warm(self.url, self.client_ssl)
+
+        for request_class in (ArmedRequest, RawRequest):
+            request = request_class('get', self.url, ssl_context=self.client_ssl, resolver=self.resolver)
+            async with request.make_connection() as conn:
+                peer = conn.transport.get_extra_info('peername')  # type: ignore
+                async with request.send(conn) as response:
+                    await response.read()
+
+            self.assertEqual(f'{peer[0]}:{peer[1]}', self.address_with_latency(0))
+            self.assertEqual(response.status, 200)
+
+    async def test_reevaluate_moves_to_the_new_fastest(self):
+        await self.resolver.warm(self.url, self.client_ssl)
+        fast = self.address_with_latency(0)
+        slow = self.address_with_latency(.03)
+        for proxy in self.proxies.values():
+            proxy.profile = NetworkProfile(latency=.03 - proxy.profile.latency)
+
+        await self.resolver.reevaluate()
+
+        self.assertEqual(self.resolver.fastest('localhost', 443).address, slow)  # type: ignore
+        self.assertNotEqual(slow, fast)
+
+    async def test_probes_take_limiter_slots(self):
+        limiter = RateLimiter('FAKE')
+        acquired = []
+        acquire = limiter.acquire
+
+        def recording_acquire(priority):
+            acquired.append(priority)
+            return acquire(priority)
+        limiter.acquire = recording_acquire  # type: ignore
+        self.resolver.limiter = limiter
+
+        await self.resolver.warm(self.url, self.client_ssl)
+
+        # Two probes of each of the three addresses
+        self.assertEqual(acquired, ['probe'] * 6)
+        self.assertEqual(limiter.in_flight, 0)
+
+    async def test_stops_reevaluating_once_no_order_is_left(self):
+        await self.resolver.warm(self.url, self.client_ssl)
+        await self.resolver.warm(self.url, self.client_ssl)
+        task = self.resolver.task
+
+        self.resolver.release(self.url)
+        still_running = self.resolver.task is task
+        self.resolver.release(self.url)
+        await asyncio.sleep(0)
+
+        self.assertTrue(still_running)
+        self.assertIsNone(self.resolver.task)
+        self.assertTrue(task.cancelled())  # type: ignore
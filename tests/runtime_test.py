@@ -0,0 +1,43 @@
+import asyncio
+import unittest
+
+from pkg.config import RuntimeConfig
+from pkg.internal.runtime import install_runtime
+
+
+class RuntimeTestCase(unittest.TestCase):
+    def tearDown(self) -> None:
+        asyncio.set_event_loop_policy(None)
+
+    def test_asyncio_loop_settings(self):
+        install_runtime(RuntimeConfig(executor_workers=3, clock_resolution=.001))
+
+        async def inspect():
+            return asyncio.get_running_loop()
+
+        loop = asyncio.run(inspect())
+        self.assertIsInstance(loop, asyncio.SelectorEventLoop)
+        self.assertEqual(loop._clock_resolution, .001)
+
+    def test_executor_workers(self):
+        install_runtime(RuntimeConfig(executor_workers=3))
+
+        async def executor_threads():
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, lambda: None)
+            return loop._default_executor._max_workers
+
+        self.assertEqual(asyncio.run(executor_threads()), 3)
+
+    def test_uvloop(self):
+        try:
+            import uvloop
+        except ImportError:
+            self.skipTest('uvloop is not installed')
+
+        install_runtime(RuntimeConfig(loop='uvloop'))
+
+        async def inspect():
+            return type(asyncio.get_running_loop())
+
+        self.assertIs(asyncio.run(inspect()), uvloop.Loop)
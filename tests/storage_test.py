@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 import datetime
 import uuid
@@ -5,6 +7,8 @@ import uuid
 import aiohttp
 from yarl import URL
 
+from pkg.internal.latencyprofile import LatencyBucket
+from pkg.journal import JournalStorage
 from pkg.models import Account, Order
 
 from pkg.storage import (
@@ -49,6 +53,45 @@ class StorageTestCase(unittest.TestCase):
 
         self.assertEqual(self.storage.get_order_by_id(order.id).status, 'DONE')
 
+    def test_update_order_trace(self):
+        order = Order(id=uuid.uuid4(), broker='FAKE', isin='IRFake', count=1, price=1, status='SCHEDULED')
+        order.trace.mark('scheduled')
+        self.storage.add_order(order)
+
+        order.trace.mark('fire')
+        order.trace.mark('committed')
+        self.storage.update_order_trace(order.id, order.trace)
+
+        self.assertEqual(self.storage.get_order_by_id(order.id).trace, order.trace)
+
+    def test_get_scheduled_orders(self):
+        deadline = datetime.datetime.utcnow() + datetime.timedelta(minutes=5)
+        orders = [
+            Order(id=uuid.uuid4(), broker='FAKE', isin='IRFake', count=1, price=1,
+                  status='SCHEDULED', username='1234', deadline=deadline),
+            Order(id=uuid.uuid4(), broker='FAKE', isin='IRFake', count=1, price=2,
+                  status='DONE', username='1234', deadline=deadline),
+            Order(id=uuid.uuid4(), broker='FAKE', isin='IRFake', count=1, price=3,
+                  status='SCHEDULED', username='1234',
+                  deadline=datetime.datetime.utcnow() - datetime.timedelta(minutes=5)),
+        ]
+        for order in orders:
+            self.storage.add_order(order)
+
+        self.assertEqual(list(self.storage.get_scheduled_orders()), orders[:1])
+
+    def test_add_orders(self):
+        group_id = uuid.uuid4()
+        orders = [
+            Order(id=uuid.uuid4(), broker='FAKE', isin='IRFake', count=1, price=1,
+                  status='SCHEDULED', username=username, group_id=group_id)
+            for username in ('1234', '5678')
+        ]
+
+        self.storage.add_orders(orders)
+
+        self.assertEqual([self.storage.get_order_by_id(order.id) for order in orders], orders)
+
     def test_get_none_existent_order(self):
         with self.assertRaises(RecordNotFoundError):
             self.storage.get_order_by_id(uuid.uuid4())
@@ -170,3 +213,169 @@ class StorageTestCase(unittest.TestCase):
         )
         with self.assertRaises(DuplicateRecordError):
             self.storage.add_account(account_dup)
+
+    def test_get_accounts_by_usernames(self):
+        for username in ('1234', '5678'):
+            self.storage.add_account(Account(
+                id=uuid.uuid4(),
+                broker='FAKE',
+                username=username,
+                password='1234',
+                last_login=datetime.datetime.utcnow(),
+                cookies=aiohttp.CookieJar(),
+                headers={},
+            ))
+
+        accounts = self.storage.get_accounts_by_usernames(['1234', '5678', '9012'])
+
+        self.assertEqual(sorted(accounts), ['1234', '5678'])
+        self.assertEqual(accounts['5678'].username, '5678')
+
+    def test_get_account_listing(self):
+        for username, broker in (('1234', 'FAKE'), ('5678', 'TAVANA')):
+            self.storage.add_account(Account(
+                id=uuid.uuid4(),
+                broker=broker,
+                username=username,
+                password='1234',
+                last_login=datetime.datetime.utcnow(),
+                cookies=aiohttp.CookieJar(),
+                headers={},
+            ))
+
+        self.assertEqual(sorted(self.storage.get_account_listing()), [('1234', 'FAKE'), ('5678', 'TAVANA')])
+
+    def test_save_accounts(self):
+        known = Account(
+            id=uuid.uuid4(),
+            broker='FAKE',
+            username='1234',
+            password='1234',
+            last_login=datetime.datetime(2024, 1, 6, 8),
+            cookies=aiohttp.CookieJar(),
+            headers={},
+        )
+        self.storage.add_account(known)
+        refreshed_at = datetime.datetime(2024, 1, 7, 8)
+
+        self.storage.save_accounts([
+            Account(
+                id=uuid.uuid4(),
+                broker='FAKE',
+                username=username,
+                password='1234',
+                last_login=refreshed_at,
+                cookies=aiohttp.CookieJar(),
+                headers={'User-Agent': username},
+            )
+            for username in ('1234', '5678')
+        ])
+
+        accounts = self.storage.get_accounts_by_usernames(['1234', '5678'])
+        self.assertEqual(accounts['1234'].id, known.id)
+        self.assertEqual([accounts[username].headers for username in ('1234', '5678')], [
+            {'User-Agent': '1234'}, {'User-Agent': '5678'}])
+        self.assertEqual({account.last_login for account in accounts.values()}, {refreshed_at})
+
+    def test_latency_buckets(self):
+        day = datetime.date(2024, 1, 6)
+        bucket = LatencyBucket(broker='FAKE', day=day, minute=540, count=2, min=.01, p50=.02, p90=.03)
+        self.storage.add_latency_buckets([bucket])
+        self.storage.add_latency_buckets([
+            LatencyBucket(broker='FAKE', day=day, minute=540, count=2, min=.005, p50=.04, p90=.05),
+            LatencyBucket(broker='FAKE', day=day - datetime.timedelta(days=30), minute=540, count=1, min=1, p50=1, p90=1),
+        ])
+
+        buckets = self.storage.get_latency_buckets('FAKE', [539, 540], since=day - datetime.timedelta(days=1))
+
+        self.assertEqual(buckets, [
+            LatencyBucket(broker='FAKE', day=day, minute=540, count=4, min=.005, p50=.03, p90=.05)])
+
+        self.storage.delete_latency_buckets('FAKE', before=day)
+        self.assertEqual(len(self.storage.get_latency_buckets('FAKE', [540], since=datetime.date.min)), 1)
+
+
+class JournalStorageTestCase(StorageTestCase):
+    """ The sqlite tests against the journaled storage """
+
+    def setUp(self) -> None:
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = directory.name
+        self.storage = JournalStorage(self.path, commit_interval=.001)
+        self.addCleanup(lambda: self.storage.close())
+
+    def reopen(self, **kwargs) -> JournalStorage:
+        self.storage.close()
+        self.storage = JournalStorage(self.path, commit_interval=.001, **kwargs)
+        return self.storage
+
+    def add_orders(self, count: int):
+        orders = [
+            Order(
+                id=uuid.uuid4(),
+                broker='FAKE',
+                isin='IRFake',
+                count=i,
+                price=1,
+                status='SCHEDULED',
+                deadline=datetime.datetime.utcnow() + datetime.timedelta(hours=1, seconds=i),
+            )
+            for i in range(count)
+        ]
+        for order in orders:
+            self.storage.add_order(order)
+        return orders
+
+    def test_recovery(self):
+        orders = self.add_orders(3)
+        self.storage.update_order_status(orders[0].id, 'FAILED')
+        self.storage.add_broker('FAKE')
+        self.storage.update_broker_latencies('FAKE', .01, .03, .02)
+
+        storage = self.reopen()
+
+        self.assertEqual(storage.get_order_by_id(orders[0].id).status, 'FAILED')
+        self.assertEqual(storage.get_scheduled_orders(), orders[1:])
+        self.assertEqual(storage.get_broker_latency('FAKE'), .01)
+
+    def test_recovery_after_compaction(self):
+        orders = self.add_orders(50)
+        # Small enough for every commit to start a new generation
+        storage = self.reopen(compact_bytes=1)
+        for order in orders[:10]:
+            storage.update_order_status(order.id, 'DONE')
+            storage.sync()
+
+        storage = self.reopen()
+
+        self.assertGreater(storage.generation, 0)
+        self.assertEqual(storage.get_order_by_id(orders[0].id).status, 'DONE')
+        self.assertEqual(storage.get_scheduled_orders(), orders[10:])
+        self.assertEqual(sorted(os.listdir(self.path)), [f'journal.{storage.generation}', f'snapshot.{storage.generation}'])
+
+    def test_recovery_removes_unfinished_snapshots(self):
+        orders = self.add_orders(2)
+        self.storage.close()
+        with open(os.path.join(self.path, 'snapshot.1.tmp'), 'wb') as fd:
+            fd.write(b'partial')
+
+        storage = self.reopen()
+
+        self.assertEqual(storage.get_scheduled_orders(), orders)
+        self.assertEqual(os.listdir(self.path), ['journal.0'])
+
+    def test_recovery_drops_torn_tail(self):
+        orders = self.add_orders(2)
+        self.storage.close()
+        journal = os.path.join(self.path, 'journal.0')
+        size = os.path.getsize(journal)
+        with open(journal, 'r+b') as fd:
+            fd.truncate(size - 3)
+
+        storage = self.reopen()
+
+        self.assertEqual(storage.get_scheduled_orders(), orders[:1])
+        self.assertLess(os.path.getsize(journal), size - 3)
+        storage.add_order(orders[1])
+        self.assertEqual(self.reopen().get_scheduled_orders(), orders)
@@ -0,0 +1,88 @@
+import asyncio
+import tempfile
+import unittest
+
+from pkg.bench.servers import make_self_signed_cert, server_ssl_context
+from pkg.internal.requests import ArmedRequest, WarmConnection, WarmPool
+from pkg.internal.tls import create_client_context
+
+
+def tearDownModule():
+    # IsolatedAsyncioTestCase leaves no current event loop behind, other modules still need one
+    asyncio.set_event_loop_policy(None)
+
+
+class WarmConnectionTestCase(unittest.IsolatedAsyncioTestCase):
+    """ Against a TLS server that answers every request and can drop its connections """
+
+    async def asyncSetUp(self) -> None:
+        certdir = tempfile.TemporaryDirectory()
+        self.addCleanup(certdir.cleanup)
+        certfile, keyfile = make_self_signed_cert(certdir.name)
+        self.writers = []
+        self.server = await asyncio.start_server(
+            self.handle, 'localhost', 0, ssl=server_ssl_context(certfile, keyfile))
+        port = self.server.sockets[0].getsockname()[1]
+        self.request = ArmedRequest('get', f'https://localhost:{port}/', ssl_context=create_client_context(certfile))
+
+    async def asyncTearDown(self) -> None:
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.writers.append(writer)
+        try:
+            while await reader.readuntil(b'\r\n\r\n'):
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def test_resumes_tls_session(self):
+        for _ in range(3):
+            async with self.request.make_connection() as conn:
+                ssl_object = conn.transport.get_extra_info('ssl_object')  # type: ignore
+                async with self.request.send(conn) as response:
+                    await response.read()
+
+        self.assertTrue(ssl_object.session_reused)
+
+    async def test_reconnects_in_background(self):
+        async with WarmConnection(self.request, check_interval=.01) as warm:  # type: ignore
+            first = warm.conn
+            # The server only gets the connection once its side of the handshake is done
+            while not self.writers:
+                await asyncio.sleep(.01)
+            for writer in self.writers:
+                writer.close()
+            await asyncio.sleep(.2)
+
+            self.assertIsNot(warm.conn, first)
+            self.assertTrue(WarmConnection.is_alive(warm.conn))
+            ssl_object = warm.conn.transport.get_extra_info('ssl_object')
+            self.assertTrue(ssl_object.session_reused)
+
+            conn = await warm.take()
+            async with self.request.send(conn) as response:
+                self.assertEqual(await response.text(), 'ok')
+
+    async def test_pool_replaces_dropped_connections(self):
+        pool = WarmPool(size=2, check_interval=.01)
+        async with pool.watching(self.request), pool.watching(self.request):
+            while len(self.writers) < 2:
+                await asyncio.sleep(.01)
+            first = [conn for _, _, conn in pool.idle]
+            for writer in self.writers:
+                writer.close()
+            await asyncio.sleep(.2)
+
+            self.assertEqual(len(pool.idle), 2)
+            for _, _, conn in pool.idle:
+                self.assertNotIn(conn, first)
+                self.assertTrue(WarmConnection.is_alive(conn))
+
+            async with pool.take(self.request) as conn:
+                async with self.request.send(conn) as response:
+                    self.assertEqual(await response.text(), 'ok')
+        self.assertFalse(pool.idle)